@@ -31,6 +31,7 @@ from bzrlib.commands import plugin_cmds
 from bzrlib.bzrdir import BzrFormat
 
 BzrFormat.register_feature("rebase-v1")
+BzrFormat.register_feature("rebase-v2")
 
 from bzrlib.plugins.rewrite.info import (
     bzr_commands,
@@ -65,21 +66,27 @@ def show_rebase_summary(params):
     features = getattr(params.new_tree._format, "features", None)
     if features is None:
         return
-    if not "rebase-v1" in features:
+    if not "rebase-v1" in features and not "rebase-v2" in features:
         return
     from bzrlib.plugins.rewrite.rebase import (
-        RebaseState1,
+        RebaseState2,
         rebase_todo,
         )
-    state = RebaseState1(params.new_tree)
+    state = RebaseState2(params.new_tree)
     try:
         replace_map = state.read_plan()[1]
     except errors.NoSuchFile:
         return
-    todo = list(rebase_todo(params.new_tree.branch.repository, replace_map))
+    todo = list(rebase_todo(params.new_tree.branch.repository, replace_map,
+        state))
     params.to_file.write('Rebase in progress. (%d revisions left)\n' % len(todo))
 
 
+from bzrlib.config import option_registry
+
+option_registry.register_lazy('rebase.ancestry_index',
+    'bzrlib.plugins.rewrite.ancestry', 'ancestry_index_option')
+
 from bzrlib.hooks import install_lazy_named_hook
 
 install_lazy_named_hook('bzrlib.status', 'hooks', 'post_status',
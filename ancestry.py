@@ -0,0 +1,265 @@
+# Copyright (C) 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Persistent index of the ancestry of revisions that are rebased onto."""
+
+from __future__ import absolute_import
+
+import base64
+import zlib
+
+from bzrlib import config as _mod_config
+from bzrlib.errors import NoSuchFile
+from bzrlib.revision import NULL_REVISION
+from bzrlib.trace import mutter
+
+
+ANCESTRY_INDEX_FILENAME = 'rebase-ancestry'
+ANCESTRY_INDEX_VERSION = 1
+# Number of revisions of which the ancestry is kept
+ANCESTRY_INDEX_MAX_TIPS = 8
+
+ancestry_index_option = _mod_config.Option('rebase.ancestry_index',
+    default=False, from_unicode=_mod_config.bool_from_store,
+    help="""\
+Whether to keep an index of the ancestry of the revisions rebased onto.
+
+The index is kept in the repository and makes rebasing onto the same
+upstream branch again cheaper.
+""")
+
+
+def find_unique_ancestors(graph, revid, ancestry):
+    """Find the ancestors of a revision that are not in an ancestry.
+
+    The ancestry of revid is searched breadth first, stopping at revisions
+    that are in ancestry.
+
+    :param graph: Graph object
+    :param revid: Revision id to start from
+    :param ancestry: Container with an ancestry, i.e. in which the ancestors
+        of every member are members as well
+    :return: Tuple with the set of ancestors of revid (including revid) that
+        are not in ancestry, and the set of revisions in ancestry at which
+        the search stopped.
+    """
+    if revid in ancestry:
+        return set(), set([revid])
+    unique = set([revid])
+    border = set()
+    pending = set([revid])
+    while pending:
+        parent_map = graph.get_parent_map(pending)
+        # Ghosts are not part of the ancestry
+        unique.difference_update(pending.difference(parent_map))
+        pending = set()
+        for parents in parent_map.itervalues():
+            for parent in parents:
+                if (parent == NULL_REVISION or parent in unique or
+                    parent in border):
+                    continue
+                if parent in ancestry:
+                    border.add(parent)
+                else:
+                    unique.add(parent)
+                    pending.add(parent)
+    return unique, border
+
+
+def _set_bit(bitmap, number):
+    bitmap[number >> 3] |= 1 << (number & 7)
+
+
+def _get_bit(bitmap, number):
+    if number >> 3 >= len(bitmap):
+        return False
+    return bool(bitmap[number >> 3] & (1 << (number & 7)))
+
+
+class IndexedAncestry(object):
+    """Ancestry of a revision, as stored in an `AncestryIndex`."""
+
+    def __init__(self, numbers, bitmap):
+        self._numbers = numbers
+        self._bitmap = bitmap
+
+    def __contains__(self, revid):
+        number = self._numbers.get(revid)
+        return number is not None and _get_bit(self._bitmap, number)
+
+
+class _StoredAncestries(object):
+    """Union of the ancestries stored in an `AncestryIndex`."""
+
+    def __init__(self, numbers, bitmaps):
+        self._numbers = numbers
+        self._bitmaps = bitmaps
+
+    def __contains__(self, revid):
+        number = self._numbers.get(revid)
+        if number is None:
+            return False
+        for bitmap in self._bitmaps:
+            if _get_bit(bitmap, number):
+                return True
+        return False
+
+
+class AncestryIndex(object):
+    """Persistent index of the ancestry of selected revisions.
+
+    Every revision in the index is assigned a number, and the ancestry of
+    each selected revision is stored as a bitmap over those numbers, so
+    checking whether a revision is an ancestor of a selected revision does
+    not involve any graph searches.
+
+    The index is stored in an append-only file. When the ancestry of a new
+    revision is added, only the ancestors that are not in the ancestry of
+    a revision that is already in the index are searched and added.
+    """
+
+    def __init__(self, transport, filename=ANCESTRY_INDEX_FILENAME,
+                 max_tips=ANCESTRY_INDEX_MAX_TIPS):
+        """Open an ancestry index.
+
+        :param transport: Transport of the directory with the index
+        :param filename: Name of the index file
+        :param max_tips: Maximum number of revisions to keep the ancestry of
+        """
+        self.transport = transport
+        self._filename = filename
+        self._max_tips = max_tips
+        self._revids = None
+        self._numbers = None
+        # Ancestry bitmaps, by revision id and in order of use
+        self._tips = None
+        self._tip_order = None
+        self._records = 0
+
+    def _header(self):
+        return "# Bazaar rewrite ancestry index %d\n" % ANCESTRY_INDEX_VERSION
+
+    def _ensure_loaded(self):
+        if self._tips is not None:
+            return
+        self._revids = []
+        self._numbers = {}
+        self._tips = {}
+        self._tip_order = []
+        self._records = 0
+        try:
+            text = self.transport.get_bytes(self._filename)
+        except NoSuchFile:
+            return
+        lines = text.splitlines(True)
+        if not lines or lines[0] != self._header():
+            mutter("ignoring ancestry index with unknown format")
+            self.transport.delete(self._filename)
+            return
+        for line in lines[1:]:
+            if not line.endswith("\n"):
+                # Incomplete record, written while being interrupted
+                break
+            fields = line.rstrip("\n").split(" ")
+            if fields[0] == "r":
+                self._numbers[fields[1]] = len(self._revids)
+                self._revids.append(fields[1])
+            elif fields[0] == "a":
+                self._add_tip(fields[1],
+                    bytearray(zlib.decompress(base64.b64decode(fields[2]))))
+                self._records += 1
+
+    def _add_tip(self, revid, bitmap):
+        if revid in self._tips:
+            self._tip_order.remove(revid)
+        self._tips[revid] = bitmap
+        self._tip_order.append(revid)
+        while len(self._tip_order) > self._max_tips:
+            del self._tips[self._tip_order.pop(0)]
+
+    def _serialize_tip(self, revid):
+        return "a %s %s\n" % (revid,
+            base64.b64encode(zlib.compress(str(self._tips[revid]))))
+
+    def _store(self, new_revids, tip):
+        if self._records + 1 > 2 * self._max_tips:
+            # Rewrite the index with only the ancestries that are kept
+            tmpname = self._filename + ".tmp"
+            f = self.transport.open_write_stream(tmpname)
+            try:
+                f.write(self._header())
+                for revid in self._revids:
+                    f.write("r %s\n" % revid)
+                for revid in self._tip_order:
+                    f.write(self._serialize_tip(revid))
+            finally:
+                f.close()
+            self.transport.move(tmpname, self._filename)
+            self._records = len(self._tip_order)
+            return
+        if len(self._revids) == len(new_revids) and self._records == 0:
+            text = self._header()
+        else:
+            text = ""
+        text += "".join(["r %s\n" % revid for revid in new_revids])
+        text += self._serialize_tip(tip)
+        self.transport.append_bytes(self._filename, text)
+        self._records += 1
+
+    def get_ancestry(self, graph, revid):
+        """Return the ancestry of a revision, adding it to the index if
+        necessary.
+
+        :param graph: Graph object
+        :param revid: Revision id
+        :return: `IndexedAncestry` with the ancestors of revid, including
+            revid itself
+        """
+        self._ensure_loaded()
+        if revid in self._tips:
+            bitmap = self._tips[revid]
+            self._tip_order.remove(revid)
+            self._tip_order.append(revid)
+            return IndexedAncestry(self._numbers, bitmap)
+        stored = _StoredAncestries(self._numbers, self._tips.values())
+        (unique, border) = find_unique_ancestors(graph, revid, stored)
+        base = None
+        for tip in reversed(self._tip_order):
+            if tip not in border:
+                continue
+            ancestry = IndexedAncestry(self._numbers, self._tips[tip])
+            if all([r in ancestry for r in border]):
+                base = tip
+                break
+        if base is None:
+            # None of the stored ancestries covers all of the ancestry that
+            # was not searched, so search everything
+            (unique, border) = find_unique_ancestors(graph, revid, ())
+            bitmap = bytearray()
+        else:
+            bitmap = bytearray(self._tips[base])
+        new_revids = []
+        for ancestor in unique:
+            if ancestor not in self._numbers:
+                self._numbers[ancestor] = len(self._revids)
+                self._revids.append(ancestor)
+                new_revids.append(ancestor)
+        bitmap.extend("\0" * ((len(self._revids) + 7) // 8 - len(bitmap)))
+        for ancestor in unique:
+            _set_bit(bitmap, self._numbers[ancestor])
+        self._add_tip(revid, bitmap)
+        self._store(new_revids, revid)
+        return IndexedAncestry(self._numbers, bitmap)
@@ -0,0 +1,225 @@
+# Copyright (C) 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Caches that live for the duration of a rebase or upgrade."""
+
+from __future__ import absolute_import
+
+from bzrlib.lru_cache import (
+    LRUCache,
+    LRUSizeCache,
+    )
+from bzrlib.revision import NULL_REVISION
+
+
+DEFAULT_MAX_TREES = 32
+
+# Maximum number of revisions to retrieve in a single call
+REVISION_PREFETCH_CHUNK = 500
+
+# Rough number of bytes used by an inventory entry, used when the tree
+# cache is bounded by memory rather than by number of trees.
+_INVENTORY_ENTRY_SIZE = 200
+
+
+def _estimate_tree_size(tree):
+    inv = getattr(tree, "root_inventory", None)
+    if inv is None:
+        return _INVENTORY_ENTRY_SIZE
+    return max(len(inv), 1) * _INVENTORY_ENTRY_SIZE
+
+
+class RevisionPresenceCache(object):
+    """Memo of which revisions are present in a repository.
+
+    Revisions are probed in bulk using `Repository.has_revisions`, so
+    a whole plan can be checked with a single lookup.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self._present = set([NULL_REVISION])
+        self._absent = set()
+
+    def prefetch(self, revids):
+        """Look up the presence of a set of revisions.
+
+        :param revids: Iterable over revision ids
+        """
+        missing = set(revids)
+        missing.difference_update(self._present)
+        missing.difference_update(self._absent)
+        if not missing:
+            return
+        present = self.repository.has_revisions(missing)
+        self._present.update(present)
+        self._absent.update(missing.difference(present))
+
+    def has_revision(self, revid):
+        """Check whether a revision is present.
+
+        :param revid: Revision id
+        :return: boolean
+        """
+        if revid not in self._present and revid not in self._absent:
+            self.prefetch([revid])
+        return revid in self._present
+
+    def get_present_revisions(self, revids):
+        """Filter out the revisions that are not present.
+
+        :param revids: Sequence of revision ids
+        :return: Tuple with the present revision ids, in the original order
+        """
+        self.prefetch(revids)
+        return tuple([r for r in revids if r in self._present])
+
+    def add(self, revid):
+        """Record that a revision has been added to the repository.
+
+        :param revid: Revision id
+        """
+        self._absent.discard(revid)
+        self._present.add(revid)
+
+
+class RevisionTreeCache(object):
+    """Bounded LRU cache of revision trees and their inventories.
+
+    In a linear rebase the base tree of a revision is the tree of the
+    revision replayed before it, so keeping the last few trees around
+    avoids deserializing the same inventories over and over.
+    """
+
+    def __init__(self, repository, max_trees=DEFAULT_MAX_TREES,
+                 max_size=None):
+        """Create a new tree cache.
+
+        :param repository: Repository to retrieve trees from
+        :param max_trees: Maximum number of trees to keep
+        :param max_size: Optional approximate maximum number of bytes used by
+            the cached trees; overrides max_trees
+        """
+        self.repository = repository
+        if max_size is not None:
+            self._trees = LRUSizeCache(max_size=max_size,
+                compute_size=_estimate_tree_size)
+        else:
+            self._trees = LRUCache(max_cache=max_trees)
+
+    def __contains__(self, revid):
+        return revid in self._trees
+
+    def prefetch(self, revids):
+        """Load the trees for a set of revisions in one go.
+
+        :param revids: Iterable over revision ids of present revisions
+        """
+        missing = []
+        for revid in revids:
+            if revid == NULL_REVISION or revid in self._trees:
+                continue
+            if revid not in missing:
+                missing.append(revid)
+        if not missing:
+            return
+        for tree in self.repository.revision_trees(missing):
+            self._trees[tree.get_revision_id()] = tree
+
+    def revision_tree(self, revid):
+        """Return the tree for a revision.
+
+        :param revid: Revision id
+        :return: Revision tree
+        """
+        tree = self._trees.get(revid)
+        if tree is None:
+            tree = self.repository.revision_tree(revid)
+            self._trees[revid] = tree
+        return tree
+
+    def get_inventory(self, revid):
+        """Return the inventory for a revision.
+
+        :param revid: Revision id
+        :return: Inventory
+        """
+        return self.revision_tree(revid).root_inventory
+
+
+class RevisionCache(object):
+    """Cache of the revisions referenced by a plan.
+
+    Revisions are retrieved in bounded chunks using
+    `Repository.get_revisions`. The cache provides ``get_revision``, so it
+    can be used in place of a repository when generating revision ids.
+    """
+
+    def __init__(self, repository, presence=None):
+        """Create a new revision cache.
+
+        :param repository: Repository to retrieve revisions from
+        :param presence: Optional `RevisionPresenceCache`, used to skip ghosts
+            when prefetching
+        """
+        self.repository = repository
+        if presence is None:
+            presence = RevisionPresenceCache(repository)
+        self.presence = presence
+        self._revisions = {}
+
+    def __contains__(self, revid):
+        return revid in self._revisions
+
+    def prefetch(self, revids):
+        """Retrieve a set of revisions.
+
+        Ghosts are silently ignored.
+
+        :param revids: Iterable over revision ids
+        """
+        missing = set(revids)
+        missing.discard(NULL_REVISION)
+        missing.difference_update(self._revisions)
+        if not missing:
+            return
+        missing = self.presence.get_present_revisions(sorted(missing))
+        for i in range(0, len(missing), REVISION_PREFETCH_CHUNK):
+            chunk = missing[i:i+REVISION_PREFETCH_CHUNK]
+            for rev in self.repository.get_revisions(chunk):
+                self._revisions[rev.revision_id] = rev
+
+    def get_revision(self, revid):
+        """Return a revision.
+
+        :param revid: Revision id
+        :return: `Revision` object
+        """
+        try:
+            return self._revisions[revid]
+        except KeyError:
+            rev = self.repository.get_revision(revid)
+            self._revisions[revid] = rev
+            return rev
+
+    def get_revisions(self, revids):
+        """Return a list of revisions.
+
+        :param revids: Sequence of revision ids
+        :return: List of `Revision` objects, in the same order
+        """
+        self.prefetch(revids)
+        return [self.get_revision(revid) for revid in revids]
@@ -39,13 +39,58 @@ from bzrlib.trace import (
 from bzrlib.plugins.rewrite import gettext
 
 
+def check_revision_rewriter_options(in_memory=False, hybrid=False):
+    """Check the options that select a revision rewriter.
+
+    :param in_memory: Whether to merge revisions in memory
+    :param hybrid: Whether to copy snapshots where possible
+    :raise BzrCommandError: If the options conflict
+    """
+    if in_memory and hybrid:
+        raise BzrCommandError(gettext(
+            "--in-memory and --hybrid are mutually exclusive"))
+
+
+def get_revision_rewriter(wt, state, merge_type=None, in_memory=False,
+                          hybrid=False, **kwargs):
+    """Create the revision rewriter for a working tree rebase.
+
+    :param wt: Working tree to rebase
+    :param state: Rebase state
+    :param merge_type: Optional merge type
+    :param in_memory: Whether to merge revisions in memory
+    :param hybrid: Whether to copy snapshots where possible
+    :return: Revision rewriter
+    """
+    from bzrlib import debug
+    from bzrlib.plugins.rewrite.rebase import (
+        REBASE_COMMIT_CHECK_INTERVAL,
+        HybridRevisionRewriter,
+        InMemoryRevisionRewriter,
+        WorkingTreeRevisionRewriter,
+        )
+    if 'rebase-check' in debug.debug_flags:
+        kwargs['check_interval'] = REBASE_COMMIT_CHECK_INTERVAL
+    if 'rebase-paranoid' in debug.debug_flags:
+        kwargs['paranoid'] = True
+    if in_memory:
+        rewriter_cls = InMemoryRevisionRewriter
+    elif hybrid:
+        rewriter_cls = HybridRevisionRewriter
+    else:
+        rewriter_cls = WorkingTreeRevisionRewriter
+    return rewriter_cls(wt, state, merge_type=merge_type, **kwargs)
+
+
 def finish_rebase(state, wt, replace_map, replayer):
     from bzrlib.plugins.rewrite.rebase import (
         rebase,
         )
     try:
         # Start executing plan from current Branch.last_revision()
-        rebase(wt.branch.repository, replace_map, replayer)
+        rebase(wt.branch.repository, replace_map, replayer, state,
+            trees=getattr(replayer, "trees", None),
+            revisions=getattr(replayer, "revisions", None))
     except ConflictsInTree:
         raise BzrCommandError(gettext("A conflict occurred replaying a commit."
             " Resolve the conflict and run 'bzr rebase-continue' or "
@@ -98,6 +143,12 @@ class cmd_rebase(Command):
             help="Rebase pending merges onto local branch."),
         Option('onto', help='Different revision to replay onto.',
             type=str),
+        Option('in-memory',
+            help="Replay revisions in memory and only update the working "
+                 "tree at the end or on conflicts."),
+        Option('hybrid',
+            help="Copy the snapshots of revisions that do not touch paths "
+                 "changed upstream rather than merging them."),
         Option('directory', 
             short_name='d',
             help="Branch to replay onto, rather than the one containing the working directory.",
@@ -108,26 +159,31 @@ class cmd_rebase(Command):
     def run(self, upstream_location=None, onto=None, revision=None,
             merge_type=None, verbose=False, dry_run=False,
             always_rebase_merges=False, pending_merges=False,
-            directory="."):
+            directory=".", in_memory=False, hybrid=False):
         from bzrlib.branch import Branch
         from bzrlib.revisionspec import RevisionSpec
         from bzrlib.workingtree import WorkingTree
+        from bzrlib.plugins.rewrite.ancestry import (
+            AncestryIndex,
+            find_unique_ancestors,
+            )
+        from bzrlib.plugins.rewrite.cache import RevisionCache
         from bzrlib.plugins.rewrite.rebase import (
             generate_simple_plan,
             rebase,
-            RebaseState1,
-            WorkingTreeRevisionRewriter,
+            RebaseState2,
             regenerate_default_revid,
             rebase_todo,
             )
         if revision is not None and pending_merges:
             raise BzrCommandError(gettext(
                 "--revision and --pending-merges are mutually exclusive"))
+        check_revision_rewriter_options(in_memory, hybrid)
 
         wt = WorkingTree.open_containing(directory)[0]
         wt.lock_write()
         try:
-            state = RebaseState1(wt)
+            state = RebaseState2(wt)
             if upstream_location is None:
                 if pending_merges:
                     upstream_location = directory
@@ -188,10 +244,20 @@ class cmd_rebase(Command):
             if stop_revid is None:
                 stop_revid = wt.branch.last_revision()
             repo_graph = wt.branch.repository.get_graph()
-            our_new, onto_unique = repo_graph.find_difference(stop_revid, onto)
+            if wt.branch.get_config_stack().get('rebase.ancestry_index'):
+                onto_ancestry = AncestryIndex(
+                    wt.branch.repository.control_transport).get_ancestry(
+                        repo_graph, onto)
+                our_new, border = find_unique_ancestors(repo_graph,
+                    stop_revid, onto_ancestry)
+                onto_merged = (onto in border)
+            else:
+                our_new, onto_unique = repo_graph.find_difference(
+                    stop_revid, onto)
+                onto_merged = not onto_unique
 
             if start_revid is None:
-                if not onto_unique:
+                if onto_merged:
                     self.outf.write(gettext("No revisions to rebase.\n"))
                     return
                 if not our_new:
@@ -204,13 +270,15 @@ class cmd_rebase(Command):
             # something.
 
             # Create plan
+            revisions = RevisionCache(wt.branch.repository)
+            revisions.prefetch(our_new)
             replace_map = generate_simple_plan(
                 our_new, start_revid, stop_revid,
                     onto, repo_graph,
                     lambda revid, ps: regenerate_default_revid(
-                        wt.branch.repository, revid),
-                    not always_rebase_merges
-                    )
+                        revisions, revid),
+                    not always_rebase_merges,
+                    is_difference=True)
 
             if verbose or dry_run:
                 todo = list(rebase_todo(wt.branch.repository, replace_map))
@@ -222,7 +290,9 @@ class cmd_rebase(Command):
                 # Write plan file
                 state.write_plan(replace_map)
 
-                replayer = WorkingTreeRevisionRewriter(wt, state, merge_type=merge_type)
+                replayer = get_revision_rewriter(wt, state,
+                    merge_type=merge_type, in_memory=in_memory,
+                    hybrid=hybrid, revisions=revisions)
 
                 finish_rebase(state, wt, replace_map, replayer)
         finally:
@@ -240,14 +310,14 @@ class cmd_rebase_abort(Command):
     @display_command
     def run(self, directory="."):
         from bzrlib.plugins.rewrite.rebase import (
-            RebaseState1,
+            RebaseState2,
             complete_revert,
             )
         from bzrlib.workingtree import WorkingTree
         wt = WorkingTree.open_containing(directory)[0]
         wt.lock_write()
         try:
-            state = RebaseState1(wt)
+            state = RebaseState2(wt)
             # Read plan file and set last revision
             try:
                 last_rev_info = state.read_plan()[0]
@@ -264,20 +334,29 @@ class cmd_rebase_continue(Command):
     takes_options = ['merge-type', Option('directory',
             short_name='d',
             help="Branch to replay onto, rather than the one containing the working directory.",
-            type=str)]
+            type=str),
+        Option('in-memory',
+            help="Replay revisions in memory and only update the working "
+                 "tree at the end or on conflicts."),
+        Option('hybrid',
+            help="Copy the snapshots of revisions that do not touch paths "
+                 "changed upstream rather than merging them."),
+        ]
 
     @display_command
-    def run(self, merge_type=None, directory="."):
+    def run(self, merge_type=None, directory=".", in_memory=False,
+            hybrid=False):
         from bzrlib.plugins.rewrite.rebase import (
-            RebaseState1,
-            WorkingTreeRevisionRewriter,
+            RebaseState2,
             )
         from bzrlib.workingtree import WorkingTree
+        check_revision_rewriter_options(in_memory, hybrid)
         wt = WorkingTree.open_containing(directory)[0]
         wt.lock_write()
         try:
-            state = RebaseState1(wt)
-            replayer = WorkingTreeRevisionRewriter(wt, state, merge_type=merge_type)
+            state = RebaseState2(wt)
+            replayer = get_revision_rewriter(wt, state,
+                merge_type=merge_type, in_memory=in_memory, hybrid=hybrid)
             # Abort if there are any conflicts
             if len(wt.conflicts()) != 0:
                 raise BzrCommandError(gettext("There are still conflicts present. "
@@ -290,8 +369,11 @@ class cmd_rebase_continue(Command):
                 raise BzrCommandError(gettext("No rebase to continue"))
             oldrevid = state.read_active_revid()
             if oldrevid is not None:
-                oldrev = wt.branch.repository.get_revision(oldrevid)
-                replayer.commit_rebase(oldrev, replace_map[oldrevid][0])
+                oldrev = replayer.revisions.get_revision(oldrevid)
+                newrevid = replace_map[oldrevid][0]
+                replayer.commit_rebase(oldrev, newrevid)
+                state.write_active_revid(None)
+                state.record_completed(oldrevid, newrevid)
             finish_rebase(state, wt, replace_map, replayer)
         finally:
             wt.unlock()
@@ -310,14 +392,14 @@ class cmd_rebase_todo(Command):
 
     def run(self, directory="."):
         from bzrlib.plugins.rewrite.rebase import (
-            RebaseState1,
+            RebaseState2,
             rebase_todo,
             )
         from bzrlib.workingtree import WorkingTree
         wt = WorkingTree.open_containing(directory)[0]
         wt.lock_read()
         try:
-            state = RebaseState1(wt)
+            state = RebaseState2(wt)
             try:
                 replace_map = state.read_plan()[1]
             except NoSuchFile:
@@ -325,7 +407,7 @@ class cmd_rebase_todo(Command):
             currentrevid = state.read_active_revid()
             if currentrevid is not None:
                 note(gettext("Currently replaying: %s") % currentrevid)
-            for revid in rebase_todo(wt.branch.repository, replace_map):
+            for revid in rebase_todo(wt.branch.repository, replace_map, state):
                 note(gettext("{0} -> {1}").format(revid, replace_map[revid][0]))
         finally:
             wt.unlock()
@@ -348,7 +430,7 @@ class cmd_replay(Command):
         from bzrlib.workingtree import WorkingTree
         from bzrlib import ui
         from bzrlib.plugins.rewrite.rebase import (
-            RebaseState1,
+            RebaseState2,
             regenerate_default_revid,
             WorkingTreeRevisionRewriter,
             )
@@ -376,14 +458,15 @@ class cmd_replay(Command):
         wt = WorkingTree.open(directory)
         wt.lock_write()
         try:
-            state = RebaseState1(wt)
+            state = RebaseState2(wt)
             replayer = WorkingTreeRevisionRewriter(wt, state, merge_type=merge_type)
             pb = ui.ui_factory.nested_progress_bar()
             try:
                 for revid in todo:
                     pb.update(gettext("replaying commits"), todo.index(revid), len(todo))
                     wt.branch.repository.fetch(from_branch.repository, revid)
-                    newrevid = regenerate_default_revid(wt.branch.repository, revid)
+                    newrevid = regenerate_default_revid(replayer.revisions,
+                        revid)
                     replayer(revid, newrevid, [wt.last_revision()])
             finally:
                 pb.finished()
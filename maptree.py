@@ -36,6 +36,225 @@ def map_file_ids(repository, old_parents, new_parents):
     return ret
 
 
+def _intern(file_id):
+    if type(file_id) is str:
+        return intern(file_id)
+    return file_id
+
+
+class FileIdMap(object):
+    """Bidirectional map between old and new file ids.
+
+    Only file ids that differ are stored; file ids that are not in the map
+    map to themselves.
+    """
+
+    def __init__(self, fileid_map=None):
+        """Create a new FileIdMap.
+
+        :param fileid_map: Optional dictionary with old -> new file ids
+        """
+        self._new_ids = {}
+        self._old_ids = {}
+        if fileid_map is not None:
+            for old_file_id, new_file_id in fileid_map.iteritems():
+                self.add(old_file_id, new_file_id)
+
+    def __len__(self):
+        return len(self._new_ids)
+
+    def __repr__(self):
+        return "<%s(%r)>" % (self.__class__.__name__, self._new_ids)
+
+    def iteritems(self):
+        """Iterate over the (old file id, new file id) pairs in the map."""
+        return self._new_ids.iteritems()
+
+    def is_identity(self):
+        """Check whether this map leaves all file ids unchanged."""
+        return not self._new_ids
+
+    def add(self, old_file_id, new_file_id):
+        """Add an entry to the map.
+
+        :param old_file_id: Old file id
+        :param new_file_id: New file id
+        """
+        self.remove(old_file_id)
+        if old_file_id == new_file_id:
+            return
+        old_file_id = _intern(old_file_id)
+        new_file_id = _intern(new_file_id)
+        self._new_ids[old_file_id] = new_file_id
+        # Several old file ids can map to the same new file id; the most
+        # recently added one is returned by old_id()
+        self._old_ids.setdefault(new_file_id, []).append(old_file_id)
+
+    def remove(self, old_file_id):
+        """Remove an entry from the map, if present.
+
+        :param old_file_id: Old file id
+        """
+        try:
+            new_file_id = self._new_ids.pop(old_file_id)
+        except KeyError:
+            return
+        old_file_ids = self._old_ids[new_file_id]
+        old_file_ids.remove(old_file_id)
+        if not old_file_ids:
+            del self._old_ids[new_file_id]
+
+    def update(self, other):
+        """Add all entries from another map.
+
+        :param other: Other FileIdMap
+        """
+        for old_file_id, new_file_id in other.iteritems():
+            self.add(old_file_id, new_file_id)
+
+    def new_id(self, file_id):
+        """Look up the new file id of a file.
+
+        :param file_id: Old file id
+        :return: New file id
+        """
+        return self._new_ids.get(file_id, file_id)
+
+    def old_id(self, file_id):
+        """Look up the original file id of a file.
+
+        :param file_id: New file id
+        :return: Old file id if mapped, otherwise new file id
+        """
+        try:
+            return self._old_ids[file_id][-1]
+        except KeyError:
+            return file_id
+
+
+def _map_tree_file_ids(oldtree, newtree):
+    """Map the file ids of two trees by path.
+
+    :param oldtree: Old tree
+    :param newtree: New tree
+    :return: `FileIdMap`
+    """
+    ret = FileIdMap()
+    for path, ie in oldtree.iter_entries_by_dir():
+        file_id = newtree.path2id(path)
+        if file_id is not None:
+            ret.add(ie.file_id, file_id)
+    return ret
+
+
+def inventory_delta(oldtree, newtree):
+    """Obtain the inventory delta between two trees, if it is cheaply
+    available.
+
+    :return: Inventory delta, or None if it is not available
+    """
+    old_inv = getattr(oldtree, "root_inventory", None)
+    new_inv = getattr(newtree, "root_inventory", None)
+    if old_inv is None or new_inv is None:
+        return None
+    return new_inv._make_delta(old_inv)
+
+
+class FileIdMapper(object):
+    """Stateful equivalent of `map_file_ids`.
+
+    The file id map for the first set of parents is determined by walking
+    the parent trees. Maps for subsequent sets of parents are derived from
+    the previous map and the inventory deltas between the previous and the
+    new parent trees, falling back to walking the trees when no delta is
+    available or a directory was renamed.
+
+    The returned maps may be updated in place by the next call.
+    """
+
+    def __init__(self, repository):
+        """Create a new file id mapper.
+
+        :param repository: Repository or `RevisionTreeCache` to retrieve
+            trees from
+        """
+        self.repository = repository
+        self._pairs = []
+
+    def _update_map(self, fileid_map, oldtree, newtree, prev_oldtree,
+                    prev_newtree):
+        """Update a file id map for a new pair of trees.
+
+        :return: Updated map, or None if the map could not be updated
+        """
+        old_delta = inventory_delta(prev_oldtree, oldtree)
+        new_delta = inventory_delta(prev_newtree, newtree)
+        if old_delta is None or new_delta is None:
+            return None
+        paths = set()
+        old_ids = set()
+        for delta in (old_delta, new_delta):
+            for (old_path, new_path, file_id, ie) in delta:
+                if (old_path is not None and new_path is not None and
+                    old_path != new_path and ie.kind == 'directory'):
+                    # Renaming a directory changes the paths of all its
+                    # children, which are not part of the delta.
+                    return None
+                if old_path is not None:
+                    paths.add(old_path)
+                if new_path is not None:
+                    paths.add(new_path)
+        for (old_path, new_path, file_id, ie) in old_delta:
+            old_ids.add(file_id)
+        for path in paths:
+            file_id = oldtree.path2id(path)
+            if file_id is not None:
+                old_ids.add(file_id)
+        for file_id in old_ids:
+            fileid_map.remove(file_id)
+            if not oldtree.has_id(file_id):
+                continue
+            new_file_id = newtree.path2id(oldtree.id2path(file_id))
+            if new_file_id is not None:
+                fileid_map.add(file_id, new_file_id)
+        return fileid_map
+
+    def __call__(self, old_parents, new_parents):
+        """Determine the equivalent file ids in two sets of parents.
+
+        :param old_parents: List of revision ids of old parents
+        :param new_parents: List of revision ids of new parents
+        :return: `FileIdMap`
+        """
+        assert len(old_parents) == len(new_parents)
+        pairs = []
+        for i, (oldp, newp) in enumerate(zip(old_parents, new_parents)):
+            oldtree = self.repository.revision_tree(oldp)
+            newtree = self.repository.revision_tree(newp)
+            fileid_map = None
+            if i < len(self._pairs):
+                (prev_oldtree, prev_newtree, prev_map) = self._pairs[i]
+                fileid_map = self._update_map(prev_map, oldtree, newtree,
+                    prev_oldtree, prev_newtree)
+            if fileid_map is None:
+                fileid_map = _map_tree_file_ids(oldtree, newtree)
+            pairs.append((oldtree, newtree, fileid_map))
+        self._pairs = pairs
+        if len(pairs) == 1:
+            return pairs[0][2]
+        # Like map_file_ids, later pairs of parents override the mappings of
+        # earlier ones, including the file ids they map to themselves.
+        ret = FileIdMap()
+        for (oldtree, newtree, fileid_map) in pairs:
+            for (old_file_id, new_file_id) in list(ret.iteritems()):
+                if (oldtree.has_id(old_file_id) and
+                    newtree.path2id(oldtree.id2path(old_file_id)) ==
+                        old_file_id):
+                    ret.remove(old_file_id)
+            ret.update(fileid_map)
+        return ret
+
+
 class MapTree(object):
     """Wrapper around a tree that translates file ids.
     """
@@ -44,21 +263,24 @@ class MapTree(object):
         """Create a new MapTree.
 
         :param oldtree: Old tree to map to.
-        :param fileid_map: Map with old -> new file ids.
+        :param fileid_map: `FileIdMap` or dictionary with old -> new file ids.
         """
         self.oldtree = oldtree
+        if not isinstance(fileid_map, FileIdMap):
+            fileid_map = FileIdMap(fileid_map)
         self.map = fileid_map
 
+    def is_identity(self):
+        """Check whether this tree leaves all file ids unchanged."""
+        return self.map.is_identity()
+
     def old_id(self, file_id):
         """Look up the original file id of a file.
 
         :param file_id: New file id
         :return: Old file id if mapped, otherwise new file id
         """
-        for x in self.map:
-            if self.map[x] == file_id:
-                return x
-        return file_id
+        return self.map.old_id(file_id)
 
     def new_id(self, file_id):
         """Look up the new file id of a file.
@@ -66,10 +288,7 @@ class MapTree(object):
         :param file_id: Old file id
         :return: New file id
         """
-        try:
-            return self.map[file_id]
-        except KeyError:
-            return file_id
+        return self.map.new_id(file_id)
 
     def get_file_sha1(self, file_id, path=None):
         "See Tree.get_file_sha1()."""
@@ -107,12 +326,21 @@ class MapTree(object):
     def map_ie(self, ie):
         """Fix the references to old file ids in an inventory entry.
 
+        The entry is only copied if any of its file ids change, so the
+        returned entry should not be modified.
+
         :param ie: Inventory entry to map
         :return: New inventory entry
         """
+        if self.map.is_identity():
+            return ie
+        file_id = self.new_id(ie.file_id)
+        parent_id = self.new_id(ie.parent_id)
+        if file_id == ie.file_id and parent_id == ie.parent_id:
+            return ie
         new_ie = ie.copy()
-        new_ie.file_id = self.new_id(new_ie.file_id)
-        new_ie.parent_id = self.new_id(new_ie.parent_id)
+        new_ie.file_id = file_id
+        new_ie.parent_id = parent_id
         return new_ie
 
     def iter_entries_by_dir(self):
@@ -18,35 +18,69 @@
 
 from __future__ import absolute_import
 
+from bisect import bisect_right
 import os
+import sys
 
 from bzrlib import (
+    commit as _mod_commit,
     config as _mod_config,
+    inventory as _mod_inventory,
     osutils,
     )
 from bzrlib.errors import (
     BzrError,
+    InconsistentDelta,
     NoSuchFile,
     UnknownFormatError,
     NoCommonAncestor,
+    RevisionNotPresent,
     UnrelatedBranches,
     )
 from bzrlib.generate_ids import gen_revision_id
 from bzrlib.graph import FrozenHeadsCache
-from bzrlib.merge import Merger
-from bzrlib.revision import NULL_REVISION
-from bzrlib.trace import mutter
+from bzrlib.merge import (
+    Merge3Merger,
+    Merger,
+    )
+from bzrlib.revision import (
+    NULL_REVISION,
+    Revision,
+    )
+from bzrlib.trace import (
+    mutter,
+    note,
+    )
 from bzrlib.tsort import topo_sort
+from bzrlib.versionedfile import ChunkedContentFactory
 import bzrlib.ui as ui
 
+from bzrlib.plugins.rewrite import gettext
+from bzrlib.plugins.rewrite.cache import (
+    RevisionCache,
+    RevisionPresenceCache,
+    RevisionTreeCache,
+    )
 from bzrlib.plugins.rewrite.maptree import (
+    FileIdMapper,
     MapTree,
-    map_file_ids,
+    inventory_delta,
     )
+from bzrlib.plugins.rewrite.revgraph import CompactGraph
 
 REBASE_PLAN_FILENAME = 'rebase-plan'
 REBASE_CURRENT_REVID_FILENAME = 'rebase-current'
+REBASE_JOURNAL_FILENAME = 'rebase-journal'
 REBASE_PLAN_VERSION = 1
+REBASE_PLAN2_VERSION = 2
+REBASE_PLAN2_INDEX_INTERVAL = 64
+# Number of revisions to load trees for at once while replaying
+REBASE_TREE_PREFETCH = 8
+# Default number of replayed revisions between checks of the commits of
+# changed paths
+REBASE_COMMIT_CHECK_INTERVAL = 10
+# Default number of revisions replayed in a single write group
+REBASE_CHECKPOINT_INTERVAL = 1000
 REVPROP_REBASE_OF = 'rebase-of'
 
 class RebaseState(object):
@@ -91,6 +125,21 @@ class RebaseState(object):
         """
         raise NotImplementedError(self.read_active_revid)
 
+    def record_completed(self, oldrevid, newrevid):
+        """Record that a revision has been replayed.
+
+        :param oldrevid: Id of the revision that was replayed
+        :param newrevid: Id of the revision that was created
+        """
+        raise NotImplementedError(self.record_completed)
+
+    def read_completed(self):
+        """Read the revisions that have been replayed so far.
+
+        :return: Dictionary mapping old revision ids to new revision ids
+        """
+        raise NotImplementedError(self.read_completed)
+
 
 class RebaseState1(RebaseState):
 
@@ -142,6 +191,221 @@ class RebaseState1(RebaseState):
         except NoSuchFile:
             return None
 
+    def record_completed(self, oldrevid, newrevid):
+        """See `RebaseState`.
+
+        Format 1 does not keep track of completed revisions.
+        """
+
+    def read_completed(self):
+        """See `RebaseState`."""
+        return {}
+
+
+class JournaledPlanState(object):
+    """Plan and progress of a rewrite, kept on a transport.
+
+    The plan is stored in format 2: it is streamed to and from the
+    transport rather than built up in memory, and carries an index that
+    allows looking up a single entry. Plans written in format 1 can still
+    be read.
+
+    Progress is kept in an append-only journal, which records the revision
+    that is being replayed and every revision that has been replayed.
+    """
+
+    _plan_filename = REBASE_PLAN_FILENAME
+    _journal_filename = REBASE_JOURNAL_FILENAME
+
+    def __init__(self, transport):
+        self.transport = transport
+        self._journal_started = False
+
+    def _read_journal(self):
+        text = self.transport.get_bytes(self._journal_filename)
+        ret = []
+        for line in text.splitlines(True):
+            if not line.endswith("\n"):
+                # Incomplete record, written while being interrupted
+                break
+            ret.append(line.rstrip("\n").split(" "))
+        return ret
+
+    def _append_journal(self, *fields):
+        if not self._journal_started:
+            # Write the journal again before adding to it, which carries
+            # over progress recorded by an older version and drops any
+            # incomplete record
+            self.transport.put_bytes(self._journal_filename,
+                "".join([" ".join(record) + "\n"
+                         for record in self._read_records()]))
+            self._journal_started = True
+        self.transport.append_bytes(self._journal_filename,
+            " ".join(fields) + "\n")
+
+    def _has_unjournaled_progress(self):
+        """Check whether progress may be recorded outside an empty journal.
+
+        :return: boolean
+        """
+        return False
+
+    def _read_unjournaled_records(self):
+        """Read the progress if it is not recorded in the journal.
+
+        :return: List of journal records
+        """
+        return []
+
+    def _read_records(self):
+        """Read the progress, from the journal if there is one.
+
+        :return: List of journal records
+        """
+        try:
+            records = self._read_journal()
+        except NoSuchFile:
+            return self._read_unjournaled_records()
+        if not records and self._has_unjournaled_progress():
+            return self._read_unjournaled_records()
+        return records
+
+    def has_plan(self):
+        """See `RebaseState`."""
+        try:
+            f = self.transport.get(self._plan_filename)
+        except NoSuchFile:
+            return False
+        try:
+            return f.read(1) != ''
+        finally:
+            f.close()
+
+    def read_plan(self):
+        """See `RebaseState`."""
+        f = self.transport.get(self._plan_filename)
+        try:
+            header = f.readline()
+            if header == '':
+                raise NoSuchFile(self._plan_filename)
+            if header == "# Bazaar rebase plan %d\n" % REBASE_PLAN_VERSION:
+                return unmarshall_rebase_plan(header + f.read())
+            return read_rebase_plan_stream(f, header)
+        finally:
+            f.close()
+
+    def read_plan_entry(self, oldrevid):
+        """Look up a single entry in the rebase plan.
+
+        :param oldrevid: Revision id of the revision to look up.
+        :return: Tuple with new revision id and new parents.
+        :raise KeyError: If oldrevid is not part of the plan
+        """
+        return lookup_rebase_plan_entry(self.transport, self._plan_filename,
+            oldrevid)
+
+    def _write_plan_file(self, filename, last_rev_info, replace_map):
+        tmpname = filename + ".tmp"
+        f = self.transport.open_write_stream(tmpname)
+        try:
+            write_rebase_plan_stream(f, last_rev_info, replace_map)
+        finally:
+            f.close()
+        self.transport.move(tmpname, filename)
+
+    def write_active_revid(self, revid):
+        """See `RebaseState`."""
+        if revid is None:
+            revid = NULL_REVISION
+        assert type(revid) == str
+        self._append_journal("replaying", revid)
+
+    def read_active_revid(self):
+        """See `RebaseState`."""
+        revid = None
+        for record in self._read_records():
+            if record[0] == "replaying" and record[1] != NULL_REVISION:
+                revid = record[1]
+            elif record[0] == "replaying":
+                revid = None
+        return revid
+
+    def record_completed(self, oldrevid, newrevid):
+        """See `RebaseState`."""
+        self._append_journal("done", oldrevid, newrevid)
+
+    def read_completed(self):
+        """See `RebaseState`."""
+        ret = {}
+        for record in self._read_records():
+            if record[0] == "done":
+                ret[record[1]] = record[2]
+        return ret
+
+
+class RebaseState2(JournaledPlanState, RebaseState):
+    """Rebase state that stores the plan in format 2.
+
+    See `JournaledPlanState` for the formats of the plan and journal.
+    """
+
+    def __init__(self, wt):
+        super(RebaseState2, self).__init__(wt._transport)
+        self.wt = wt
+
+    def _has_unjournaled_progress(self):
+        # A rebase started by an older version may have left the empty
+        # journal of an earlier rebase behind
+        return self._has_plan_format1()
+
+    def _has_plan_format1(self):
+        try:
+            f = self.transport.get(self._plan_filename)
+        except NoSuchFile:
+            return False
+        try:
+            return f.readline() == (
+                "# Bazaar rebase plan %d\n" % REBASE_PLAN_VERSION)
+        finally:
+            f.close()
+
+    def _read_unjournaled_records(self):
+        # Rebase was started by an older version, which did not record the
+        # revisions it replayed; those the branch contains have been.
+        records = []
+        if self._has_plan_format1():
+            replace_map = self.read_plan()[1]
+            repository = self.wt.branch.repository
+            repository.lock_read()
+            try:
+                present = repository.has_revisions([newrevid
+                    for (newrevid, newparents) in replace_map.itervalues()])
+                done = find_ancestors_among(repository.get_graph(),
+                    self.wt.branch.last_revision(), present)
+            finally:
+                repository.unlock()
+            for oldrevid in sorted(replace_map):
+                if replace_map[oldrevid][0] in done:
+                    records.append(["done", oldrevid, replace_map[oldrevid][0]])
+        active_revid = RebaseState1(self.wt).read_active_revid()
+        if active_revid is not None:
+            records.append(["replaying", active_revid])
+        return records
+
+    def write_plan(self, replace_map):
+        """See `RebaseState`."""
+        self.wt.update_feature_flags({"rebase-v2": "write-required"})
+        # Clear the journal first, so it is never combined with a new plan
+        self.transport.put_bytes(self._journal_filename, '')
+        self._write_plan_file(self._plan_filename,
+            self.wt.branch.last_revision_info(), replace_map)
+
+    def remove_plan(self):
+        """See `RebaseState`."""
+        self.wt.update_feature_flags({"rebase-v1": None, "rebase-v2": None})
+        self.transport.put_bytes(self._plan_filename, '')
+        self.transport.put_bytes(self._journal_filename, '')
+
 
 def marshall_rebase_plan(last_rev_info, replace_map):
     """Marshall a rebase plan.
@@ -150,13 +414,12 @@ def marshall_rebase_plan(last_rev_info, replace_map):
     :param replace_map: Replace map (old revid -> (new revid, new parents))
     :return: string
     """
-    ret = "# Bazaar rebase plan %d\n" % REBASE_PLAN_VERSION
-    ret += "%d %s\n" % last_rev_info
+    ret = ["# Bazaar rebase plan %d\n" % REBASE_PLAN_VERSION]
+    ret.append("%d %s\n" % last_rev_info)
     for oldrev in replace_map:
         (newrev, newparents) = replace_map[oldrev]
-        ret += "%s %s" % (oldrev, newrev) + \
-            "".join([" %s" % p for p in newparents]) + "\n"
-    return ret
+        ret.append(" ".join((oldrev, newrev) + tuple(newparents)) + "\n")
+    return "".join(ret)
 
 
 def unmarshall_rebase_plan(text):
@@ -182,10 +445,155 @@ def unmarshall_rebase_plan(text):
     return (last_revision_info, replace_map)
 
 
+def _compress_revid(revid, previous):
+    """Encode a revision id relative to the one preceding it.
+
+    :param revid: Revision id to encode
+    :param previous: Previously encoded revision id
+    :return: String with the length of the shared prefix and the suffix
+    """
+    if previous:
+        shared = len(os.path.commonprefix([revid, previous]))
+    else:
+        shared = 0
+    return "%d:%s" % (shared, revid[shared:])
+
+
+def _decompress_revid(text, previous):
+    """Decode a revision id encoded by `_compress_revid`."""
+    (shared, suffix) = text.split(":", 1)
+    return previous[:int(shared)] + suffix
+
+
+def _decode_plan_entry(line, previous):
+    """Decode a single line of a format 2 rebase plan.
+
+    :param line: Line to decode, without trailing newline
+    :param previous: Last revision id decoded before this line
+    :return: Tuple with old revid, new revid, new parents and the last
+        revision id decoded
+    """
+    revids = []
+    for field in line.split(" "):
+        previous = _decompress_revid(field, previous)
+        revids.append(previous)
+    return (revids[0], revids[1], tuple(revids[2:]), previous)
+
+
+def write_rebase_plan_stream(f, last_rev_info, replace_map):
+    """Write a rebase plan in format 2.
+
+    Entries are sorted by old revision id and each revision id only
+    stores the part that differs from the revision id written before it.
+    Every REBASE_PLAN2_INDEX_INTERVAL entries the prefix sharing is restarted
+    and the offset of the entry is recorded in an index at the end of the
+    file, followed by a fixed size trailer pointing at the index.
+
+    :param f: File-like object to write to
+    :param last_rev_info: Last revision info tuple.
+    :param replace_map: Replace map (old revid -> (new revid, new parents))
+    """
+    offset = 0
+    for line in ("# Bazaar rebase plan %d\n" % REBASE_PLAN2_VERSION,
+                 "%d %s\n" % last_rev_info):
+        f.write(line)
+        offset += len(line)
+    index = []
+    previous = None
+    for i, oldrev in enumerate(sorted(replace_map)):
+        if i % REBASE_PLAN2_INDEX_INTERVAL == 0:
+            index.append((oldrev, offset))
+            previous = None
+        (newrev, newparents) = replace_map[oldrev]
+        fields = []
+        for revid in (oldrev, newrev) + tuple(newparents):
+            fields.append(_compress_revid(revid, previous))
+            previous = revid
+        line = " ".join(fields) + "\n"
+        f.write(line)
+        offset += len(line)
+    index_offset = offset
+    f.write("# index\n")
+    for (oldrev, block_offset) in index:
+        f.write("%d %s\n" % (block_offset, oldrev))
+    f.write("# index at %020d\n" % index_offset)
+
+
+def read_rebase_plan_stream(f, header=None):
+    """Read a rebase plan in format 2.
+
+    :param f: File-like object to read from
+    :param header: Header line, if it has already been read from f
+    :return: Tuple with last revision info, replace map.
+    """
+    if header is None:
+        header = f.readline()
+    if header != "# Bazaar rebase plan %d\n" % REBASE_PLAN2_VERSION:
+        raise UnknownFormatError(header.rstrip("\n"))
+    pts = f.readline().rstrip("\n").split(" ", 1)
+    last_revision_info = (int(pts[0]), pts[1])
+    replace_map = {}
+    previous = ""
+    for line in f:
+        if line == "# index\n":
+            break
+        (oldrev, newrev, newparents, previous) = _decode_plan_entry(
+            line.rstrip("\n"), previous)
+        replace_map[oldrev] = (newrev, newparents)
+    return (last_revision_info, replace_map)
+
+
+def lookup_rebase_plan_entry(transport, name, oldrevid):
+    """Look up a single entry in a format 2 rebase plan.
+
+    Only the trailer, the index and the block containing the entry are read.
+
+    :param transport: Transport to read from
+    :param name: Name of the plan file
+    :param oldrevid: Old revision id to look up
+    :return: Tuple with new revision id and new parents.
+    :raise KeyError: If oldrevid is not part of the plan
+    """
+    trailer_size = len("# index at %020d\n" % 0)
+    size = transport.stat(name).st_size
+    if size < trailer_size:
+        raise KeyError(oldrevid)
+    trailer = list(transport.readv(name, [(size - trailer_size,
+        trailer_size)]))[0][1]
+    if not trailer.startswith("# index at "):
+        raise UnknownFormatError(trailer.rstrip("\n"))
+    index_offset = int(trailer[len("# index at "):])
+    index_text = list(transport.readv(name, [(index_offset,
+        size - trailer_size - index_offset)]))[0][1]
+    index_lines = index_text.splitlines()[1:]
+    first_revids = []
+    offsets = []
+    for l in index_lines:
+        (block_offset, revid) = l.split(" ", 1)
+        offsets.append(int(block_offset))
+        first_revids.append(revid)
+    i = bisect_right(first_revids, oldrevid) - 1
+    if i < 0:
+        raise KeyError(oldrevid)
+    if i + 1 < len(offsets):
+        end = offsets[i+1]
+    else:
+        end = index_offset
+    block = list(transport.readv(name, [(offsets[i], end - offsets[i])]))[0][1]
+    previous = ""
+    for line in block.splitlines():
+        (oldrev, newrev, newparents, previous) = _decode_plan_entry(line,
+            previous)
+        if oldrev == oldrevid:
+            return (newrev, newparents)
+    raise KeyError(oldrevid)
+
+
 def regenerate_default_revid(repository, revid):
     """Generate a revision id for the rebase of an existing revision.
 
-    :param repository: Repository in which the revision is present.
+    :param repository: Repository in which the revision is present, or a
+        `RevisionCache`.
     :param revid: Revision id of the revision that is being rebased.
     :return: new revision id."""
     if revid == NULL_REVISION:
@@ -195,7 +603,7 @@ def regenerate_default_revid(repository, revid):
 
 
 def generate_simple_plan(todo_set, start_revid, stop_revid, onto_revid, graph,
-    generate_revid, skip_full_merged=False):
+    generate_revid, skip_full_merged=False, is_difference=False):
     """Create a simple rebase plan that replays history based
     on one revision being replayed on top of another.
 
@@ -210,6 +618,11 @@ def generate_simple_plan(todo_set, start_revid, stop_revid, onto_revid, graph,
     :param generate_revid: Function for generating new revision ids
     :param skip_full_merged: Skip revisions that merge already merged
                              revisions.
+    :param is_difference: Whether todo_set contains exactly the ancestors of
+        stop_revid that are not ancestors of onto_revid, as returned by
+        `Graph.find_difference`. In that case no further graph searches
+        are necessary to find out which parents are already merged into
+        onto_revid.
 
     :return: replace map
     """
@@ -223,20 +636,51 @@ def generate_simple_plan(todo_set, start_revid, stop_revid, onto_revid, graph,
         stop_revid = order[-1]
     if start_revid is None:
         # We need a common base.
-        lca = graph.find_lca(stop_revid, onto_revid)
-        if lca == set([NULL_REVISION]):
+        if is_difference:
+            # The parents of the unique revisions that are not unique
+            # themselves are common ancestors.
+            related = False
+            for parents in parent_map.itervalues():
+                for parent in parents:
+                    if parent not in todo_set and parent != NULL_REVISION:
+                        related = True
+                        break
+                if related:
+                    break
+        else:
+            related = (graph.find_lca(stop_revid, onto_revid) !=
+                       set([NULL_REVISION]))
+        if not related:
             raise UnrelatedBranches()
         start_revid = order[0]
-    todo = order[order.index(start_revid):order.index(stop_revid)+1]
-    heads_cache = FrozenHeadsCache(graph)
-    # XXX: The output replacemap'd parents should get looked up in some manner
-    # by the heads cache? RBC 20080719
+    index = dict([(revid, i) for (i, revid) in enumerate(order)])
+    todo = order[index[start_revid]:index[stop_revid]+1]
+    if is_difference:
+        # Any path between two unique revisions only contains unique
+        # revisions, and merged parents are never kept, so the heads of
+        # the parents can be found without searching the full graph.
+        heads_cache = CompactGraph(parent_map)
+    else:
+        heads_cache = FrozenHeadsCache(graph)
+    # Whether revisions are merged into onto_revid
+    merged = {onto_revid: True}
+    def is_merged(revid):
+        try:
+            return merged[revid]
+        except KeyError:
+            if is_difference:
+                ret = (revid not in todo_set)
+            else:
+                ret = (heads_cache.heads((revid, onto_revid)) ==
+                       set((onto_revid,)))
+            merged[revid] = ret
+            return ret
     for oldrevid in todo:
         oldparents = parent_map[oldrevid]
         assert isinstance(oldparents, tuple), "not tuple: %r" % oldparents
         parents = []
         # Left parent:
-        if heads_cache.heads((oldparents[0], onto_revid)) == set((onto_revid,)):
+        if is_merged(oldparents[0]):
             parents.append(onto_revid)
         elif oldparents[0] in replace_map:
             parents.append(replace_map[oldparents[0]][0])
@@ -245,10 +689,13 @@ def generate_simple_plan(todo_set, start_revid, stop_revid, onto_revid, graph,
             parents.append(oldparents[0])
         # Other parents:
         if len(oldparents) > 1:
-            additional_parents = heads_cache.heads(oldparents[1:])
+            if len(oldparents) > 2:
+                additional_parents = heads_cache.heads(oldparents[1:])
+            else:
+                additional_parents = oldparents[1:]
             for oldparent in oldparents[1:]:
                 if oldparent in additional_parents:
-                    if heads_cache.heads((oldparent, onto_revid)) == set((onto_revid,)):
+                    if is_merged(oldparent):
                         pass
                     elif oldparent in replace_map:
                         newparent = replace_map[oldparent][0]
@@ -268,6 +715,44 @@ def generate_simple_plan(todo_set, start_revid, stop_revid, onto_revid, graph,
     return replace_map
 
 
+def _transpose_descendants(graph, renames, generate_revid):
+    """Rewrite the descendants of a set of renamed revisions.
+
+    :param graph: `CompactGraph` with the part of the ancestry that should be
+        considered
+    :param renames: Dictionary with the renamed revisions, mapping old to new
+        revision ids
+    :param generate_revid: Function for creating new revision ids
+    :return: Replace map
+    """
+    replace_map = {}
+    new_revids = dict(renames)
+    # The new revisions of renamed revisions can be their descendants, but
+    # are already upgraded themselves
+    targets = set(renames.itervalues())
+    for revid in graph.topo_sort(graph.descendants(renames)):
+        if revid in renames or revid in targets:
+            continue
+        oldparents = graph.get_parents(revid)
+        parents = list(oldparents)
+        rewritten = False
+        for i, oldparent in enumerate(oldparents):
+            if oldparent not in new_revids:
+                continue
+            rewritten = True
+            # replace the parent with its new revision
+            if new_revids[oldparent] not in parents:
+                parents[i] = new_revids[oldparent]
+        if not rewritten:
+            continue
+        parents = tuple(parents)
+        newrevid = generate_revid(revid, parents)
+        if newrevid != revid:
+            replace_map[revid] = (newrevid, parents)
+            new_revids[revid] = newrevid
+    return replace_map
+
+
 def generate_transpose_plan(ancestry, renames, graph, generate_revid):
     """Create a rebase plan that replaces a bunch of revisions
     in a revision graph.
@@ -277,110 +762,365 @@ def generate_transpose_plan(ancestry, renames, graph, generate_revid):
     :param graph: Graph object
     :param generate_revid: Function for creating new revision ids
     """
-    replace_map = {}
-    todo = []
-    children = {}
+    return _transpose_descendants(CompactGraph(ancestry), renames,
+        generate_revid)
+
+
+def find_common_ancestor(graph, revids):
+    """Find a revision that is an ancestor of all of a set of revisions.
+
+    The ancestry of the revisions is searched breadth first, as a whole.
+    Every time the searched part of the ancestry has doubled in size, the
+    deepest left hand ancestor found of one of the revisions is checked.
+    Unlike `Graph.find_lca`, this does not search the ancestry of every
+    revision separately, and the ancestor found is not necessarily the
+    lowest.
+
+    :param graph: Graph object
+    :param revids: Revision ids
+    :return: Revision id of a common ancestor, or None if there is none
+    """
+    revids = set(revids)
+    if not revids:
+        return None
     parent_map = {}
-    for r, ps in ancestry:
-        if not children.has_key(r):
-            children[r] = []
-        if ps is None: # Ghost
+    seen = set(revids)
+    pending = set(revids)
+    lefthand = [sorted(revids)[0]]
+    checked = 0
+    while pending:
+        new_parents = graph.get_parent_map(pending)
+        parent_map.update(new_parents)
+        pending = set()
+        for parents in new_parents.itervalues():
+            for parent in parents:
+                if parent not in seen and parent != NULL_REVISION:
+                    seen.add(parent)
+                    pending.add(parent)
+        while parent_map.get(lefthand[-1]):
+            lefthand.append(parent_map[lefthand[-1]][0])
+        if pending and len(parent_map) < checked * 2:
             continue
-        parent_map[r] = ps
-        if not children.has_key(r):
-            children[r] = []
-        for p in ps:
-            if not children.has_key(p):
-                children[p] = []
-            children[p].append(r)
-
-    parent_map.update(graph.get_parent_map(filter(lambda x: not x in parent_map, renames.values())))
-
-    # todo contains a list of revisions that need to
-    # be rewritten
-    for r, v in renames.items():
-        replace_map[r] = (v, parent_map[v])
-        todo.append(r)
-
-    total = len(todo)
-    processed = set()
-    i = 0
-    pb = ui.ui_factory.nested_progress_bar()
-    try:
-        while len(todo) > 0:
-            r = todo.pop()
-            processed.add(r)
-            i += 1
-            pb.update('determining dependencies', i, total)
-            # Add entry for them in replace_map
-            for c in children[r]:
-                if c in renames:
-                    continue
-                if replace_map.has_key(c):
-                    parents = replace_map[c][1]
-                else:
-                    parents = parent_map[c]
-                assert isinstance(parents, tuple), \
-                        "Expected tuple of parents, got: %r" % parents
-                # replace r in parents with replace_map[r][0]
-                if not replace_map[r][0] in parents:
-                    parents = list(parents)
-                    parents[parents.index(r)] = replace_map[r][0]
-                    parents = tuple(parents)
-                replace_map[c] = (generate_revid(c, tuple(parents)),
-                                  tuple(parents))
-                if replace_map[c][0] == c:
-                    del replace_map[c]
-                elif c not in processed:
-                    todo.append(c)
-    finally:
-        pb.finished()
+        checked = len(parent_map)
+        candidate = lefthand[-1]
+        if candidate == NULL_REVISION:
+            candidate = lefthand[-2]
+        descendants = CompactGraph(parent_map).descendants([candidate])
+        if not revids.difference(descendants, [candidate]):
+            return candidate
+    return None
 
-    # Remove items from the map that already exist
-    for revid in renames:
-        if replace_map.has_key(revid):
-            del replace_map[revid]
 
-    return replace_map
+def find_descendants(graph, revids, heads):
+    """Find the descendants of a set of revisions that are ancestors of a
+    set of heads.
+
+    Only the ancestry of the heads that is not also ancestry of a common
+    ancestor of revids is searched. A revision can only descend from one of
+    revids if it is not an ancestor of a common ancestor of them.
 
+    :param graph: Graph object
+    :param revids: Revision ids to find the descendants of
+    :param heads: Revision ids of the heads
+    :return: `CompactGraph` with the part of the ancestry of heads that
+        is not ancestry of a common ancestor of revids
+    """
+    common = find_common_ancestor(graph, revids)
+    descendants = graph._make_breadth_first_searcher(heads)
+    if common is None:
+        list(descendants)
+        candidates = descendants.seen
+    else:
+        stop = graph._make_breadth_first_searcher([common])
+        for revisions in descendants:
+            old_stop = stop.seen.intersection(revisions)
+            descendants.stop_searching_any(old_stop)
+            seen_stop = descendants.find_seen_ancestors(stop.step())
+            descendants.stop_searching_any(seen_stop)
+        candidates = descendants.seen.difference(stop.seen)
+    candidates.discard(NULL_REVISION)
+    return CompactGraph(graph.get_parent_map(candidates))
+
+
+def find_ancestors_among(graph, revision_id, revids):
+    """Find which of a set of revisions are ancestors of a revision.
+
+    Only the ancestry of revision_id that is not also ancestry of a common
+    ancestor of revids is searched, so the search is bounded by the part of
+    the history that revids are in rather than by all of the history.
 
-def rebase_todo(repository, replace_map):
+    :param graph: Graph object
+    :param revision_id: Revision id of which to check the ancestry
+    :param revids: Revision ids to check
+    :return: Set with the revisions in revids that are ancestors of
+        revision_id, or revision_id itself
+    """
+    revids = set(revids)
+    revids.discard(NULL_REVISION)
+    if not revids or revision_id == NULL_REVISION:
+        return set()
+    common = find_common_ancestor(graph, revids)
+    if common is None:
+        stop = []
+    elif common in revids:
+        stop = [parent for parent in
+                graph.get_parent_map([common]).get(common, ())
+                if parent != NULL_REVISION]
+    else:
+        stop = [common]
+    if stop:
+        ancestry = graph.find_unique_ancestors(revision_id, stop)
+    else:
+        ancestry = set([ancestor for (ancestor, parents) in
+            graph.iter_ancestry([revision_id]) if parents is not None])
+    return revids.intersection(ancestry)
+
+
+def generate_bounded_transpose_plan(heads, renames, graph, generate_revid):
+    """Create a rebase plan that replaces a bunch of revisions in the
+    ancestry of a set of heads.
+
+    Rather than all of the ancestry of heads, only the descendants of the
+    renamed revisions are considered.
+
+    :param heads: Heads of the ancestry to consider
+    :param renames: Renames of revision
+    :param graph: Graph object
+    :param generate_revid: Function for creating new revision ids
+    :return: Replace map
+    """
+    return _transpose_descendants(find_descendants(graph, renames, heads),
+        renames, generate_revid)
+
+
+def rebase_todo(repository, replace_map, state=None):
     """Figure out what revisions still need to be rebased.
 
     :param repository: Repository that contains the revisions
     :param replace_map: Replace map
+    :param state: Optional rebase state with a record of the revisions
+        that have already been replayed
     """
-    for revid, parent_ids in replace_map.items():
+    if state is not None:
+        completed = state.read_completed()
+    else:
+        completed = {}
+    todo = [(revid, parent_ids) for (revid, parent_ids) in replace_map.items()
+            if revid not in completed]
+    presence = RevisionPresenceCache(repository)
+    presence.prefetch([parent_ids[0] for (revid, parent_ids) in todo])
+    for revid, parent_ids in todo:
         assert isinstance(parent_ids, tuple), "replace map parents not tuple"
-        if not repository.has_revision(parent_ids[0]):
+        if not presence.has_revision(parent_ids[0]):
             yield revid
 
 
-def rebase(repository, replace_map, revision_rewriter):
+def rebase(repository, replace_map, revision_rewriter, state=None,
+           presence=None, trees=None, revisions=None):
     """Rebase a working tree according to the specified map.
 
     :param repository: Repository that contains the revisions
     :param replace_map: Dictionary with revisions to (optionally) rewrite
-    :param merge_fn: Function for replaying a revision
+    :param revision_rewriter: Function for replaying a revision. If it has
+        a ``finish`` method, that is called after the last revision has
+        been replayed.
+    :param state: Optional rebase state in which to record progress
+    :param presence: Optional `RevisionPresenceCache` to share with the
+        revision rewriter
+    :param trees: Optional `RevisionTreeCache` used by the revision rewriter,
+        which will be primed with the trees of upcoming revisions
+    :param revisions: Optional `RevisionCache` used by the revision rewriter,
+        which will be primed with the revisions that are replayed
+
+    Revision rewriters that batch their writes can provide an ``uncommitted``
+    set with the new revisions that have not been committed yet, which are
+    then only recorded in the state once they are, and an ``abort`` method
+    which is called if rebasing fails. Revision rewriters can also provide
+    a ``skipped`` method, which is called with the new revision id of
+    revisions that are not replayed because they already exist.
     """
+    if state is not None:
+        completed = state.read_completed()
+    else:
+        completed = {}
+    if presence is None:
+        presence = RevisionPresenceCache(repository)
     # Figure out the dependencies
     graph = repository.get_graph()
-    todo = list(graph.iter_topo_order(replace_map.keys()))
+    parent_map = graph.get_parent_map(
+        [revid for revid in replace_map if revid not in completed])
+    todo = CompactGraph(parent_map).topo_sort()
+    # Check the presence of everything the replays will look at at once
+    lookup = set()
+    for revid in todo:
+        (newrevid, newparents) = replace_map[revid]
+        lookup.add(newrevid)
+        lookup.update(newparents)
+        lookup.update(parent_map[revid])
+    presence.prefetch(lookup)
+    if revisions is not None:
+        revisions.prefetch(todo)
+    uncommitted = getattr(revision_rewriter, "uncommitted", ())
+    # Replayed revisions that have not been recorded in the state yet
+    unrecorded = []
+    def record_committed():
+        for (done_revid, done_newrevid) in unrecorded:
+            if done_newrevid not in uncommitted:
+                state.record_completed(done_revid, done_newrevid)
+        unrecorded[:] = [r for r in unrecorded if r[1] in uncommitted]
     pb = ui.ui_factory.nested_progress_bar()
     try:
         for i, revid in enumerate(todo):
             pb.update('rebase revisions', i, len(todo))
+            if trees is not None and i % REBASE_TREE_PREFETCH == 0:
+                upcoming = todo[i:i+REBASE_TREE_PREFETCH]
+                revids = list(upcoming)
+                for upcoming_revid in upcoming:
+                    revids.extend(parent_map[upcoming_revid][:1])
+                trees.prefetch(presence.get_present_revisions(revids))
             (newrevid, newparents) = replace_map[revid]
             assert isinstance(newparents, tuple), "Expected tuple for %r" % newparents
-            if repository.has_revision(newrevid):
-                # Was already converted, no need to worry about it again
-                continue
-            revision_rewriter(revid, newrevid, newparents)
+            if not presence.has_revision(newrevid):
+                revision_rewriter(revid, newrevid, newparents)
+                presence.add(newrevid)
+            else:
+                # was already converted, no need to worry about it again
+                skipped = getattr(revision_rewriter, "skipped", None)
+                if skipped is not None:
+                    skipped(newrevid)
+            if state is not None:
+                unrecorded.append((revid, newrevid))
+                if newrevid not in uncommitted:
+                    record_committed()
+        finish = getattr(revision_rewriter, "finish", None)
+        if finish is not None:
+            finish()
+        if state is not None:
+            for (done_revid, done_newrevid) in unrecorded:
+                state.record_completed(done_revid, done_newrevid)
+    except Exception:
+        exc_info = sys.exc_info()
+        if state is not None:
+            # The failed replay may have committed revisions that were
+            # replayed before it, e.g. by updating the working tree
+            try:
+                record_committed()
+            except Exception, e:
+                mutter('error recording replayed revisions: %s', e)
+        abort = getattr(revision_rewriter, "abort", None)
+        if abort is not None:
+            try:
+                abort()
+            except Exception, e:
+                mutter('error aborting the revision rewriter: %s', e)
+        raise exc_info[0], exc_info[1], exc_info[2]
     finally:
         pb.finished()
 
 
-def wrap_iter_changes(old_iter_changes, map_tree):
+def inventory_delta_to_changes(delta, basis_inv):
+    """Convert an inventory delta to an iter_changes stream.
+
+    Like iter_changes, entries of which only the last modified revision
+    changed are skipped.
+
+    :param delta: Inventory delta against basis_inv
+    :param basis_inv: Inventory the delta applies to
+    :return: Iterator over iter_changes tuples
+    """
+    for (old_path, new_path, file_id, new_ie) in delta:
+        if old_path is not None:
+            old_ie = basis_inv[file_id]
+            old_values = (old_ie.parent_id, old_ie.name, old_ie.kind,
+                          old_ie.executable)
+        else:
+            old_ie = None
+            old_values = (None, None, None, None)
+        if new_path is not None:
+            new_values = (new_ie.parent_id, new_ie.name, new_ie.kind,
+                          new_ie.executable)
+        else:
+            new_values = (None, None, None, None)
+        kind = (old_values[2], new_values[2])
+        if kind[0] != kind[1]:
+            changed_content = True
+        elif kind[0] == 'file':
+            changed_content = (old_ie.text_size != new_ie.text_size or
+                               old_ie.text_sha1 != new_ie.text_sha1)
+        elif kind[0] == 'symlink':
+            changed_content = (old_ie.symlink_target != new_ie.symlink_target)
+        elif kind[0] == 'tree-reference':
+            changed_content = (
+                old_ie.reference_revision != new_ie.reference_revision)
+        else:
+            changed_content = False
+        if (not changed_content and old_path == new_path and
+            old_values == new_values):
+            continue
+        yield (file_id, (old_path, new_path), changed_content,
+               (old_path is not None, new_path is not None),
+               (old_values[0], new_values[0]), (old_values[1], new_values[1]),
+               kind, (old_values[3], new_values[3]))
+
+
+def check_inventory_delta(basis_inv, delta):
+    """Check that an inventory delta can be applied to an inventory.
+
+    This does the checks that applying the delta does, without creating
+    the new inventory, which for CHK inventories would write to the
+    repository.
+
+    :param basis_inv: Inventory the delta applies to
+    :param delta: Inventory delta
+    :raise InconsistentDelta: If the delta can not be applied
+    """
+    for check in (_mod_inventory._check_delta_unique_ids,
+                  _mod_inventory._check_delta_unique_old_paths,
+                  _mod_inventory._check_delta_unique_new_paths,
+                  _mod_inventory._check_delta_ids_match_entry,
+                  _mod_inventory._check_delta_ids_are_valid,
+                  _mod_inventory._check_delta_new_path_entry_both_or_None):
+        delta = list(check(delta))
+    new_paths = {}
+    for (old_path, new_path, file_id, new_ie) in delta:
+        if old_path is not None:
+            if (not basis_inv.has_id(file_id) or
+                basis_inv.id2path(file_id) != old_path):
+                raise InconsistentDelta(old_path, file_id,
+                    "Entry was at wrong other path")
+        elif basis_inv.has_id(file_id):
+            raise InconsistentDelta(new_path, file_id,
+                "Entry already exists")
+        new_paths[file_id] = new_path
+    for (old_path, new_path, file_id, new_ie) in delta:
+        if old_path is not None and new_path is None:
+            old_ie = basis_inv[file_id]
+            if old_ie.kind == 'directory':
+                for child in old_ie.children.itervalues():
+                    if child.file_id not in new_paths:
+                        raise InconsistentDelta(old_path, file_id,
+                            "Removed directory is not empty")
+        if new_path is None:
+            continue
+        occupant = basis_inv.path2id(new_path)
+        if (occupant is not None and occupant != file_id and
+            new_paths.get(occupant, new_path) == new_path):
+            raise InconsistentDelta(new_path, file_id,
+                "Path already versioned")
+        if new_ie.parent_id is None:
+            continue
+        if new_ie.parent_id in new_paths:
+            parent_path = new_paths[new_ie.parent_id]
+        elif basis_inv.has_id(new_ie.parent_id):
+            parent_path = basis_inv.id2path(new_ie.parent_id)
+        else:
+            parent_path = None
+        if parent_path is None or osutils.dirname(new_path) != parent_path:
+            raise InconsistentDelta(new_path, file_id,
+                "Parent is not present or at the wrong path")
+
+
+def _wrap_iter_changes(old_iter_changes, map_tree):
     for (file_id, path, changed_content, versioned, (old_parent, new_parent), name, kind,
             executable) in old_iter_changes:
         if old_parent is not None:
@@ -391,18 +1131,58 @@ def wrap_iter_changes(old_iter_changes, map_tree):
                 (old_parent, new_parent), name, kind, executable)
 
 
+def wrap_iter_changes(old_iter_changes, map_tree):
+    """Translate the file ids in an iter_changes stream.
+
+    :param old_iter_changes: iter_changes stream with old file ids
+    :param map_tree: `MapTree` to use for translating file ids
+    :return: iter_changes stream with new file ids
+    """
+    if getattr(map_tree, "is_identity", None) is None or map_tree.is_identity():
+        return old_iter_changes
+    return _wrap_iter_changes(old_iter_changes, map_tree)
+
+
 class CommitBuilderRevisionRewriter(object):
     """Revision rewriter that use commit builder.
 
     :ivar repository: Repository in which the revision is present.
     """
 
-    def __init__(self, repository, map_ids=True):
+    def __init__(self, repository, map_ids=True, presence=None, trees=None,
+                 revisions=None, reuse_texts=False, checkpoint_interval=None):
+        """Create a new commit builder revision rewriter.
+
+        :param repository: Repository in which the revisions are present.
+        :param map_ids: Whether to map file ids to those in the new parents.
+        :param presence: Optional `RevisionPresenceCache`.
+        :param trees: Optional `RevisionTreeCache` to retrieve trees from.
+        :param revisions: Optional `RevisionCache` to retrieve revisions from.
+        :param reuse_texts: Whether to copy the stored texts of changed files
+            rather than reading and hashing them again, where possible.
+        :param checkpoint_interval: If set, replay revisions that reuse
+            texts in a shared write group, which is committed after this
+            many revisions. `finish` commits the last write group.
+        """
         self.repository = repository
         self.map_ids = map_ids
+        self.reuse_texts = reuse_texts
+        self.checkpoint_interval = checkpoint_interval
+        self.uncommitted = set()
+        self._in_write_group = False
+        if presence is None:
+            presence = RevisionPresenceCache(repository)
+        self.presence = presence
+        if revisions is None:
+            revisions = RevisionCache(repository, presence)
+        self.revisions = revisions
+        if trees is None:
+            trees = RevisionTreeCache(repository)
+        self.trees = trees
+        self._map_file_ids = FileIdMapper(trees)
 
     def _get_present_revisions(self, revids):
-        return tuple([p for p in revids if self.repository.has_revision(p)])
+        return self.presence.get_present_revisions(revids)
 
     def __call__(self, oldrevid, newrevid, new_parents):
         """Replay a commit by simply commiting the same snapshot with different
@@ -413,20 +1193,33 @@ class CommitBuilderRevisionRewriter(object):
         :param new_parents: Revision ids of the new parent revisions.
         """
         assert isinstance(new_parents, tuple), "CommitBuilderRevisionRewriter: Expected tuple for %r" % new_parents
-        mutter('creating copy %r of %r with new parents %r' %
-                                   (newrevid, oldrevid, new_parents))
-        oldrev = self.repository.get_revision(oldrevid)
-
+        oldrev = self.revisions.get_revision(oldrevid)
         revprops = dict(oldrev.properties)
         revprops[REVPROP_REBASE_OF] = oldrevid
+        return self.replay(oldrev, newrevid, new_parents, oldrev.committer,
+            revprops)
+
+    def replay(self, oldrev, newrevid, new_parents, committer, revprops):
+        """Commit the snapshot of a revision with different parents and
+        metadata.
 
+        :param oldrev: Revision to copy.
+        :param newrevid: Revision id of the revision to create.
+        :param new_parents: Revision ids of the new parent revisions.
+        :param committer: Committer of the new revision.
+        :param revprops: Revision properties of the new revision.
+        :return: Revision id of the new revision.
+        """
+        oldrevid = oldrev.revision_id
+        mutter('creating copy %r of %r with new parents %r' %
+                                   (newrevid, oldrevid, new_parents))
         # Check what new_ie.file_id should be
         # use old and new parent trees to generate new_id map
         nonghost_oldparents = self._get_present_revisions(oldrev.parent_ids)
         nonghost_newparents = self._get_present_revisions(new_parents)
-        oldtree = self.repository.revision_tree(oldrevid)
+        oldtree = self.trees.revision_tree(oldrevid)
         if self.map_ids:
-            fileid_map = map_file_ids(self.repository, nonghost_oldparents,
+            fileid_map = self._map_file_ids(nonghost_oldparents,
                 nonghost_newparents)
             mappedtree = MapTree(oldtree, fileid_map)
         else:
@@ -440,11 +1233,30 @@ class CommitBuilderRevisionRewriter(object):
             new_base = new_parents[0]
         except IndexError:
             new_base = NULL_REVISION
-        old_base_tree = self.repository.revision_tree(old_base)
-        old_iter_changes = oldtree.iter_changes(old_base_tree)
+        old_base_tree = self.trees.revision_tree(old_base)
+        old_iter_changes = None
+        if oldrev.parent_ids and oldrev.parent_ids[0] == old_base:
+            # The changes against the left hand parent can be derived from
+            # the inventory delta
+            delta = inventory_delta(old_base_tree, oldtree)
+            if delta is not None:
+                old_iter_changes = inventory_delta_to_changes(delta,
+                    old_base_tree.root_inventory)
+        if old_iter_changes is None:
+            old_iter_changes = oldtree.iter_changes(old_base_tree)
         iter_changes = wrap_iter_changes(old_iter_changes, mappedtree)
+        if self.reuse_texts and self._can_reuse_texts(nonghost_newparents,
+                new_parents):
+            iter_changes = list(iter_changes)
+            ret = self._replay_reusing_texts(oldrev, newrevid, new_parents,
+                committer, revprops, oldtree, mappedtree, iter_changes)
+            if ret is not None:
+                self.presence.add(ret)
+                return ret
+        # The commit builder uses a write group of its own
+        self.checkpoint()
         builder = self.repository.get_commit_builder(branch=None,
-            parents=new_parents, committer=oldrev.committer,
+            parents=new_parents, committer=committer,
             timestamp=oldrev.timestamp, timezone=oldrev.timezone,
             revprops=revprops, revision_id=newrevid,
             config_stack=_mod_config.GlobalStack())
@@ -453,22 +1265,176 @@ class CommitBuilderRevisionRewriter(object):
                     mappedtree, new_base, iter_changes):
                 pass
             builder.finish_inventory()
-            return builder.commit(oldrev.message)
+            ret = builder.commit(oldrev.message)
         except:
             builder.abort()
             raise
+        self.presence.add(ret)
+        return ret
+
+    def _can_reuse_texts(self, nonghost_newparents, new_parents):
+        """Check whether a revision with the specified new parents can be
+        replayed by copying the stored texts.
+
+        This is only done for revisions with a single present parent in
+        repositories that version the tree root, as it bypasses the per-file
+        graph and root handling of the commit builder.
+        """
+        if len(new_parents) != 1 or len(nonghost_newparents) != 1:
+            return False
+        if not self.repository.supports_rich_root():
+            return False
+        if self.repository._fallback_repositories:
+            return False
+        if (_mod_config.GlobalStack().get('create_signatures') ==
+                _mod_config.SIGN_ALWAYS):
+            return False
+        return True
+
+    def _replay_reusing_texts(self, oldrev, newrevid, new_parents, committer,
+                              revprops, oldtree, mappedtree, changes):
+        """Replay a revision by adding its inventory delta directly,
+        copying the stored texts of changed files under their new keys.
+
+        The known SHA1s of the texts are passed along, so the storage layer
+        does not have to hash them again.
+
+        :return: Revision id of the new revision, or None if the changes can
+            not be replayed this way
+        """
+        if not isinstance(mappedtree, MapTree):
+            mappedtree = MapTree(mappedtree, {})
+        new_base = new_parents[0]
+        basis_inv = self.trees.get_inventory(new_base)
+        old_inv = oldtree.root_inventory
+        inv_delta = []
+        # old text key -> (new text key, parent keys, sha1)
+        copied_texts = {}
+        empty_texts = []
+        for change in changes:
+            file_id = change[0]
+            if '' in change[1]:
+                # Root changes are left to the commit builder
+                return None
+            if basis_inv.has_id(file_id):
+                basis_path = basis_inv.id2path(file_id)
+                parent_keys = ((file_id, basis_inv[file_id].revision),)
+            else:
+                basis_path = None
+                parent_keys = ()
+            new_path = change[1][1]
+            if new_path is None:
+                if basis_path is not None:
+                    inv_delta.append((basis_path, None, file_id, None))
+                continue
+            old_ie = old_inv[mappedtree.old_id(file_id)]
+            ie = mappedtree.map_ie(old_ie).copy()
+            ie.revision = newrevid
+            if ie.kind == 'file':
+                copied_texts[(old_ie.file_id, old_ie.revision)] = (
+                    (file_id, newrevid), parent_keys, ie.text_sha1)
+            elif ie.kind in ('directory', 'symlink'):
+                empty_texts.append(ChunkedContentFactory((file_id, newrevid),
+                    parent_keys, osutils.sha_string(''), []))
+            else:
+                return None
+            inv_delta.append((basis_path, new_path, file_id, ie))
+        texts = self.repository.texts
+        # Check everything that could make the replay fail before the write
+        # group is touched, as aborting it would also discard the revisions
+        # replayed in it before.
+        if len(texts.get_parent_map(copied_texts.keys())) != len(copied_texts):
+            mutter('texts for %r missing, not reusing them', newrevid)
+            return None
+        try:
+            check_inventory_delta(basis_inv, inv_delta)
+        except InconsistentDelta:
+            mutter('inconsistent delta for %r, not reusing texts', newrevid)
+            return None
+        batched = (self.checkpoint_interval is not None)
+        def copy_texts():
+            for record in texts.get_record_stream(copied_texts.keys(),
+                    'unordered', True):
+                if record.storage_kind == 'absent':
+                    raise RevisionNotPresent(record.key, texts)
+                (key, parent_keys, sha1) = copied_texts[record.key]
+                yield ChunkedContentFactory(key, parent_keys, sha1,
+                    record.get_bytes_as('chunked'))
+            for record in empty_texts:
+                yield record
+        if not self._in_write_group:
+            self.repository.start_write_group()
+            self._in_write_group = True
+        try:
+            texts.insert_record_stream(copy_texts())
+            (validator, new_inv) = self.repository.add_inventory_by_delta(
+                new_base, inv_delta, newrevid, new_parents,
+                basis_inv=basis_inv)
+            rev = Revision(timestamp=oldrev.timestamp,
+                timezone=oldrev.timezone, committer=committer,
+                message=oldrev.message, inventory_sha1=validator,
+                revision_id=newrevid, properties=revprops)
+            rev.parent_ids = list(new_parents)
+            self.repository.add_revision(newrevid, rev, inv=new_inv)
+        except:
+            self.abort()
+            raise
+        self.uncommitted.add(newrevid)
+        if not batched or len(self.uncommitted) >= self.checkpoint_interval:
+            self.checkpoint()
+        return newrevid
+
+    def checkpoint(self):
+        """Commit the write group with the revisions replayed so far, if
+        there is one."""
+        if not self._in_write_group:
+            return
+        self.repository.commit_write_group()
+        self._in_write_group = False
+        self.uncommitted.clear()
+
+    def abort(self):
+        """Abort the write group with the revisions replayed since the last
+        checkpoint, if there is one."""
+        if not self._in_write_group:
+            return
+        self._in_write_group = False
+        self.uncommitted.clear()
+        self.repository.abort_write_group()
+
+    def finish(self):
+        """Commit the revisions replayed since the last checkpoint."""
+        self.checkpoint()
 
 
 class WorkingTreeRevisionRewriter(object):
 
-    def __init__(self, wt, state, merge_type=None):
+    def __init__(self, wt, state, merge_type=None, trees=None,
+                 revisions=None, check_interval=None, paranoid=False):
         """
         :param wt: Working tree in which to do the replays.
+        :param trees: Optional `RevisionTreeCache` to retrieve trees from.
+        :param revisions: Optional `RevisionCache` to retrieve revisions from.
+        :param check_interval: If set, check every check_interval'th commit
+            of only the changed paths against a commit of the full tree.
+        :param paranoid: Whether to check the full working tree for changes
+            before each replay.
         """
         self.wt = wt
+        self.check_interval = check_interval
+        self.paranoid = paranoid
+        self._restricted_commits = 0
+        self._committed_revid = None
+        self._skipped_revid = None
         self.graph = self.wt.branch.repository.get_graph()
         self.state = state
         self.merge_type = merge_type
+        if trees is None:
+            trees = RevisionTreeCache(self.wt.branch.repository)
+        self.trees = trees
+        if revisions is None:
+            revisions = RevisionCache(self.wt.branch.repository)
+        self.revisions = revisions
 
     def __call__(self, oldrevid, newrevid, newparents):
         """Replay a commit in a working tree, with a different base.
@@ -477,34 +1443,134 @@ class WorkingTreeRevisionRewriter(object):
         :param newrevid: New revision id
         :param newparents: New parent revision ids
         """
-        repository = self.wt.branch.repository
         if self.merge_type is None:
-            from bzrlib.merge import Merge3Merger
             merge_type = Merge3Merger
         else:
             merge_type = self.merge_type
-        oldrev = self.wt.branch.repository.get_revision(oldrevid)
+        self._skipped_revid = None
+        oldrev = self.revisions.get_revision(oldrevid)
         # Make sure there are no conflicts or pending merges/changes
         # in the working tree
-        complete_revert(self.wt, [newparents[0]])
-        assert not self.wt.changes_from(self.wt.basis_tree()).has_changed(), "Changes in rev"
+        self.revert([newparents[0]])
+        if self.paranoid:
+            assert not self.wt.changes_from(self.wt.basis_tree()).has_changed(), "Changes in rev"
 
-        oldtree = repository.revision_tree(oldrevid)
         self.state.write_active_revid(oldrevid)
-        merger = Merger(self.wt.branch, this_tree=self.wt)
-        merger.set_other_revision(oldrevid, self.wt.branch)
         base_revid = self.determine_base(oldrevid, oldrev.parent_ids,
                                            newrevid, newparents)
+        merger = Merger(self.wt.branch, this_tree=self.wt)
+        merger.cache_trees_with_revision_ids([
+            self.trees.revision_tree(oldrevid),
+            self.trees.revision_tree(base_revid)])
+        merger.set_other_revision(oldrevid, self.wt.branch)
         mutter('replaying %r as %r with base %r and new parents %r' %
                (oldrevid, newrevid, base_revid, newparents))
         merger.set_base_revision(base_revid, self.wt.branch)
         merger.merge_type = merge_type
+        merge_paths = self.get_merge_paths(base_revid, oldrevid)
+        merger.set_interesting_files(merge_paths)
         merger.do_merge()
         for newparent in newparents[1:]:
             self.wt.add_pending_merge(newparent)
-        self.commit_rebase(oldrev, newrevid)
+        if merge_paths is not None and len(newparents) == 1:
+            # Partial commits are not possible with pending merges
+            specific_files = self.get_commit_paths(merge_paths, base_revid,
+                oldrevid)
+        else:
+            specific_files = None
+        self.commit_rebase(oldrev, newrevid, specific_files)
         self.state.write_active_revid(None)
 
+    def revert(self, newparents):
+        """Revert the working tree to new parents.
+
+        If the working tree is known to be unchanged since the last commit
+        by this rewriter, only the paths that differ from the new left hand
+        parent are updated.
+
+        :param newparents: New parents of the working tree
+        """
+        if (self._committed_revid is not None and
+            self.wt.last_revision() == self._committed_revid):
+            incremental_revert(self.wt, newparents, self.trees, self.paranoid)
+        else:
+            complete_revert(self.wt, newparents, self.trees, self.paranoid)
+        self._committed_revid = None
+
+    def skipped(self, newrevid):
+        """Note that a revision was not replayed because it already exists.
+
+        The working tree might not reflect it yet, for example if an
+        in-memory rebase was interrupted. If no other revisions are replayed
+        after it, `finish` updates the working tree to it.
+
+        :param newrevid: Revision id of the existing new revision
+        """
+        self._skipped_revid = newrevid
+
+    def _is_newer(self, revid):
+        """Check whether a revision descends from the working tree revision.
+
+        :param revid: Revision id to check
+        :return: boolean
+        """
+        last_revid = self.wt.last_revision()
+        if revid == last_revid:
+            return False
+        # Use a new graph, as revisions may have been added since self.graph
+        # was created
+        graph = self.wt.branch.repository.get_graph()
+        return graph.is_ancestor(last_revid, revid)
+
+    def finish(self):
+        """Update the working tree to the last revision, if that was
+        skipped and descends from the working tree revision."""
+        if (self._skipped_revid is not None and
+            self._is_newer(self._skipped_revid)):
+            self.revert([self._skipped_revid])
+        self._skipped_revid = None
+
+    def get_merge_paths(self, base_revid, oldrevid):
+        """Determine the paths the merge of a revision can be limited to.
+
+        :param base_revid: Revision id of the merge base.
+        :param oldrevid: Revision id of the revision that is being merged.
+        :return: List of paths, or None if the merge can not be limited
+        """
+        return restricted_merge_paths(self.trees.revision_tree(base_revid),
+            self.trees.revision_tree(oldrevid))
+
+    def get_commit_paths(self, merge_paths, base_revid, oldrevid):
+        """Determine the paths in the working tree changed by a merge.
+
+        :param merge_paths: Paths the merge was limited to.
+        :param base_revid: Revision id of the merge base.
+        :param oldrevid: Revision id of the revision that was merged.
+        :return: List of paths in the working tree or its basis tree
+        """
+        file_ids = set()
+        for revid in (base_revid, oldrevid):
+            tree = self.trees.revision_tree(revid)
+            for path in merge_paths:
+                file_id = tree.path2id(path)
+                if file_id is not None:
+                    file_ids.add(file_id)
+        self.wt.lock_read()
+        try:
+            basis_tree = self.wt.basis_tree()
+            basis_tree.lock_read()
+            try:
+                paths = set()
+                for file_id in file_ids:
+                    for tree in (self.wt, basis_tree):
+                        if tree.has_id(file_id):
+                            paths.add(tree.id2path(file_id))
+            finally:
+                basis_tree.unlock()
+        finally:
+            self.wt.unlock()
+        return sorted(paths)
+
     def determine_base(self, oldrevid, oldparents, newrevid, newparents):
         """Determine the base for replaying a revision using merge.
 
@@ -536,12 +1602,12 @@ class WorkingTreeRevisionRewriter(object):
         except NoCommonAncestor:
             return oldparents[0]
 
-    def commit_rebase(self, oldrev, newrevid):
-        """Commit a rebase.
+    def get_commit_metadata(self, oldrev):
+        """Determine the metadata for the rebased version of a revision.
 
-        :param oldrev: Revision info of new revision to commit.
-        :param newrevid: New revision id."""
-        assert oldrev.revision_id != newrevid, "Invalid revid %r" % newrevid
+        :param oldrev: Revision that is being rebased.
+        :return: Tuple with committer, authors and revision properties.
+        """
         revprops = dict(oldrev.properties)
         revprops[REVPROP_REBASE_OF] = oldrev.revision_id
         committer = self.wt.branch.get_config().username()
@@ -558,31 +1624,420 @@ class WorkingTreeRevisionRewriter(object):
             del revprops['author']
         if 'authors' in revprops:
             del revprops['authors']
+        return (committer, authors, revprops)
+
+    def commit_rebase(self, oldrev, newrevid, specific_files=None):
+        """Commit a rebase.
+
+        :param oldrev: Revision info of new revision to commit.
+        :param newrevid: New revision id.
+        :param specific_files: Optional list of the paths that were changed;
+            other paths are not checked for changes."""
+        assert oldrev.revision_id != newrevid, "Invalid revid %r" % newrevid
+        (committer, authors, revprops) = self.get_commit_metadata(oldrev)
         self.wt.commit(message=oldrev.message, timestamp=oldrev.timestamp,
                   timezone=oldrev.timezone, revprops=revprops, rev_id=newrevid,
-                  committer=committer, authors=authors)
+                  committer=committer, authors=authors,
+                  specific_files=specific_files)
+        self._committed_revid = newrevid
+        if specific_files is not None and self.check_interval:
+            self._restricted_commits += 1
+            if self._restricted_commits % self.check_interval == 0:
+                self.check_commit(newrevid)
+
+    def check_commit(self, newrevid):
+        """Check that a commit of the changed paths recorded all changes.
+
+        :param newrevid: Revision id of the commit to check.
+        :raise RestrictedCommitMismatch: If the working tree has changes
+            that were not committed
+        """
+        paths = []
+        self.wt.lock_read()
+        try:
+            for change in self.wt.iter_changes(self.wt.basis_tree()):
+                (old_path, new_path) = change[1]
+                paths.append(new_path or old_path)
+        finally:
+            self.wt.unlock()
+        if paths:
+            raise RestrictedCommitMismatch(newrevid, paths)
+
+
+class InMemoryRevisionRewriter(WorkingTreeRevisionRewriter):
+    """Revision rewriter that merges and commits revisions in memory.
+
+    Each revision is merged into a preview of its new left hand parent and
+    committed from there, without touching the working tree. The working
+    tree is only updated by `finish`, or when a merge conflicts and the
+    conflict has to be resolved by the user.
+
+    :ivar uncommitted: Set with the revisions that have been replayed in
+        memory but that the branch and working tree do not reflect yet.
+    """
+
+    def __init__(self, wt, state, merge_type=None, trees=None,
+                 revisions=None, check_interval=None, paranoid=False):
+        super(InMemoryRevisionRewriter, self).__init__(wt, state,
+            merge_type=merge_type, trees=trees, revisions=revisions,
+            check_interval=check_interval, paranoid=paranoid)
+        self._last_revid = None
+        self.uncommitted = set()
+
+    def __call__(self, oldrevid, newrevid, newparents):
+        """Replay a commit in memory, with a different base.
+
+        :param oldrevid: Old revision id
+        :param newrevid: New revision id
+        :param newparents: New parent revision ids
+        """
+        if self.merge_type is None:
+            merge_type = Merge3Merger
+        else:
+            merge_type = self.merge_type
+        if not issubclass(merge_type, Merge3Merger):
+            # Only merge types derived from Merge3Merger can create previews
+            self._last_revid = None
+            return super(InMemoryRevisionRewriter, self).__call__(oldrevid,
+                newrevid, newparents)
+        oldrev = self.revisions.get_revision(oldrevid)
+        base_revid = self.determine_base(oldrevid, oldrev.parent_ids,
+                                           newrevid, newparents)
+        mutter('replaying %r as %r in memory with base %r and new parents %r' %
+               (oldrevid, newrevid, base_revid, newparents))
+        merger = Merger(self.wt.branch,
+            this_tree=self.trees.revision_tree(newparents[0]),
+            other_tree=self.trees.revision_tree(oldrevid),
+            base_tree=self.trees.revision_tree(base_revid),
+            revision_graph=self.graph)
+        merger.this_basis = newparents[0]
+        merger.other_rev_id = oldrevid
+        merger.other_basis = oldrevid
+        merger.base_rev_id = base_revid
+        merger.merge_type = merge_type
+        merger.set_interesting_files(self.get_merge_paths(base_revid,
+            oldrevid))
+        merge = merger.make_merger()
+        tt = merge.make_preview_transform()
+        try:
+            if len(merge.cooked_conflicts) == 0:
+                self._commit_preview(tt, oldrev, newrevid, newparents)
+                self._last_revid = newrevid
+                self.uncommitted.add(newrevid)
+                return
+        finally:
+            tt.finalize()
+        # Let the user resolve the conflicts in the working tree
+        self._last_revid = None
+        super(InMemoryRevisionRewriter, self).__call__(oldrevid, newrevid,
+            newparents)
+
+    def _commit_preview(self, tt, oldrev, newrevid, newparents):
+        assert oldrev.revision_id != newrevid, "Invalid revid %r" % newrevid
+        (committer, authors, revprops) = self.get_commit_metadata(oldrev)
+        revprops = _mod_commit.Commit.update_revprops(revprops,
+            self.wt.branch, authors)
+        builder = self.wt.branch.repository.get_commit_builder(
+            branch=self.wt.branch,
+            parents=[p for p in newparents if p != NULL_REVISION],
+            config_stack=self.wt.branch.get_config_stack(),
+            committer=committer, timestamp=oldrev.timestamp,
+            timezone=oldrev.timezone, revprops=revprops,
+            revision_id=newrevid)
+        try:
+            list(builder.record_iter_changes(tt.get_preview_tree(),
+                newparents[0], tt.iter_changes()))
+            builder.finish_inventory()
+            builder.commit(oldrev.message)
+        except:
+            builder.abort()
+            raise
+
+    def revert(self, newparents):
+        """Revert the working tree to new parents.
+
+        The branch and working tree are synced with the revisions replayed
+        in memory so far, so none of them are uncommitted any more.
+
+        :param newparents: New parents of the working tree
+        """
+        super(InMemoryRevisionRewriter, self).revert(newparents)
+        self.uncommitted.clear()
+
+    def skipped(self, newrevid):
+        """Note that a revision was not replayed because it already exists.
+
+        This happens when a rebase is continued after it was interrupted
+        before the working tree was updated to the revisions replayed in
+        memory, so the revision is treated like one replayed in memory.
+
+        :param newrevid: Revision id of the existing new revision
+        """
+        self._last_revid = newrevid
+        self.uncommitted.add(newrevid)
+
+    def finish(self):
+        """Update the working tree to the last revision replayed in memory."""
+        if self._last_revid is None:
+            return
+        if self._is_newer(self._last_revid):
+            self.revert([self._last_revid])
+        else:
+            # Skipped revisions the working tree already contains
+            self.uncommitted.clear()
+        self._last_revid = None
+
+
+class HybridRevisionRewriter(InMemoryRevisionRewriter):
+    """Revision rewriter that copies snapshots where that is safe.
+
+    Revisions that only touch paths that did not change between their old
+    and their new base are replayed by committing their snapshot with the
+    new parents, in memory. Other revisions are merged in the working tree.
+
+    :ivar snapshot_count: Number of revisions replayed by copying their
+        snapshot.
+    :ivar merge_count: Number of revisions replayed by merging.
+    """
+
+    def __init__(self, wt, state, merge_type=None, trees=None,
+                 revisions=None, check_interval=None, paranoid=False):
+        super(HybridRevisionRewriter, self).__init__(wt, state,
+            merge_type=merge_type, trees=trees, revisions=revisions,
+            check_interval=check_interval, paranoid=paranoid)
+        self._snapshot = CommitBuilderRevisionRewriter(wt.branch.repository,
+            trees=self.trees, revisions=self.revisions)
+        self.snapshot_count = 0
+        self.merge_count = 0
+        # (old base, new base) -> paths that differ between them
+        self._upstream_changes = {}
+
+    def get_upstream_changes(self, old_base, new_base):
+        """Determine the paths that differ between an old and a new base.
+
+        The paths are only determined by comparing the trees if they are
+        not known from the replay of old_base as new_base.
+
+        :param old_base: Revision id of the old base
+        :param new_base: Revision id of the new base
+        :return: Set of paths
+        """
+        key = (old_base, new_base)
+        if key not in self._upstream_changes:
+            self._upstream_changes[key] = changed_paths(
+                self.trees.revision_tree(new_base),
+                self.trees.revision_tree(old_base))
+        return self._upstream_changes[key]
+
+    def _get_changes(self, oldrev, newparents):
+        """Determine the paths changed by a revision and by upstream.
+
+        :param oldrev: Revision that is being replayed.
+        :param newparents: New parent revision ids.
+        :return: Tuple with the paths changed by the revision and the paths
+            changed between its old and new base, or None if the revision
+            does not have a single present parent
+        """
+        if len(oldrev.parent_ids) != 1 or len(newparents) != 1:
+            return None
+        old_base = oldrev.parent_ids[0]
+        if not self._snapshot.presence.has_revision(old_base):
+            return None
+        changes = changed_paths(self.trees.revision_tree(oldrev.revision_id),
+            self.trees.revision_tree(old_base))
+        return (changes, self.get_upstream_changes(old_base, newparents[0]))
+
+    def can_copy_snapshot(self, oldrev, newparents):
+        """Check whether a revision can be replayed by copying its snapshot.
+
+        :param oldrev: Revision that is being replayed.
+        :param newparents: New parent revision ids.
+        :return: boolean
+        """
+        changes = self._get_changes(oldrev, newparents)
+        return changes is not None and not paths_overlap(*changes)
+
+    def __call__(self, oldrevid, newrevid, newparents):
+        """Replay a commit, with a different base.
+
+        :param oldrevid: Old revision id
+        :param newrevid: New revision id
+        :param newparents: New parent revision ids
+        """
+        oldrev = self.revisions.get_revision(oldrevid)
+        changes = self._get_changes(oldrev, newparents)
+        if changes is None or paths_overlap(*changes):
+            self.merge_count += 1
+            self._last_revid = None
+            WorkingTreeRevisionRewriter.__call__(self, oldrevid, newrevid,
+                newparents)
+            if changes is not None:
+                # The merge can only have changed the paths changed by the
+                # revision or upstream
+                self._upstream_changes[(oldrevid, newrevid)] = (
+                    changes[0].union(changes[1]))
+            return
+        assert oldrevid != newrevid, "Invalid revid %r" % newrevid
+        (committer, authors, revprops) = self.get_commit_metadata(oldrev)
+        revprops = _mod_commit.Commit.update_revprops(revprops,
+            self.wt.branch, authors)
+        self._snapshot.replay(oldrev, newrevid, tuple(newparents), committer,
+            revprops)
+        self.snapshot_count += 1
+        self._last_revid = newrevid
+        self.uncommitted.add(newrevid)
+        # The changes of the revision do not overlap those upstream, so
+        # applying them to both bases leaves the same paths different
+        self._upstream_changes[(oldrevid, newrevid)] = changes[1]
+
+    def finish(self):
+        """Update the working tree and report how revisions were replayed."""
+        super(HybridRevisionRewriter, self).finish()
+        note(gettext("%d revisions replayed by copying their snapshot, "
+                     "%d by merging."),
+             self.snapshot_count, self.merge_count)
+
+
+def changed_paths(new_tree, old_tree):
+    """Determine the paths that differ between two trees.
+
+    :param new_tree: Tree to compare
+    :param old_tree: Tree to compare against
+    :return: Set with the old and new paths of all changed entries
+    """
+    paths = set()
+    for change in new_tree.iter_changes(old_tree):
+        (old_path, new_path) = change[1]
+        if old_path is not None:
+            paths.add(old_path)
+        if new_path is not None:
+            paths.add(new_path)
+    return paths
 
 
-def complete_revert(wt, newparents):
+def paths_overlap(paths, other_paths):
+    """Check whether two sets of paths overlap.
+
+    Paths overlap if they are the same or if one contains the other.
+
+    :param paths: Set of paths
+    :param other_paths: Set of paths
+    :return: boolean
+    """
+    if "" in paths or "" in other_paths:
+        return True
+    prefixes = set()
+    for path in other_paths:
+        while path and path not in prefixes:
+            prefixes.add(path)
+            path = osutils.dirname(path)
+    for path in paths:
+        if path in prefixes:
+            return True
+        path = osutils.dirname(path)
+        while path:
+            if path in other_paths:
+                return True
+            path = osutils.dirname(path)
+    return False
+
+
+def restricted_merge_paths(base_tree, other_tree):
+    """Determine the paths a merge of a tree can be limited to.
+
+    A merge can only be limited to the paths that changed if no entries
+    were renamed or moved and no directories were changed, since those
+    affect the paths of other entries.
+
+    :param base_tree: Base tree of the merge
+    :param other_tree: Tree that is being merged
+    :return: Sorted list of changed paths, or None if the merge can not
+        be limited to them
+    """
+    paths = set()
+    for (file_id, (old_path, new_path), changed_content, versioned, parent,
+            name, kind, executable) in other_tree.iter_changes(base_tree):
+        if (old_path is not None and new_path is not None and
+            old_path != new_path):
+            return None
+        if kind[0] not in (None, 'file', 'symlink'):
+            return None
+        if kind[1] not in (None, 'file', 'symlink'):
+            return None
+        if new_path is not None:
+            paths.add(new_path)
+        else:
+            paths.add(old_path)
+    if not paths:
+        return None
+    return sorted(paths)
+
+
+def _remove_paths(wt, paths):
+    for path in paths:
+        abs_path = wt.abspath(path)
+        if osutils.lexists(abs_path):
+            if osutils.isdir(abs_path):
+                osutils.rmtree(abs_path)
+            else:
+                os.unlink(abs_path)
+
+
+def complete_revert(wt, newparents, trees=None, paranoid=False):
     """Simple helper that reverts to specified new parents and makes sure none
     of the extra files are left around.
 
     :param wt: Working tree to use for rebase
     :param newparents: New parents of the working tree
+    :param trees: Optional `RevisionTreeCache` to retrieve trees from
+    :param paranoid: Whether to check the full working tree afterwards
     """
-    newtree = wt.branch.repository.revision_tree(newparents[0])
+    if trees is None:
+        newtree = wt.branch.repository.revision_tree(newparents[0])
+    else:
+        newtree = trees.revision_tree(newparents[0])
     delta = wt.changes_from(newtree)
     wt.branch.generate_revision_history(newparents[0])
     wt.set_parent_ids([r for r in newparents[:1] if r != NULL_REVISION])
-    for (f, _, _) in delta.added:
-        abs_path = wt.abspath(f)
-        if osutils.lexists(abs_path):
-            if osutils.isdir(abs_path):
-                osutils.rmtree(abs_path)
-            else:
-                os.unlink(abs_path)
+    _remove_paths(wt, [f for (f, _, _) in delta.added])
     wt.revert(None, old_tree=newtree, backups=False)
-    assert not wt.changes_from(wt.basis_tree()).has_changed(), "Rev changed"
+    if paranoid:
+        assert not wt.changes_from(wt.basis_tree()).has_changed(), "Rev changed"
+    wt.set_parent_ids([r for r in newparents if r != NULL_REVISION])
+
+
+def incremental_revert(wt, newparents, trees=None, paranoid=False):
+    """Update a working tree without local changes to new parents.
+
+    Unlike `complete_revert`, only the paths that differ between the basis
+    tree of the working tree and the new left hand parent are updated.
+
+    :param wt: Working tree to update; must not have any changes
+    :param newparents: New parents of the working tree
+    :param trees: Optional `RevisionTreeCache` to retrieve trees from
+    :param paranoid: Whether to check the full working tree afterwards
+    """
+    if trees is None:
+        trees = RevisionTreeCache(wt.branch.repository)
+    oldtree = trees.revision_tree(wt.last_revision())
+    newtree = trees.revision_tree(newparents[0])
+    paths = set()
+    removed = []
+    for (file_id, (old_path, new_path), changed_content, versioned, parent,
+            name, kind, executable) in newtree.iter_changes(oldtree):
+        if old_path is not None:
+            paths.add(old_path)
+        if new_path is not None:
+            paths.add(new_path)
+        if versioned == (True, False):
+            removed.append(old_path)
+    wt.branch.generate_revision_history(newparents[0])
+    wt.set_parent_ids([r for r in newparents[:1] if r != NULL_REVISION])
+    if paths:
+        _remove_paths(wt, removed)
+        wt.revert(sorted(paths), old_tree=newtree, backups=False)
+    if paranoid:
+        assert not wt.changes_from(wt.basis_tree()).has_changed(), "Rev changed"
     wt.set_parent_ids([r for r in newparents if r != NULL_REVISION])
 
 
@@ -593,3 +2048,13 @@ class ReplaySnapshotError(BzrError):
     def __init__(self, msg):
         BzrError.__init__(self)
         self.msg = msg
+
+
+class RestrictedCommitMismatch(BzrError):
+    """Raised when a commit of the changed paths missed changes."""
+    _fmt = """Commit of the changed paths in %(revid)s missed changes to: %(paths)s."""
+
+    def __init__(self, revid, paths):
+        BzrError.__init__(self)
+        self.revid = revid
+        self.paths = ", ".join(paths)
@@ -0,0 +1,249 @@
+# Copyright (C) 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Compact revision graphs used while planning."""
+
+from __future__ import absolute_import
+
+from array import array
+
+from bzrlib.errors import GraphCycleError
+
+
+# Type code of the arrays with node numbers
+_NODE_TYPECODE = 'i'
+
+
+class CompactGraph(object):
+    """Immutable revision graph with integer nodes.
+
+    Revision ids are interned to integers in the order in which they are
+    first seen. The parents of all revisions are kept in a single array,
+    in compressed sparse row form: the parents of the revision in row ``r``
+    are ``parents[offsets[r]:offsets[r+1]]``. Parents that are not in the
+    graph themselves, such as ghosts or revisions outside of the part of the
+    ancestry the graph was created from, are interned as well but have no
+    row.
+    """
+
+    def __init__(self, ancestry):
+        """Create a new graph.
+
+        :param ancestry: Parent map, or iterable over tuples with revision id
+            and parents, such as returned by `Graph.iter_ancestry`. Revisions
+            of which the parents are None (ghosts) are ignored.
+        """
+        if getattr(ancestry, "iteritems", None) is not None:
+            ancestry = ancestry.iteritems()
+        self._revids = []
+        self._nodes = {}
+        # Row of each node, or -1 for nodes of which the parents are unknown
+        self._rows = array(_NODE_TYPECODE)
+        self._offsets = array(_NODE_TYPECODE, [0])
+        self._parents = array(_NODE_TYPECODE)
+        for revid, parents in ancestry:
+            if parents is None:
+                continue
+            node = self._intern(revid)
+            if self._rows[node] != -1:
+                continue
+            self._rows[node] = len(self._offsets) - 1
+            for parent in parents:
+                self._parents.append(self._intern(parent))
+            self._offsets.append(len(self._parents))
+        self._children = None
+        self._child_offsets = None
+        self._positions = None
+
+    def _intern(self, revid):
+        try:
+            return self._nodes[revid]
+        except KeyError:
+            node = self._nodes[revid] = len(self._revids)
+            self._revids.append(revid)
+            self._rows.append(-1)
+            return node
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __contains__(self, revid):
+        node = self._nodes.get(revid)
+        return node is not None and self._rows[node] != -1
+
+    def _iter_parent_nodes(self, node):
+        row = self._rows[node]
+        if row == -1:
+            return iter(())
+        return iter(self._parents[self._offsets[row]:self._offsets[row+1]])
+
+    def _iter_child_nodes(self, node):
+        if self._children is None:
+            self._build_children()
+        return iter(self._children[
+            self._child_offsets[node]:self._child_offsets[node+1]])
+
+    def _build_children(self):
+        count = len(self._revids)
+        offsets = array(_NODE_TYPECODE, [0]) * (count + 1)
+        for parent in self._parents:
+            offsets[parent+1] += 1
+        for node in xrange(count):
+            offsets[node+1] += offsets[node]
+        fill = array(_NODE_TYPECODE, offsets)
+        children = array(_NODE_TYPECODE, [0]) * len(self._parents)
+        for node in xrange(count):
+            for parent in self._iter_parent_nodes(node):
+                children[fill[parent]] = node
+                fill[parent] += 1
+        self._children = children
+        self._child_offsets = offsets
+
+    def get_parents(self, revid):
+        """Return the parents of a revision.
+
+        :param revid: Revision id
+        :return: Tuple with parent revision ids, or None if the parents of
+            revid are not known
+        """
+        node = self._nodes.get(revid)
+        if node is None or self._rows[node] == -1:
+            return None
+        return tuple([self._revids[parent]
+                      for parent in self._iter_parent_nodes(node)])
+
+    def _topo_sort_nodes(self, nodes):
+        member = bytearray(len(self._revids))
+        for node in nodes:
+            member[node] = 1
+        pending = array(_NODE_TYPECODE, [0]) * len(self._revids)
+        ready = []
+        for node in nodes:
+            for parent in self._iter_parent_nodes(node):
+                if member[parent]:
+                    pending[node] += 1
+            if pending[node] == 0:
+                ready.append(node)
+        ready.reverse()
+        order = []
+        while ready:
+            node = ready.pop()
+            order.append(node)
+            for child in self._iter_child_nodes(node):
+                if member[child]:
+                    pending[child] -= 1
+                    if pending[child] == 0:
+                        ready.append(child)
+        if len(order) != len(nodes):
+            raise GraphCycleError(dict([(self._revids[n],
+                self.get_parents(self._revids[n]))
+                for n in nodes if pending[n] != 0]))
+        return order
+
+    def topo_sort(self, revids=None):
+        """Sort revisions topologically.
+
+        :param revids: Revisions to sort, all of which should be in the
+            graph; defaults to all revisions in the graph
+        :return: List of revision ids, in which parents come before their
+            children
+        """
+        if revids is None:
+            nodes = [n for n in xrange(len(self._revids))
+                     if self._rows[n] != -1]
+        else:
+            nodes = []
+            for revid in revids:
+                node = self._nodes[revid]
+                if self._rows[node] == -1:
+                    raise KeyError(revid)
+                nodes.append(node)
+        return [self._revids[n] for n in self._topo_sort_nodes(nodes)]
+
+    def descendants(self, revids):
+        """Find the descendants of a set of revisions.
+
+        :param revids: Revision ids to start from
+        :return: Set with the revision ids of the revisions in the graph that
+            descend from revids, not including revids themselves unless they
+            descend from one of the others
+        """
+        seen = bytearray(len(self._revids))
+        pending = []
+        for revid in revids:
+            node = self._nodes.get(revid)
+            if node is not None:
+                pending.extend(self._iter_child_nodes(node))
+        ret = set()
+        while pending:
+            node = pending.pop()
+            if seen[node]:
+                continue
+            seen[node] = 1
+            ret.add(self._revids[node])
+            pending.extend(self._iter_child_nodes(node))
+        return ret
+
+    def _get_positions(self):
+        if self._positions is None:
+            positions = array(_NODE_TYPECODE, [-1]) * len(self._revids)
+            for i, node in enumerate(self._topo_sort_nodes(
+                    [n for n in xrange(len(self._revids))
+                     if self._rows[n] != -1])):
+                positions[node] = i
+            self._positions = positions
+        return self._positions
+
+    def heads(self, revids):
+        """Find the heads of a set of revisions.
+
+        Only the ancestry in the graph is considered, so the result is only
+        exact if any path between two of revids lies within the graph.
+
+        :param revids: Revision ids
+        :return: Set with the revision ids in revids that are not ancestors
+            of any of the others
+        """
+        revids = set(revids)
+        candidates = set()
+        for revid in revids:
+            node = self._nodes.get(revid)
+            if node is not None:
+                candidates.add(node)
+        if len(candidates) < 2:
+            return revids
+        positions = self._get_positions()
+        # Ancestors of a revision come before it in topological order, so
+        # there is no need to look beyond the earliest candidate
+        lowest = min([positions[n] for n in candidates])
+        seen = bytearray(len(self._revids))
+        pending = []
+        for node in candidates:
+            pending.extend(self._iter_parent_nodes(node))
+        while pending:
+            node = pending.pop()
+            if seen[node]:
+                continue
+            seen[node] = 1
+            if node in candidates:
+                revids.discard(self._revids[node])
+                candidates.discard(node)
+                if len(candidates) == 1:
+                    break
+            if positions[node] <= lowest:
+                continue
+            pending.extend(self._iter_parent_nodes(node))
+        return revids
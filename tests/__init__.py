@@ -16,6 +16,35 @@
 
 """Tests for bzr-rewrite."""
 
+from bzrlib.revision import NULL_REVISION
+
+
+def make_random_parent_map(rand, size, parent_counts=(1, 1, 1, 2, 2, 3),
+                           root_probability=0.05):
+    """Create a random revision graph.
+
+    Revisions are named r0 to r<size-1>, and only have parents with a lower
+    number.
+
+    :param rand: Random number generator
+    :param size: Number of revisions
+    :param parent_counts: Sequence to pick the number of parents of a
+        revision from
+    :param root_probability: Probability that a revision other than r0 has
+        no parents
+    :return: Parent map
+    """
+    parent_map = {}
+    for i in range(size):
+        revid = "r%d" % i
+        if i == 0 or rand.random() < root_probability:
+            parent_map[revid] = (NULL_REVISION,)
+            continue
+        candidates = ["r%d" % j for j in range(i)]
+        nparents = min(len(candidates), rand.choice(parent_counts))
+        parent_map[revid] = tuple(rand.sample(candidates, nparents))
+    return parent_map
+
 
 def test_suite():
     """Determine the testsuite for bzr-rewrite."""
@@ -25,10 +54,13 @@ def test_suite():
     loader = TestUtil.TestLoader()
     suite = TestSuite()
     testmod_names = [
+        'test_ancestry',
         'test_blackbox',
+        'test_cache',
         'test_maptree',
         'test_pseudonyms',
         'test_rebase',
+        'test_revgraph',
         'test_upgrade']
     suite.addTest(loader.loadTestsFromModuleNames(
                               ["%s.%s" % (__name__, i) for i in testmod_names]))
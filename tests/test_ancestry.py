@@ -0,0 +1,174 @@
+# Copyright (C) 2012 by Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Tests for the ancestry index."""
+
+import random
+
+from bzrlib.graph import (
+    DictParentsProvider,
+    Graph,
+    )
+from bzrlib.revision import NULL_REVISION
+from bzrlib.tests import (
+    TestCase,
+    TestCaseWithTransport,
+    )
+
+from bzrlib.plugins.rewrite.ancestry import (
+    AncestryIndex,
+    find_unique_ancestors,
+    )
+from bzrlib.plugins.rewrite.tests import make_random_parent_map
+
+
+class CountingParentsProvider(object):
+
+    def __init__(self, parent_map):
+        self.parent_map = parent_map
+        self._provider = DictParentsProvider(parent_map)
+        self.looked_up = set()
+
+    def get_parent_map(self, revids):
+        self.looked_up.update(revids)
+        return self._provider.get_parent_map(revids)
+
+
+class FindUniqueAncestorsTests(TestCase):
+
+    def setUp(self):
+        super(FindUniqueAncestorsTests, self).setUp()
+        self.graph = Graph(DictParentsProvider({"A": (NULL_REVISION,),
+            "B": ("A",), "C": ("B", "ghost"), "D": ("A",), "E": ("D", "B")}))
+
+    def test_unique(self):
+        self.assertEquals((set(["C"]), set(["B"])),
+            find_unique_ancestors(self.graph, "C", set(["A", "B"])))
+        self.assertEquals((set(["D", "E"]), set(["A", "B"])),
+            find_unique_ancestors(self.graph, "E", set(["A", "B"])))
+
+    def test_in_ancestry(self):
+        self.assertEquals((set(), set(["B"])),
+            find_unique_ancestors(self.graph, "B", set(["A", "B"])))
+
+    def test_empty_ancestry(self):
+        self.assertEquals((set(["A", "B", "C"]), set()),
+            find_unique_ancestors(self.graph, "C", ()))
+
+
+class AncestryIndexTests(TestCaseWithTransport):
+
+    def make_graph(self, size):
+        parent_map = {"r0": (NULL_REVISION,)}
+        for i in range(1, size):
+            parent_map["r%d" % i] = ("r%d" % (i-1),)
+        return parent_map
+
+    def test_ancestry(self):
+        graph = Graph(DictParentsProvider(self.make_graph(5)))
+        index = AncestryIndex(self.get_transport())
+        ancestry = index.get_ancestry(graph, "r2")
+        self.assertTrue("r0" in ancestry)
+        self.assertTrue("r2" in ancestry)
+        self.assertFalse("r3" in ancestry)
+        self.assertFalse("unknown" in ancestry)
+
+    def test_persistent(self):
+        graph = Graph(DictParentsProvider(self.make_graph(5)))
+        AncestryIndex(self.get_transport()).get_ancestry(graph, "r2")
+        provider = CountingParentsProvider({})
+        ancestry = AncestryIndex(self.get_transport()).get_ancestry(
+            Graph(provider), "r2")
+        self.assertEquals(set(), provider.looked_up)
+        self.assertTrue("r1" in ancestry)
+        self.assertFalse("r3" in ancestry)
+
+    def test_incremental(self):
+        parent_map = self.make_graph(1000)
+        parent_map["side"] = ("r500",)
+        parent_map["merge"] = ("r999", "side")
+        AncestryIndex(self.get_transport()).get_ancestry(
+            Graph(DictParentsProvider(parent_map)), "r990")
+        provider = CountingParentsProvider(parent_map)
+        ancestry = AncestryIndex(self.get_transport()).get_ancestry(
+            Graph(provider), "merge")
+        self.assertEquals(set(["merge", "side"] +
+            ["r%d" % i for i in range(991, 1000)]), provider.looked_up)
+        for revid in parent_map:
+            self.assertTrue(revid in ancestry)
+        ancestry = AncestryIndex(self.get_transport()).get_ancestry(
+            Graph(provider), "merge")
+        self.assertTrue("side" in ancestry)
+
+    def test_unrelated_stored(self):
+        parent_map = self.make_graph(10)
+        parent_map["other"] = ("r5",)
+        parent_map["merge"] = ("r8", "other")
+        graph = Graph(DictParentsProvider(parent_map))
+        index = AncestryIndex(self.get_transport())
+        index.get_ancestry(graph, "other")
+        ancestry = index.get_ancestry(graph, "r9")
+        self.assertFalse("other" in ancestry)
+        self.assertTrue("r9" in ancestry)
+        self.assertTrue("r0" in ancestry)
+
+    def test_compacted(self):
+        graph = Graph(DictParentsProvider(self.make_graph(20)))
+        index = AncestryIndex(self.get_transport(), max_tips=2)
+        for i in range(10):
+            index.get_ancestry(graph, "r%d" % i)
+        self.assertTrue(
+            self.get_transport().get_bytes("rebase-ancestry").count("\na ")
+            <= 4)
+        index = AncestryIndex(self.get_transport(), max_tips=2)
+        provider = CountingParentsProvider({})
+        ancestry = index.get_ancestry(Graph(provider), "r9")
+        self.assertEquals(set(), provider.looked_up)
+        self.assertTrue("r0" in ancestry)
+
+    def test_interrupted(self):
+        graph = Graph(DictParentsProvider(self.make_graph(5)))
+        AncestryIndex(self.get_transport()).get_ancestry(graph, "r2")
+        self.get_transport().append_bytes("rebase-ancestry", "a r4 trunc")
+        ancestry = AncestryIndex(self.get_transport()).get_ancestry(graph,
+            "r4")
+        self.assertTrue("r3" in ancestry)
+
+    def test_unknown_format(self):
+        self.get_transport().put_bytes("rebase-ancestry", "garbage\n")
+        graph = Graph(DictParentsProvider(self.make_graph(5)))
+        ancestry = AncestryIndex(self.get_transport()).get_ancestry(graph,
+            "r2")
+        self.assertTrue("r1" in ancestry)
+        ancestry = AncestryIndex(self.get_transport()).get_ancestry(graph,
+            "r2")
+        self.assertTrue("r1" in ancestry)
+
+    def test_random(self):
+        rand = random.Random(42)
+        for i in range(10):
+            parent_map = make_random_parent_map(rand, 50,
+                parent_counts=(1, 1, 2), root_probability=0)
+            graph = Graph(DictParentsProvider(parent_map))
+            index = AncestryIndex(self.get_transport(), "index-%d" % i,
+                max_tips=3)
+            for j in range(10):
+                tip = "r%d" % rand.randrange(50)
+                ancestry = index.get_ancestry(graph, tip)
+                expected = set([r for (r, ps) in graph.iter_ancestry([tip])
+                                if r != NULL_REVISION])
+                self.assertEquals(expected,
+                    set([r for r in parent_map if r in ancestry]))
@@ -115,6 +115,105 @@ class TestRebaseSimple(ExternalBase):
         self.assertEquals('', self.run_bzr('rebase ../main')[0])
         self.assertEquals('3\n', self.run_bzr('revno')[0])
 
+    def test_simple_success_ancestry_index(self):
+        self.make_file('hello', '42')
+        self.run_bzr('commit -m that')
+        os.chdir('../feature')
+        self.run_bzr('config rebase.ancestry_index=true')
+        self.make_file('hoi', "my data")
+        self.run_bzr('add')
+        self.run_bzr('commit -m this')
+        self.assertEquals('', self.run_bzr('rebase ../main')[0])
+        self.assertEquals('3\n', self.run_bzr('revno')[0])
+        self.assertPathExists('.bzr/repository/rebase-ancestry')
+        self.assertEquals('No revisions to rebase.\n',
+            self.run_bzr('rebase ../main')[0])
+
+    def test_simple_success_in_memory(self):
+        self.make_file('hello', '42')
+        self.run_bzr('commit -m that')
+        os.chdir('../feature')
+        self.make_file('hoi', "my data")
+        self.run_bzr('add')
+        self.run_bzr('commit -m this')
+        self.make_file('hoi', "more data")
+        self.run_bzr('commit -m those')
+        self.assertEquals('', self.run_bzr('rebase --in-memory ../main')[0])
+        self.assertEquals('4\n', self.run_bzr('revno')[0])
+        self.assertEquals('42', open('hello').read())
+        self.assertEquals('more data', open('hoi').read())
+        self.assertEquals('', self.run_bzr('status')[0])
+
+    def test_simple_success_hybrid(self):
+        self.make_file('hello', '42')
+        self.run_bzr('commit -m that')
+        os.chdir('../feature')
+        self.make_file('hoi', "my data")
+        self.run_bzr('add')
+        self.run_bzr('commit -m this')
+        out, err = self.run_bzr('rebase --hybrid ../main')
+        self.assertEquals('', out)
+        self.assertContainsRe(err,
+            '1 revisions replayed by copying their snapshot, 0 by merging.')
+        self.assertEquals('3\n', self.run_bzr('revno')[0])
+        self.assertEquals('42', open('hello').read())
+        self.assertEquals('', self.run_bzr('status')[0])
+
+    def test_interrupted_continue_in_memory(self):
+        from bzrlib.errors import BzrCommandError
+        from bzrlib.plugins.rewrite.rebase import InMemoryRevisionRewriter
+        self.make_file('hello', '42')
+        self.run_bzr('commit -m that')
+        os.chdir('../feature')
+        self.make_file('hoi', "my data")
+        self.run_bzr('add')
+        self.run_bzr('commit -m this')
+        self.make_file('hoi', "more data")
+        self.run_bzr('commit -m those')
+        finish = InMemoryRevisionRewriter.finish
+        def interrupt(rewriter):
+            InMemoryRevisionRewriter.finish = finish
+            raise BzrCommandError("interrupted")
+        self.overrideAttr(InMemoryRevisionRewriter, 'finish', interrupt)
+        self.run_bzr_error(['interrupted'], 'rebase --in-memory ../main')
+        self.assertEquals('3\n', self.run_bzr('revno')[0])
+        self.assertEquals('',
+            self.run_bzr('rebase-continue --in-memory')[0])
+        self.assertEquals('4\n', self.run_bzr('revno')[0])
+        self.assertEquals('42', open('hello').read())
+        self.assertEquals('more data', open('hoi').read())
+        self.assertEquals('', self.run_bzr('status')[0])
+
+    def test_interrupted_continue_hybrid(self):
+        from bzrlib.errors import BzrCommandError
+        from bzrlib.plugins.rewrite.rebase import HybridRevisionRewriter
+        self.make_file('hello', '42')
+        self.run_bzr('commit -m that')
+        os.chdir('../feature')
+        self.make_file('hoi', "my data")
+        self.run_bzr('add')
+        self.run_bzr('commit -m this')
+        finish = HybridRevisionRewriter.finish
+        def interrupt(rewriter):
+            HybridRevisionRewriter.finish = finish
+            raise BzrCommandError("interrupted")
+        self.overrideAttr(HybridRevisionRewriter, 'finish', interrupt)
+        self.run_bzr_error(['interrupted'], 'rebase --hybrid ../main')
+        self.assertEquals('2\n', self.run_bzr('revno')[0])
+        self.assertEquals('', self.run_bzr('rebase-continue')[0])
+        self.assertEquals('3\n', self.run_bzr('revno')[0])
+        self.assertEquals('42', open('hello').read())
+        self.assertEquals('my data', open('hoi').read())
+        self.assertEquals('', self.run_bzr('status')[0])
+
+    def test_hybrid_in_memory(self):
+        self.run_bzr_error(
+            ['--in-memory and --hybrid are mutually exclusive'],
+            'rebase --in-memory --hybrid ../feature')
+        self.run_bzr_error(
+            ['--in-memory and --hybrid are mutually exclusive'],
+            'rebase-continue --in-memory --hybrid')
+
     def test_range(self):
         # commit mainline rev 2
         self.make_file('hello', '42')
@@ -201,6 +300,87 @@ class TestRebaseSimple(ExternalBase):
         self.assertEquals('', self.run_bzr('rebase-continue')[0])
         self.assertEquals('3\n', self.run_bzr('revno')[0])
 
+    def test_conflicting_continue_in_memory(self):
+        self.make_file('hello', '42')
+        self.run_bzr('commit -m that')
+        os.chdir('../feature')
+        self.make_file('hello', "other data")
+        self.run_bzr('commit -m this')
+        self.make_file('hoi', "my data")
+        self.run_bzr('add')
+        self.run_bzr('commit -m those')
+        self.run_bzr_error(['bzr: ERROR: A conflict occurred replaying a commit.'],
+            ['rebase', '--in-memory', '../main'])
+        self.run_bzr('resolved hello')
+        self.assertEquals('',
+            self.run_bzr('rebase-continue --in-memory')[0])
+        self.assertEquals('4\n', self.run_bzr('revno')[0])
+        self.assertEquals('my data', open('hoi').read())
+        self.assertEquals('', self.run_bzr('status')[0])
+
+    def conflict_after_replay(self, option):
+        self.make_file('hello', '42')
+        self.run_bzr('commit -m that')
+        os.chdir('../feature')
+        self.make_file('hoi', "my data")
+        self.run_bzr('add')
+        self.run_bzr('commit -m this')
+        self.make_file('hello', "other data")
+        self.run_bzr('commit -m those')
+        self.run_bzr_error(['bzr: ERROR: A conflict occurred replaying a commit.'],
+            ['rebase', option, '../main'])
+        self.make_file('hello', "resolved")
+        self.run_bzr('resolved hello')
+        self.assertEquals('', self.run_bzr('rebase-continue')[0])
+        self.assertEquals('4\n', self.run_bzr('revno')[0])
+        self.assertEquals('resolved', open('hello').read())
+        self.assertEquals('my data', open('hoi').read())
+        self.assertEquals('', self.run_bzr('status')[0])
+
+    def test_conflicting_continue_after_in_memory(self):
+        self.conflict_after_replay('--in-memory')
+
+    def test_conflicting_continue_after_hybrid(self):
+        self.conflict_after_replay('--hybrid')
+
+    def test_conflicting_continue_format1(self):
+        from bzrlib.plugins.rewrite.rebase import (
+            REBASE_JOURNAL_FILENAME,
+            RebaseState1,
+            RebaseState2,
+            )
+        from bzrlib.workingtree import WorkingTree
+        self.make_file('hello', '42')
+        self.run_bzr('commit -m that')
+        os.chdir('../feature')
+        self.make_file('hoi', "my data")
+        self.run_bzr('add')
+        self.run_bzr('commit -m this')
+        self.make_file('hello', "other data")
+        self.run_bzr('commit -m those')
+        self.run_bzr_error(['bzr: ERROR: A conflict occurred replaying a commit.'],
+            ['rebase', '../main'])
+        # Leave the state like an older version would have
+        wt = WorkingTree.open('.')
+        wt.lock_write()
+        try:
+            state = RebaseState2(wt)
+            replace_map = state.read_plan()[1]
+            active_revid = state.read_active_revid()
+            wt._transport.delete(REBASE_JOURNAL_FILENAME)
+            state = RebaseState1(wt)
+            state.write_plan(replace_map)
+            state.write_active_revid(active_revid)
+        finally:
+            wt.unlock()
+        self.make_file('hello', "resolved")
+        self.run_bzr('resolved hello')
+        self.assertEquals('', self.run_bzr('rebase-continue')[0])
+        self.assertEquals('4\n', self.run_bzr('revno')[0])
+        self.assertEquals('resolved', open('hello').read())
+        self.assertEquals('my data', open('hoi').read())
+        self.assertEquals('', self.run_bzr('status')[0])
+
     def test_continue_nothing(self):
         self.run_bzr_error(['bzr: ERROR: No rebase to continue'],
                            ['rebase-continue'])
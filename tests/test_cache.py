@@ -0,0 +1,198 @@
+# Copyright (C) 2012 by Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Tests for the rebase caches."""
+
+from bzrlib.revision import (
+    NULL_REVISION,
+    Revision,
+    )
+from bzrlib.tests import TestCase
+
+from bzrlib.plugins.rewrite import cache as _mod_cache
+from bzrlib.plugins.rewrite.cache import (
+    RevisionCache,
+    RevisionPresenceCache,
+    RevisionTreeCache,
+    )
+
+
+class CountingRepository(object):
+
+    def __init__(self, revids):
+        self.revids = set(revids)
+        self.calls = []
+
+    def has_revisions(self, revids):
+        self.calls.append(set(revids))
+        return self.revids.intersection(revids)
+
+
+class RevisionPresenceCacheTests(TestCase):
+
+    def test_prefetch(self):
+        repo = CountingRepository(["a", "b"])
+        cache = RevisionPresenceCache(repo)
+        cache.prefetch(["a", "c"])
+        self.assertTrue(cache.has_revision("a"))
+        self.assertFalse(cache.has_revision("c"))
+        self.assertEquals([set(["a", "c"])], repo.calls)
+
+    def test_memo(self):
+        repo = CountingRepository(["a", "b"])
+        cache = RevisionPresenceCache(repo)
+        self.assertTrue(cache.has_revision("b"))
+        self.assertTrue(cache.has_revision("b"))
+        cache.prefetch(["a", "b"])
+        self.assertEquals([set(["b"]), set(["a"])], repo.calls)
+
+    def test_null_revision(self):
+        repo = CountingRepository([])
+        cache = RevisionPresenceCache(repo)
+        self.assertTrue(cache.has_revision(NULL_REVISION))
+        self.assertEquals([], repo.calls)
+
+    def test_get_present_revisions(self):
+        repo = CountingRepository(["a", "b"])
+        cache = RevisionPresenceCache(repo)
+        self.assertEquals(("b", "a"),
+            cache.get_present_revisions(["b", "ghost", "a"]))
+        self.assertEquals([set(["a", "b", "ghost"])], repo.calls)
+
+    def test_add(self):
+        repo = CountingRepository([])
+        cache = RevisionPresenceCache(repo)
+        self.assertFalse(cache.has_revision("a"))
+        cache.add("a")
+        self.assertTrue(cache.has_revision("a"))
+        self.assertEquals([set(["a"])], repo.calls)
+
+
+class FakeTree(object):
+
+    def __init__(self, revid):
+        self.revid = revid
+        self.root_inventory = range(10)
+
+    def get_revision_id(self):
+        return self.revid
+
+
+class TreeRepository(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def revision_tree(self, revid):
+        self.calls.append(("revision_tree", revid))
+        return FakeTree(revid)
+
+    def revision_trees(self, revids):
+        self.calls.append(("revision_trees", list(revids)))
+        return [FakeTree(revid) for revid in revids]
+
+
+class RevisionTreeCacheTests(TestCase):
+
+    def test_revision_tree(self):
+        repo = TreeRepository()
+        cache = RevisionTreeCache(repo)
+        tree = cache.revision_tree("a")
+        self.assertEquals("a", tree.get_revision_id())
+        self.assertIs(tree, cache.revision_tree("a"))
+        self.assertEquals([("revision_tree", "a")], repo.calls)
+
+    def test_get_inventory(self):
+        repo = TreeRepository()
+        cache = RevisionTreeCache(repo)
+        self.assertIs(cache.revision_tree("a").root_inventory,
+            cache.get_inventory("a"))
+
+    def test_prefetch(self):
+        repo = TreeRepository()
+        cache = RevisionTreeCache(repo)
+        cache.revision_tree("a")
+        cache.prefetch(["a", "b", NULL_REVISION, "c", "b"])
+        self.assertTrue("b" in cache)
+        cache.revision_tree("c")
+        self.assertEquals([("revision_tree", "a"),
+            ("revision_trees", ["b", "c"])], repo.calls)
+
+    def test_max_trees(self):
+        repo = TreeRepository()
+        cache = RevisionTreeCache(repo, max_trees=2)
+        cache.revision_tree("a")
+        cache.revision_tree("b")
+        cache.revision_tree("c")
+        self.assertFalse("a" in cache)
+        self.assertTrue("c" in cache)
+
+    def test_max_size(self):
+        repo = TreeRepository()
+        cache = RevisionTreeCache(repo, max_size=5000)
+        cache.revision_tree("a")
+        cache.revision_tree("b")
+        cache.revision_tree("c")
+        self.assertFalse("a" in cache)
+        self.assertTrue("c" in cache)
+
+
+class RevisionRepository(CountingRepository):
+
+    def get_revisions(self, revids):
+        self.calls.append(("get_revisions", list(revids)))
+        return [Revision(revid) for revid in revids]
+
+    def get_revision(self, revid):
+        self.calls.append(("get_revision", revid))
+        return Revision(revid)
+
+
+class RevisionCacheTests(TestCase):
+
+    def test_prefetch(self):
+        repo = RevisionRepository(["a", "b"])
+        cache = RevisionCache(repo)
+        cache.prefetch(["b", "a", "ghost", NULL_REVISION])
+        self.assertEquals("a", cache.get_revision("a").revision_id)
+        self.assertEquals("b", cache.get_revision("b").revision_id)
+        self.assertEquals([set(["a", "b", "ghost"]),
+            ("get_revisions", ["a", "b"])], repo.calls)
+
+    def test_prefetch_chunks(self):
+        self.overrideAttr(_mod_cache, "REVISION_PREFETCH_CHUNK", 2)
+        repo = RevisionRepository(["a", "b", "c"])
+        cache = RevisionCache(repo)
+        cache.prefetch(["a", "b", "c"])
+        self.assertEquals([set(["a", "b", "c"]),
+            ("get_revisions", ["a", "b"]), ("get_revisions", ["c"])],
+            repo.calls)
+
+    def test_get_revision(self):
+        repo = RevisionRepository(["a"])
+        cache = RevisionCache(repo)
+        rev = cache.get_revision("a")
+        self.assertIs(rev, cache.get_revision("a"))
+        cache.prefetch(["a"])
+        self.assertEquals([("get_revision", "a")], repo.calls)
+
+    def test_get_revisions(self):
+        repo = RevisionRepository(["a", "b"])
+        cache = RevisionCache(repo)
+        self.assertEquals(["b", "a"],
+            [rev.revision_id for rev in cache.get_revisions(["b", "a"])])
+        self.assertEquals([set(["a", "b"]),
+            ("get_revisions", ["a", "b"])], repo.calls)
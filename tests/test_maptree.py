@@ -23,7 +23,10 @@ from bzrlib.treebuilder import (
     TreeBuilder,
     )
 
+from bzrlib.plugins.rewrite import maptree
 from bzrlib.plugins.rewrite.maptree import (
+    FileIdMap,
+    FileIdMapper,
     MapTree,
     map_file_ids,
     )
@@ -88,8 +91,156 @@ class EmptyMapTreeTests(TestCaseWithTransport):
                               self.maptree.path2id("foo")))
         self.assertFalse(self.maptree.has_id("bar"))
 
+    def test_mapped_ids(self):
+        self.oldtree.lock_write()
+        self.addCleanup(self.oldtree.unlock)
+        self.build_tree(['branch/foo'])
+        self.oldtree.add(['foo'], ['foo-id'])
+        self.maptree = MapTree(self.oldtree, {"foo-id": "bar-id"})
+        self.assertFalse(self.maptree.is_identity())
+        self.assertEquals("bar-id", self.maptree.path2id("foo"))
+        self.assertEquals("foo", self.maptree.id2path("bar-id"))
+        self.assertTrue(self.maptree.has_id("bar-id"))
+
+    def test_iter_entries_by_dir(self):
+        self.oldtree.lock_write()
+        self.addCleanup(self.oldtree.unlock)
+        self.build_tree(['branch/dir/', 'branch/dir/foo', 'branch/bar'])
+        self.oldtree.add(['dir', 'dir/foo', 'bar'],
+            ['dir-id', 'foo-id', 'bar-id'])
+        self.maptree = MapTree(self.oldtree, {"dir-id": "newdir-id"})
+        old_entries = dict(self.oldtree.iter_entries_by_dir())
+        entries = dict(self.maptree.iter_entries_by_dir())
+        self.assertEquals("newdir-id", entries["dir"].file_id)
+        self.assertEquals("newdir-id", entries["dir/foo"].parent_id)
+        self.assertEquals("foo-id", entries["dir/foo"].file_id)
+        self.assertEquals("dir-id", old_entries["dir"].file_id)
+        self.assertEquals("dir-id", old_entries["dir/foo"].parent_id)
+        self.assertEquals(old_entries["bar"], entries["bar"])
+
+
+class FileIdMapTests(TestCase):
+
+    def test_empty(self):
+        fileid_map = FileIdMap()
+        self.assertTrue(fileid_map.is_identity())
+        self.assertEquals("a", fileid_map.new_id("a"))
+        self.assertEquals("a", fileid_map.old_id("a"))
+
+    def test_identity_entries(self):
+        fileid_map = FileIdMap({"a": "a"})
+        self.assertTrue(fileid_map.is_identity())
+        self.assertEquals(0, len(fileid_map))
+
+    def test_lookups(self):
+        fileid_map = FileIdMap({"a": "b", "c": "c"})
+        self.assertFalse(fileid_map.is_identity())
+        self.assertEquals("b", fileid_map.new_id("a"))
+        self.assertEquals("c", fileid_map.new_id("c"))
+        self.assertEquals("a", fileid_map.old_id("b"))
+        self.assertEquals("c", fileid_map.old_id("c"))
+        self.assertEquals([("a", "b")], list(fileid_map.iteritems()))
+
+    def test_replace(self):
+        fileid_map = FileIdMap({"a": "b"})
+        fileid_map.add("a", "c")
+        self.assertEquals("c", fileid_map.new_id("a"))
+        self.assertEquals("a", fileid_map.old_id("c"))
+        self.assertEquals("b", fileid_map.old_id("b"))
+        fileid_map.remove("a")
+        self.assertTrue(fileid_map.is_identity())
+        self.assertEquals("c", fileid_map.old_id("c"))
+
+    def test_shared_new_id(self):
+        fileid_map = FileIdMap()
+        fileid_map.add("a", "x")
+        fileid_map.add("b", "x")
+        self.assertEquals("b", fileid_map.old_id("x"))
+        fileid_map.remove("b")
+        self.assertEquals("a", fileid_map.old_id("x"))
+        self.assertEquals("x", fileid_map.new_id("a"))
+        fileid_map.remove("a")
+        self.assertEquals("x", fileid_map.old_id("x"))
+
 
 class MapFileIdTests(TestCase):
 
     def test_empty(self):
         self.assertEquals({}, map_file_ids(None, [], []))
+
+
+class FileIdMapperTests(TestCaseWithTransport):
+
+    def setUp(self):
+        super(FileIdMapperTests, self).setUp()
+        self.oldwt = self.make_branch_and_tree('old')
+        self.newwt = self.make_branch_and_tree('new')
+
+    def commit_both(self, revid, paths):
+        """Commit the same paths in both trees, with different file ids."""
+        for (wt, prefix) in ((self.oldwt, "old"), (self.newwt, "new")):
+            for path in paths:
+                if not wt.has_filename(path):
+                    self.build_tree([prefix + "/" + path])
+                    wt.add([path], [prefix + "-" + path.strip("/")])
+            wt.commit(revid, rev_id=prefix + revid)
+
+    def assertMapsLike(self, mapper, oldrevs, newrevs):
+        repository = self.newwt.branch.repository
+        expected = dict([(k, v) for (k, v) in
+            map_file_ids(repository, oldrevs, newrevs).iteritems() if k != v])
+        self.assertEquals(expected, dict(mapper(oldrevs, newrevs).iteritems()))
+
+    def test_incremental(self):
+        self.commit_both("1", ["a", "b", "dir/", "dir/c"])
+        self.commit_both("2", ["d"])
+        self.oldwt.rename_one("a", "e")
+        self.oldwt.remove(["b"], keep_files=False)
+        self.oldwt.commit("3", rev_id="old3")
+        self.newwt.remove(["b"], keep_files=False)
+        self.newwt.rename_one("d", "b")
+        self.newwt.commit("3", rev_id="new3")
+        self.newwt.branch.repository.fetch(self.oldwt.branch.repository)
+        repository = self.newwt.branch.repository
+        repository.lock_read()
+        self.addCleanup(repository.unlock)
+        walks = []
+        def map_tree_file_ids(oldtree, newtree):
+            walks.append((oldtree.get_revision_id(), newtree.get_revision_id()))
+            return orig_map_tree_file_ids(oldtree, newtree)
+        orig_map_tree_file_ids = self.overrideAttr(maptree,
+            "_map_tree_file_ids", map_tree_file_ids)
+        mapper = FileIdMapper(repository)
+        self.assertMapsLike(mapper, ["old1"], ["new1"])
+        self.assertMapsLike(mapper, ["old2"], ["new2"])
+        self.assertMapsLike(mapper, ["old3"], ["new2"])
+        self.assertMapsLike(mapper, ["old3"], ["new3"])
+        self.assertMapsLike(mapper, ["old1"], ["new3"])
+        self.assertEquals([("old1", "new1")], walks)
+
+    def test_directory_rename(self):
+        self.commit_both("1", ["dir/", "dir/c"])
+        self.oldwt.rename_one("dir", "otherdir")
+        self.oldwt.commit("2", rev_id="old2")
+        self.newwt.branch.repository.fetch(self.oldwt.branch.repository)
+        repository = self.newwt.branch.repository
+        repository.lock_read()
+        self.addCleanup(repository.unlock)
+        mapper = FileIdMapper(repository)
+        self.assertMapsLike(mapper, ["old1"], ["new1"])
+        self.assertMapsLike(mapper, ["old2"], ["new1"])
+
+    def test_multiple_parents(self):
+        self.commit_both("1", ["a", "b"])
+        self.newwt.branch.repository.fetch(self.oldwt.branch.repository)
+        repository = self.newwt.branch.repository
+        repository.lock_read()
+        self.addCleanup(repository.unlock)
+        mapper = FileIdMapper(repository)
+        self.assertMapsLike(mapper, ["old1", "old1"], ["new1", "old1"])
+        self.assertMapsLike(mapper, ["old1", "old1"], ["old1", "new1"])
+        self.assertMapsLike(mapper, ["old1", "new1"], ["new1", "new1"])
+
+    def test_no_parents(self):
+        mapper = FileIdMapper(None)
+        self.assertTrue(mapper([], []).is_identity())
@@ -16,33 +16,66 @@
 
 """Tests for the rebase code."""
 
+from cStringIO import StringIO
+import os
+import random
+
 from bzrlib.conflicts import ConflictList
 from bzrlib.errors import (
+    BzrError,
+    InconsistentDelta,
     UnknownFormatError,
     NoSuchFile,
     ConflictsInTree,
+    UnrelatedBranches,
     )
 from bzrlib.graph import (
     Graph,
     DictParentsProvider,
+    FrozenHeadsCache,
+    )
+from bzrlib.inventory import (
+    Inventory,
+    InventoryDirectory,
+    InventoryFile,
     )
 from bzrlib.revision import NULL_REVISION
 from bzrlib.tests import TestCase, TestCaseWithTransport
 from bzrlib.tests.matchers import RevisionHistoryMatches
+from bzrlib.tsort import topo_sort
 
+from bzrlib.plugins.rewrite import rebase as rebase_module
 from bzrlib.plugins.rewrite.rebase import (
     marshall_rebase_plan,
     unmarshall_rebase_plan,
+    read_rebase_plan_stream,
+    write_rebase_plan_stream,
     CommitBuilderRevisionRewriter,
+    HybridRevisionRewriter,
+    check_inventory_delta,
+    InMemoryRevisionRewriter,
+    find_ancestors_among,
+    find_common_ancestor,
+    generate_bounded_transpose_plan,
     generate_simple_plan,
     generate_transpose_plan,
+    incremental_revert,
+    inventory_delta_to_changes,
+    paths_overlap,
+    rebase,
     rebase_todo,
+    restricted_merge_paths,
     REBASE_PLAN_FILENAME,
     REBASE_CURRENT_REVID_FILENAME,
+    REBASE_JOURNAL_FILENAME,
+    REVPROP_REBASE_OF,
     RebaseState1,
+    RebaseState2,
     ReplaySnapshotError,
+    RestrictedCommitMismatch,
     WorkingTreeRevisionRewriter,
     )
+from bzrlib.plugins.rewrite.tests import make_random_parent_map
 
 
 class RebasePlanReadWriterTests(TestCase):
@@ -71,6 +104,40 @@ oldrev newrev newparent1 newparent2
 """)
 
 
+class RebasePlan2ReadWriterTests(TestCase):
+
+    def test_simple_write(self):
+        f = StringIO()
+        write_rebase_plan_stream(f, (1, "bla"),
+            {"oldrev": ("newrev", ("newparent1", "newparent2"))})
+        self.assertEqualDiff("""# Bazaar rebase plan 2
+1 bla
+0:oldrev 0:newrev 3:parent1 9:2
+# index
+29 oldrev
+# index at 00000000000000000061
+""", f.getvalue())
+
+    def test_roundtrip(self):
+        replace_map = {}
+        for i in range(200):
+            replace_map["jelmer@samba.org-%04d" % i] = (
+                "jelmer@samba.org-%04d-rebase" % i,
+                ("jelmer@samba.org-%04d-rebase" % (i-1), "otherparent"))
+        f = StringIO()
+        write_rebase_plan_stream(f, (42, "bla"), replace_map)
+        f.seek(0)
+        self.assertEquals(((42, "bla"), replace_map),
+            read_rebase_plan_stream(f))
+
+    def test_read_formatunknown(self):
+        self.assertRaises(UnknownFormatError, read_rebase_plan_stream,
+            StringIO("""# Bazaar rebase plan 1
+1 bla
+oldrev newrev newparent1 newparent2
+"""))
+
+
 class ConversionTests(TestCaseWithTransport):
 
     def test_simple(self):
@@ -251,6 +318,270 @@ class PlanCreatorTests(TestCaseWithTransport):
                     graph, lambda y, _: y+"'", True))
 
 
+def reference_generate_simple_plan(todo_set, start_revid, stop_revid,
+        onto_revid, graph, generate_revid, skip_full_merged=False):
+    """The original implementation of generate_simple_plan."""
+    replace_map = {}
+    parent_map = graph.get_parent_map(todo_set)
+    order = topo_sort(parent_map)
+    if stop_revid is None:
+        stop_revid = order[-1]
+    if start_revid is None:
+        lca = graph.find_lca(stop_revid, onto_revid)
+        if lca == set([NULL_REVISION]):
+            raise UnrelatedBranches()
+        start_revid = order[0]
+    todo = order[order.index(start_revid):order.index(stop_revid)+1]
+    heads_cache = FrozenHeadsCache(graph)
+    for oldrevid in todo:
+        oldparents = parent_map[oldrevid]
+        parents = []
+        if heads_cache.heads((oldparents[0], onto_revid)) == set((onto_revid,)):
+            parents.append(onto_revid)
+        elif oldparents[0] in replace_map:
+            parents.append(replace_map[oldparents[0]][0])
+        else:
+            parents.append(onto_revid)
+            parents.append(oldparents[0])
+        if len(oldparents) > 1:
+            additional_parents = heads_cache.heads(oldparents[1:])
+            for oldparent in oldparents[1:]:
+                if oldparent in additional_parents:
+                    if heads_cache.heads((oldparent, onto_revid)) == set((onto_revid,)):
+                        pass
+                    elif oldparent in replace_map:
+                        newparent = replace_map[oldparent][0]
+                        if parents[0] == onto_revid:
+                            parents[0] = newparent
+                        else:
+                            parents.append(newparent)
+                    else:
+                        parents.append(oldparent)
+            if len(parents) == 1 and skip_full_merged:
+                continue
+        parents = tuple(parents)
+        replace_map[oldrevid] = (generate_revid(oldrevid, parents), parents)
+    return replace_map
+
+
+class CountingGraph(object):
+
+    def __init__(self, graph):
+        self._graph = graph
+        self.searches = []
+
+    def get_parent_map(self, revids):
+        return self._graph.get_parent_map(revids)
+
+    def heads(self, revids):
+        self.searches.append(("heads", tuple(revids)))
+        return self._graph.heads(revids)
+
+    def find_lca(self, *revids):
+        self.searches.append(("find_lca", revids))
+        return self._graph.find_lca(*revids)
+
+
+class SimplePlanComparisonTests(TestCase):
+
+    def plan_or_error(self, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except (UnrelatedBranches, IndexError), e:
+            return e.__class__
+
+    def test_matches_reference(self):
+        rand = random.Random(42)
+        compared = 0
+        for i in range(40):
+            parent_map = make_random_parent_map(rand, 40)
+            graph = Graph(DictParentsProvider(parent_map))
+            for j in range(10):
+                (stop, onto) = rand.sample(sorted(parent_map), 2)
+                todo_set = graph.find_difference(stop, onto)[0]
+                if not todo_set:
+                    continue
+                start = rand.choice([None, rand.choice(sorted(todo_set))])
+                skip = rand.choice([True, False])
+                generate_revid = lambda revid, ps: revid + "'"
+                expected = self.plan_or_error(reference_generate_simple_plan,
+                    todo_set, start, stop, onto, graph, generate_revid, skip)
+                for is_difference in (False, True):
+                    self.assertEquals(expected,
+                        self.plan_or_error(generate_simple_plan, todo_set,
+                            start, stop, onto, graph, generate_revid, skip,
+                            is_difference=is_difference))
+                compared += 1
+        self.assertTrue(compared > 100)
+
+    def test_difference_needs_no_searches(self):
+        parent_map = {
+                "A": (),
+                "B": ("A",),
+                "C": ("B",),
+                "D": ("A",),
+                "E": ("D", "B"),
+                "F": ("E",),
+        }
+        graph = CountingGraph(Graph(DictParentsProvider(parent_map)))
+        self.assertEquals(
+            {"D": ("D'", ("C",)), "E": ("E'", ("D'",)), "F": ("F'", ("E'",))},
+            generate_simple_plan(set(["D", "E", "F"]), None, "F", "C", graph,
+                lambda y, _: y+"'", is_difference=True))
+        self.assertEquals([], graph.searches)
+
+    def test_difference_unrelated(self):
+        parent_map = {"A": (), "B": ("A",), "C": ()}
+        graph = Graph(DictParentsProvider(parent_map))
+        self.assertRaises(UnrelatedBranches, generate_simple_plan,
+            set(["A", "B"]), None, "B", "C", graph, lambda y, _: y+"'",
+            is_difference=True)
+
+
+class CountingParentsProvider(object):
+
+    def __init__(self, parent_map):
+        self._provider = DictParentsProvider(parent_map)
+        self.looked_up = set()
+
+    def get_parent_map(self, revids):
+        self.looked_up.update(revids)
+        return self._provider.get_parent_map(revids)
+
+
+class FindCommonAncestorTests(TestCase):
+
+    def test_chain(self):
+        graph = Graph(DictParentsProvider({"A": (NULL_REVISION,),
+            "B": ("A",), "C": ("B",)}))
+        self.assertEquals("A", find_common_ancestor(graph, ["B", "C"]))
+
+    def test_diamond(self):
+        graph = Graph(DictParentsProvider({"A": (NULL_REVISION,),
+            "B": ("A",), "C": ("A",), "D": ("B", "C")}))
+        self.assertEquals("A", find_common_ancestor(graph, ["C", "D"]))
+        self.assertEquals("A", find_common_ancestor(graph, ["B", "C"]))
+
+    def test_unrelated(self):
+        graph = Graph(DictParentsProvider({"A": (NULL_REVISION,),
+            "B": (NULL_REVISION,)}))
+        self.assertIs(None, find_common_ancestor(graph, ["A", "B"]))
+
+
+class FindAncestorsAmongTests(TestCase):
+
+    def setUp(self):
+        super(FindAncestorsAmongTests, self).setUp()
+        self.parent_map = {"A": (NULL_REVISION,), "B": ("A",), "C": ("B",),
+            "D": ("B",), "E": ("C", "D"), "F": ("D",)}
+        self.graph = Graph(DictParentsProvider(self.parent_map))
+
+    def test_ancestors(self):
+        self.assertEquals(set(["C", "D"]),
+            find_ancestors_among(self.graph, "E", ["C", "D", "F"]))
+        self.assertEquals(set(["B"]),
+            find_ancestors_among(self.graph, "F", ["B", "C"]))
+        self.assertEquals(set(["E"]),
+            find_ancestors_among(self.graph, "E", ["E", "F"]))
+        self.assertEquals(set(),
+            find_ancestors_among(self.graph, "C", ["D", NULL_REVISION]))
+        self.assertEquals(set(), find_ancestors_among(self.graph, "C", []))
+
+    def test_rename_target_descendant(self):
+        graph = Graph(DictParentsProvider({"A": (NULL_REVISION,),
+            "B": ("A",), "B2": ("B",), "C": ("B",)}))
+        self.assertEquals({"C": ("newC", ("B2",))},
+            generate_bounded_transpose_plan(["B2", "C"], {"B": "B2"}, graph,
+                lambda y, _: "new"+y))
+
+    def test_history_not_searched(self):
+        parent_map = {"old0": (NULL_REVISION,)}
+        for i in range(1, 1000):
+            parent_map["old%d" % i] = ("old%d" % (i-1),)
+        parent_map["A"] = ("old999",)
+        parent_map["B"] = ("A",)
+        parent_map["B2"] = ("A",)
+        parent_map["C"] = ("B2",)
+        provider = CountingParentsProvider(parent_map)
+        self.assertEquals(set(),
+            find_ancestors_among(Graph(provider), "C", ["B"]))
+        self.assertTrue(len(provider.looked_up) < 20,
+            "looked up %d revisions" % len(provider.looked_up))
+
+    def test_random(self):
+        rand = random.Random(42)
+        for i in range(50):
+            parent_map = make_random_parent_map(rand, 30,
+                parent_counts=(1, 1, 2))
+            graph = Graph(DictParentsProvider(parent_map))
+            revids = sorted(parent_map)
+            tip = rand.choice(revids)
+            candidates = rand.sample(revids, rand.choice([1, 2, 5]))
+            ancestry = set([r for (r, ps) in graph.iter_ancestry([tip])])
+            self.assertEquals(ancestry.intersection(candidates),
+                find_ancestors_among(graph, tip, candidates))
+
+
+class BoundedTransposePlanTests(TestCase):
+
+    def test_between_renames(self):
+        """Revisions between renamed revisions are rewritten.
+
+        A - R1 - X - R2 - C
+                  \
+                   D
+        """
+        graph = Graph(DictParentsProvider({"A": (NULL_REVISION,),
+            "R1": ("A",), "X": ("R1",), "R2": ("X",), "C": ("R2",),
+            "D": ("X",)}))
+        self.assertEquals({
+            "X": ("newX", ("S1",)),
+            "C": ("newC", ("S2",)),
+            "D": ("newD", ("newX",))},
+            generate_bounded_transpose_plan(["C", "D"],
+                {"R1": "S1", "R2": "S2"}, graph, lambda y, _: "new"+y))
+
+    def test_within_heads(self):
+        graph = Graph(DictParentsProvider({"A": (NULL_REVISION,),
+            "B": ("A",), "C": ("B",), "D": ("B",)}))
+        self.assertEquals({"C": ("newC", ("B2",))},
+            generate_bounded_transpose_plan(["C"], {"B": "B2"}, graph,
+                lambda y, _: "new"+y))
+
+    def test_history_not_searched(self):
+        parent_map = {"old0": (NULL_REVISION,)}
+        for i in range(1, 1000):
+            parent_map["old%d" % i] = ("old%d" % (i-1),)
+        parent_map["A"] = ("old999",)
+        parent_map["B"] = ("A",)
+        parent_map["side"] = ("old998",)
+        parent_map["C"] = ("B", "side")
+        provider = CountingParentsProvider(parent_map)
+        graph = Graph(provider)
+        self.assertEquals({"C": ("newC", ("B2", "side"))},
+            generate_bounded_transpose_plan(["C"], {"B": "B2"}, graph,
+                lambda y, _: "new"+y))
+        self.assertTrue(len(provider.looked_up) < 20,
+            "looked up %d revisions" % len(provider.looked_up))
+
+    def test_matches_full_ancestry(self):
+        rand = random.Random(42)
+        for i in range(100):
+            parent_map = make_random_parent_map(rand, 30,
+                parent_counts=(1, 1, 2, 3))
+            graph = Graph(DictParentsProvider(parent_map))
+            revids = sorted(parent_map)
+            heads = rand.sample(revids, rand.choice([1, 2, 3]))
+            renames = dict([(revid, "new-" + revid) for revid in
+                rand.sample(revids, rand.choice([1, 2, 5]))])
+            generate_revid = lambda revid, ps: "%s(%s)" % (revid, ",".join(ps))
+            self.assertEquals(
+                generate_transpose_plan(graph.iter_ancestry(heads), renames,
+                    graph, generate_revid),
+                generate_bounded_transpose_plan(heads, renames, graph,
+                    generate_revid))
+
+
 class RebaseStateTests(TestCaseWithTransport):
 
     def setUp(self):
@@ -326,12 +657,132 @@ oldrev newrev newparent1 newparent2
         self.assertIs(None, self.state.read_active_revid())
 
 
+class RebaseState2Tests(TestCaseWithTransport):
+
+    def setUp(self):
+        super(RebaseState2Tests, self).setUp()
+        self.wt = self.make_branch_and_tree('.')
+        self.state = RebaseState2(self.wt)
+
+    def test_rebase_plan_exists_false(self):
+        self.assertFalse(self.state.has_plan())
+
+    def test_rebase_plan_exists_empty(self):
+        self.wt._transport.put_bytes(REBASE_PLAN_FILENAME, "")
+        self.assertFalse(self.state.has_plan())
+
+    def test_remove_rebase_plan(self):
+        self.state.write_plan({"oldrev": ("newrev", ("newparent1",))})
+        self.assertTrue(self.state.has_plan())
+        self.state.remove_plan()
+        self.assertFalse(self.state.has_plan())
+        self.assertRaises(NoSuchFile, self.state.read_plan)
+
+    def test_write_read_plan(self):
+        self.wt.commit(message='empty', rev_id="bla")
+        self.state.write_plan(
+                {"oldrev": ("newrev", ("newparent1", "newparent2"))})
+        self.assertEquals(((1, "bla"),
+            {"oldrev": ("newrev", ("newparent1", "newparent2"))}),
+            self.state.read_plan())
+
+    def test_read_plan_format1(self):
+        self.wt._transport.put_bytes(REBASE_PLAN_FILENAME,
+            """# Bazaar rebase plan 1
+1 bla
+oldrev newrev newparent1 newparent2
+""")
+        self.assertEquals(((1, "bla"),
+            {"oldrev": ("newrev", ("newparent1", "newparent2"))}),
+            self.state.read_plan())
+
+    def test_read_plan_entry(self):
+        replace_map = {}
+        for i in range(300):
+            replace_map["rev-%03d" % i] = ("newrev-%03d" % i,
+                ("newrev-%03d" % (i-1),))
+        self.state.write_plan(replace_map)
+        for revid in ("rev-000", "rev-063", "rev-064", "rev-150", "rev-299"):
+            self.assertEquals(replace_map[revid],
+                self.state.read_plan_entry(revid))
+        self.assertRaises(KeyError, self.state.read_plan_entry, "aaa")
+        self.assertRaises(KeyError, self.state.read_plan_entry, "rev-0500")
+
+    def test_read_active_revid_nonexistant(self):
+        self.assertIs(None, self.state.read_active_revid())
+
+    def test_read_active_revid_legacy(self):
+        self.wt._transport.put_bytes(REBASE_CURRENT_REVID_FILENAME, "bla")
+        self.assertEquals("bla", self.state.read_active_revid())
+
+    def test_write_active_revid(self):
+        self.state.write_plan({})
+        self.wt._transport.put_bytes(REBASE_CURRENT_REVID_FILENAME, "bla")
+        self.assertIs(None, self.state.read_active_revid())
+        self.state.write_active_revid("bloe")
+        self.assertEquals("bloe", self.state.read_active_revid())
+        self.state.write_active_revid(None)
+        self.assertIs(None, self.state.read_active_revid())
+
+    def test_read_completed_nonexistant(self):
+        self.assertEquals({}, self.state.read_completed())
+
+    def test_record_completed(self):
+        self.state.write_plan({"a": ("a'", ()), "b": ("b'", ("a'",))})
+        self.state.write_active_revid("a")
+        self.state.record_completed("a", "a'")
+        self.state.write_active_revid(None)
+        self.assertEquals({"a": "a'"}, self.state.read_completed())
+
+    def test_record_completed_interrupted(self):
+        self.state.write_plan({"a": ("a'", ()), "b": ("b'", ("a'",))})
+        self.state.record_completed("a", "a'")
+        self.wt._transport.append_bytes(REBASE_JOURNAL_FILENAME, "done b")
+        self.assertEquals({"a": "a'"}, self.state.read_completed())
+
+    def test_read_completed_format1(self):
+        self.wt.commit("a", rev_id="a'")
+        RebaseState1(self.wt).write_plan({"a": ("a'", ()),
+            "b": ("b'", ("a'",))})
+        self.wt._transport.put_bytes(REBASE_CURRENT_REVID_FILENAME, "b")
+        self.assertEquals({"a": "a'"}, self.state.read_completed())
+        self.assertEquals("b", self.state.read_active_revid())
+        self.state.write_active_revid(None)
+        self.assertEquals({"a": "a'"}, self.state.read_completed())
+        self.assertIs(None, self.state.read_active_revid())
+
+    def test_read_completed_format1_old_journal(self):
+        self.state.write_plan({})
+        self.state.remove_plan()
+        self.wt.commit("a", rev_id="a'")
+        RebaseState1(self.wt).write_plan({"a": ("a'", ())})
+        self.assertEquals({"a": "a'"}, self.state.read_completed())
+
+    def test_write_plan_resets_journal(self):
+        self.state.write_plan({"a": ("a'", ())})
+        self.state.record_completed("a", "a'")
+        self.state.write_plan({"a": ("a'", ())})
+        self.assertEquals({}, self.state.read_completed())
+
+    def test_write_plan_interrupted(self):
+        self.state.write_plan({"a": ("a'", ())})
+        self.state.record_completed("a", "a'")
+        def write_plan_file(filename, last_rev_info, replace_map):
+            raise AssertionError("interrupted")
+        self.state._write_plan_file = write_plan_file
+        self.assertRaises(AssertionError, self.state.write_plan,
+            {"a": ("a2", ())})
+        self.assertEquals({}, self.state.read_completed())
+
+
 class RebaseTodoTests(TestCase):
 
     def test_done(self):
         class Repository:
             def has_revision(self, revid):
                 return revid == "bloe"
+            def has_revisions(self, revids):
+                return set([r for r in revids if self.has_revision(r)])
         self.assertEquals([],
                 list(rebase_todo(Repository(), { "bla": ("bloe", [])})))
 
@@ -339,6 +790,8 @@ class RebaseTodoTests(TestCase):
         class Repository:
             def has_revision(self, revid):
                 return False
+            def has_revisions(self, revids):
+                return set()
         self.assertEquals(["bla"],
                 list(rebase_todo(Repository(), { "bla": ("bloe", [])})))
 
@@ -346,10 +799,26 @@ class RebaseTodoTests(TestCase):
         class Repository:
             def has_revision(self, revid):
                 return revid == "bloe"
+            def has_revisions(self, revids):
+                return set([r for r in revids if self.has_revision(r)])
         self.assertEquals(["ha"],
                 list(rebase_todo(Repository(), { "bla": ("bloe", []),
                                                  "ha": ("hee", [])})))
 
+    def test_completed(self):
+        class Repository:
+            def has_revisions(self, revids):
+                if "bloe" in revids:
+                    raise AssertionError("completed revision probed")
+                return set()
+        class State:
+            def read_completed(self):
+                return {"bla": "bloe"}
+        self.assertEquals(["ha"],
+                list(rebase_todo(Repository(), { "bla": ("bloe", []),
+                                                 "ha": ("hee", [])},
+                                 State())))
+
 
 class ReplaySnapshotTests(TestCaseWithTransport):
 
@@ -486,6 +955,261 @@ class ReplaySnapshotTests(TestCaseWithTransport):
         self.assertEquals("newcommit", inv[inv.path2id("afile")].revision)
 
 
+class CheckInventoryDeltaTests(TestCase):
+
+    def make_inventory(self):
+        inv = Inventory(root_id="rootid")
+        inv.add(InventoryDirectory("dirid", "adir", "rootid"))
+        inv.add(InventoryFile("fileid", "afile", "dirid"))
+        return inv
+
+    def test_consistent(self):
+        inv = self.make_inventory()
+        check_inventory_delta(inv, [
+            (None, "bfile", "newid", InventoryFile("newid", "bfile", "rootid")),
+            ("adir/afile", "adir/cfile", "fileid",
+             InventoryFile("fileid", "cfile", "dirid"))])
+
+    def test_consistent_swap(self):
+        inv = self.make_inventory()
+        check_inventory_delta(inv, [
+            ("adir/afile", None, "fileid", None),
+            (None, "adir/afile", "newid",
+             InventoryFile("newid", "afile", "dirid"))])
+
+    def test_path_versioned(self):
+        inv = self.make_inventory()
+        self.assertRaises(InconsistentDelta, check_inventory_delta, inv, [
+            (None, "adir/afile", "newid",
+             InventoryFile("newid", "afile", "dirid"))])
+
+    def test_missing_parent(self):
+        inv = self.make_inventory()
+        self.assertRaises(InconsistentDelta, check_inventory_delta, inv, [
+            (None, "bdir/bfile", "newid",
+             InventoryFile("newid", "bfile", "bdirid"))])
+
+    def test_removed_parent(self):
+        inv = self.make_inventory()
+        self.assertRaises(InconsistentDelta, check_inventory_delta, inv, [
+            ("adir", None, "dirid", None)])
+
+    def test_wrong_old_path(self):
+        inv = self.make_inventory()
+        self.assertRaises(InconsistentDelta, check_inventory_delta, inv, [
+            ("afile", None, "fileid", None)])
+
+
+class ReplayReusingTextsTests(TestCaseWithTransport):
+
+    def make_old_and_new(self):
+        wt = self.make_branch_and_tree("old")
+        self.build_tree_contents([('old/afile', 'base content'),
+            ('old/gone', 'removed later'), ('old/adir/',)])
+        wt.add(["afile", "gone", "adir"], ids=["originalid", "goneid", "dirid"])
+        wt.commit("bla", rev_id="oldparent")
+        self.build_tree_contents([('old/afile', 'bloe'),
+            ('old/adir/nfile', 'new content'), ('old/subdir/',)])
+        wt.add(["adir/nfile", "subdir"], ids=["nfileid", "subdirid"])
+        wt.remove(["gone"])
+        wt.commit("bla", rev_id="oldcommit")
+        oldrepos = wt.branch.repository
+        wt = self.make_branch_and_tree("new")
+        self.build_tree_contents([('new/afile', 'base content'),
+            ('new/gone', 'removed later'), ('new/adir/',)])
+        wt.add(["afile", "gone", "adir"], ids=["newid", "goneid", "dirid"])
+        wt.commit("bla", rev_id="newparent")
+        wt.branch.repository.fetch(oldrepos)
+        return wt.branch.repository
+
+    def replay(self, repository, newrevid, reuse_texts):
+        repository.lock_write()
+        self.addCleanup(repository.unlock)
+        return CommitBuilderRevisionRewriter(repository,
+            reuse_texts=reuse_texts)("oldcommit", newrevid, ("newparent",))
+
+    def get_entries(self, repository, revid):
+        result = {}
+        inv = repository.get_inventory(revid)
+        for path, ie in inv.iter_entries():
+            result[path] = (ie.file_id, ie.parent_id, ie.kind, ie.text_sha1,
+                            ie.text_size, ie.revision)
+        return result
+
+    def test_matches_commit_builder(self):
+        repository = self.make_old_and_new()
+        self.replay(repository, "builtcommit", False)
+        repository.get_commit_builder = None
+        self.replay(repository, "newcommit", True)
+        built = self.get_entries(repository, "builtcommit")
+        replayed = self.get_entries(repository, "newcommit")
+        for path, entry in built.items():
+            if entry[5] == "builtcommit":
+                built[path] = entry[:5] + ("newcommit",)
+        self.assertEquals(built, replayed)
+        self.assertEquals("newid", repository.get_inventory(
+            "newcommit").path2id("afile"))
+        rev = repository.get_revision("newcommit")
+        self.assertEquals(["newparent"], rev.parent_ids)
+        self.assertEquals("oldcommit", rev.properties[REVPROP_REBASE_OF])
+
+    def test_copies_texts(self):
+        repository = self.make_old_and_new()
+        self.replay(repository, "newcommit", True)
+        tree = repository.revision_tree("newcommit")
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        self.assertEquals("bloe", tree.get_file_text("newid"))
+        self.assertEquals("new content", tree.get_file_text("nfileid"))
+        self.assertEquals({("newid", "newcommit"): (("newid", "newparent"),)},
+            repository.texts.get_parent_map([("newid", "newcommit")]))
+
+    def test_multiple_parents_uses_commit_builder(self):
+        repository = self.make_old_and_new()
+        repository.lock_write()
+        self.addCleanup(repository.unlock)
+        rewriter = CommitBuilderRevisionRewriter(repository, map_ids=False,
+            reuse_texts=True)
+        rewriter._replay_reusing_texts = None
+        rewriter("oldcommit", "newcommit", ("oldparent", "newparent"))
+        self.assertEquals(["oldparent", "newparent"],
+            repository.get_revision("newcommit").parent_ids)
+
+
+class RecordingState(object):
+
+    def __init__(self, rewriter):
+        self.rewriter = rewriter
+        self.completed = []
+
+    def read_completed(self):
+        return {}
+
+    def record_completed(self, oldrevid, newrevid):
+        if newrevid in self.rewriter.uncommitted:
+            raise AssertionError("%s recorded before commit" % newrevid)
+        self.completed.append((oldrevid, newrevid))
+
+
+class FailingRewriter(object):
+
+    def __init__(self, exception):
+        self.exception = exception
+        self.aborts = 0
+
+    def __call__(self, oldrevid, newrevid, new_parents):
+        raise self.exception
+
+    def abort(self):
+        self.aborts += 1
+        raise BzrError("abort failed")
+
+
+class BatchedReplayTests(TestCaseWithTransport):
+
+    def make_chain(self, count):
+        wt = self.make_branch_and_tree("old")
+        self.build_tree_contents([('old/afile', 'base content')])
+        wt.add(["afile"])
+        wt.commit("base", rev_id="oldparent")
+        plan = {}
+        newparent = "newparent"
+        for i in range(count):
+            self.build_tree_contents([('old/afile', 'content %d' % i)])
+            wt.commit("change %d" % i, rev_id="old%d" % i)
+            plan["old%d" % i] = ("new%d" % i, (newparent,))
+            newparent = "new%d" % i
+        oldrepos = wt.branch.repository
+        wt = wt.bzrdir.sprout("new",
+            revision_id="oldparent").open_workingtree()
+        wt.branch.repository.fetch(oldrepos)
+        self.build_tree(['new/bfile'])
+        wt.add(["bfile"])
+        wt.commit("bla", rev_id="newparent")
+        return wt.branch.repository, plan
+
+    def rebase_batched(self, repository, plan, checkpoint_interval):
+        repository.lock_write()
+        self.addCleanup(repository.unlock)
+        commits = []
+        orig_commit_write_group = repository.commit_write_group
+        def commit_write_group():
+            commits.append(repository.is_in_write_group())
+            return orig_commit_write_group()
+        repository.commit_write_group = commit_write_group
+        rewriter = CommitBuilderRevisionRewriter(repository,
+            reuse_texts=True, checkpoint_interval=checkpoint_interval)
+        state = RecordingState(rewriter)
+        rebase(repository, plan, rewriter, state=state)
+        return commits, state.completed
+
+    def test_checkpoints(self):
+        repository, plan = self.make_chain(5)
+        commits, completed = self.rebase_batched(repository, plan, 2)
+        self.assertEquals(3, len(commits))
+        self.assertEquals(sorted(plan.items()),
+            sorted([(old, (new, plan[old][1])) for (old, new) in completed]))
+        tree = repository.revision_tree("new4")
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        self.assertEquals("content 4", tree.get_file_text(tree.path2id("afile")))
+        self.assertEquals(["new3"], repository.get_revision("new4").parent_ids)
+        self.assertTrue(tree.has_filename("bfile"))
+
+    def test_abort_loses_checkpoint(self):
+        repository, plan = self.make_chain(5)
+        repository.lock_write()
+        self.addCleanup(repository.unlock)
+        rewriter = CommitBuilderRevisionRewriter(repository,
+            reuse_texts=True, checkpoint_interval=2)
+        state = RecordingState(rewriter)
+        orig_replay = rewriter._replay_reusing_texts
+        def replay(oldrev, newrevid, *args):
+            if newrevid == "new3":
+                raise BzrError("interrupted")
+            return orig_replay(oldrev, newrevid, *args)
+        rewriter._replay_reusing_texts = replay
+        self.assertRaises(BzrError, rebase, repository, plan, rewriter,
+            state=state)
+        self.assertFalse(repository.is_in_write_group())
+        self.assertEquals(set(["new0", "new1"]),
+            repository.has_revisions(["new0", "new1", "new2", "new3"]))
+        self.assertEquals([("old0", "new0"), ("old1", "new1")],
+            state.completed)
+
+    def test_abort_error_keeps_original(self):
+        repository, plan = self.make_chain(1)
+        repository.lock_read()
+        self.addCleanup(repository.unlock)
+        rewriter = FailingRewriter(BzrError("replay failed"))
+        e = self.assertRaises(BzrError, rebase, repository, plan, rewriter)
+        self.assertEquals("replay failed", str(e))
+        self.assertEquals(1, rewriter.aborts)
+
+    def test_interrupt_does_not_abort(self):
+        repository, plan = self.make_chain(1)
+        repository.lock_read()
+        self.addCleanup(repository.unlock)
+        rewriter = FailingRewriter(KeyboardInterrupt())
+        self.assertRaises(KeyboardInterrupt, rebase, repository, plan,
+            rewriter)
+        self.assertEquals(0, rewriter.aborts)
+
+    def test_inconsistent_delta_keeps_checkpoint(self):
+        repository, plan = self.make_chain(5)
+        def check_inventory_delta(basis_inv, delta):
+            if basis_inv.revision_id == "new2":
+                raise InconsistentDelta("afile", "fileid", "broken")
+        self.overrideAttr(rebase_module, "check_inventory_delta",
+            check_inventory_delta)
+        commits, completed = self.rebase_batched(repository, plan, 5)
+        self.assertEquals(set(["new%d" % i for i in range(5)]),
+            repository.has_revisions(["new%d" % i for i in range(5)]))
+        self.assertEquals(sorted(plan.items()),
+            sorted([(old, (new, plan[old][1])) for (old, new) in completed]))
+        self.assertEquals(["new2"], repository.get_revision("new3").parent_ids)
+
+
 class TestReplayWorkingtree(TestCaseWithTransport):
     def test_conflicts(self):
         wt = self.make_branch_and_tree("old")
@@ -634,7 +1358,380 @@ class TestReplayWorkingtree(TestCaseWithTransport):
                 RevisionHistoryMatches(["A", "B", "C", "D'", "E'"]))
 
 
+class DivergedTreeTestCase(TestCaseWithTransport):
+
+    def make_diverged(self):
+        wt = self.make_branch_and_tree("old")
+        wt.commit("base", rev_id="base")
+        self.build_tree_contents([('old/afile', 'base content')])
+        wt.add(["afile"], ids=["originalid"])
+        wt.commit("bla", rev_id="oldparent")
+        self.build_tree_contents([('old/afile', 'bloe')])
+        wt.commit("bla", rev_id="oldcommit")
+        oldrepos = wt.branch.repository
+        wt = wt.bzrdir.sprout("new",
+            revision_id="oldparent").open_workingtree()
+        wt.branch.repository.fetch(oldrepos)
+        self.build_tree(['new/bfile'])
+        wt.add(["bfile"], ids=["newid"])
+        wt.commit("bla", rev_id="newparent")
+        return wt
+
+
+class TestReplayInMemory(DivergedTreeTestCase):
+    def test_simple(self):
+        wt = self.make_diverged()
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = InMemoryRevisionRewriter(wt, RebaseState2(wt))
+        replayer("oldcommit", "newcommit", ("newparent",))
+        # The working tree is not touched until the rebase is finished
+        self.assertEquals("newparent", wt.last_revision())
+        oldrev = wt.branch.repository.get_revision("oldcommit")
+        newrev = wt.branch.repository.get_revision("newcommit")
+        self.assertEquals(["newparent"], newrev.parent_ids)
+        self.assertEquals(oldrev.timestamp, newrev.timestamp)
+        self.assertEquals(oldrev.timezone, newrev.timezone)
+        self.assertEquals(oldrev.message, newrev.message)
+        newtree = wt.branch.repository.revision_tree("newcommit")
+        newtree.lock_read()
+        self.addCleanup(newtree.unlock)
+        self.assertEquals("bloe", newtree.get_file_text("originalid"))
+        self.assertEquals("newid", newtree.path2id("bfile"))
+        replayer.finish()
+        self.assertEquals("newcommit", wt.last_revision())
+        self.assertEquals("newcommit", wt.branch.last_revision())
+        self.assertEquals("bloe", open("new/afile", "r").read())
+        self.assertFalse(wt.changes_from(wt.basis_tree()).has_changed())
+
+    def test_ghost_parent(self):
+        wt = self.make_diverged()
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = InMemoryRevisionRewriter(wt, RebaseState2(wt))
+        replayer("oldcommit", "newcommit", ("newparent", "ghost"))
+        newrev = wt.branch.repository.get_revision("newcommit")
+        self.assertEquals(["newparent", "ghost"], newrev.parent_ids)
+
+    def test_conflicts(self):
+        wt = self.make_diverged()
+        self.build_tree_contents([('new/afile', 'other')])
+        wt.commit("bla", rev_id="newparent2")
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = InMemoryRevisionRewriter(wt, RebaseState2(wt))
+        self.assertRaises(ConflictsInTree,
+            replayer, "oldcommit", "newcommit", ("newparent2",))
+        self.assertEquals(1, len(wt.conflicts()))
+        self.assertEquals("newparent2", wt.last_revision())
+
+    def test_recorded_after_finish(self):
+        wt = self.make_diverged()
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = InMemoryRevisionRewriter(wt, RebaseState2(wt))
+        state = RecordingState(replayer)
+        rebase(wt.branch.repository,
+            {"oldcommit": ("newcommit", ("newparent",))}, replayer,
+            state=state)
+        self.assertEquals([("oldcommit", "newcommit")], state.completed)
+        self.assertEquals(set(), replayer.uncommitted)
+        self.assertEquals("newcommit", wt.branch.last_revision())
+
+    def test_not_recorded_if_finish_fails(self):
+        wt = self.make_diverged()
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = InMemoryRevisionRewriter(wt, RebaseState2(wt))
+        def finish():
+            raise AssertionError("finish failed")
+        replayer.finish = finish
+        state = RecordingState(replayer)
+        self.assertRaises(AssertionError, rebase, wt.branch.repository,
+            {"oldcommit": ("newcommit", ("newparent",))}, replayer,
+            state=state)
+        self.assertEquals([], state.completed)
+        self.assertEquals(set(["newcommit"]), replayer.uncommitted)
+
+
+class TestReplayHybrid(DivergedTreeTestCase):
+
+    def test_snapshot(self):
+        wt = self.make_diverged()
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = HybridRevisionRewriter(wt, RebaseState2(wt))
+        replayer("oldcommit", "newcommit", ("newparent",))
+        self.assertEquals((1, 0),
+            (replayer.snapshot_count, replayer.merge_count))
+        self.assertEquals("newparent", wt.last_revision())
+        newrev = wt.branch.repository.get_revision("newcommit")
+        self.assertEquals(["newparent"], newrev.parent_ids)
+        self.assertEquals("oldcommit", newrev.properties["rebase-of"])
+        replayer.finish()
+        self.assertEquals("newcommit", wt.last_revision())
+        self.assertEquals("bloe", open("new/afile", "r").read())
+        self.assertPathExists("new/bfile")
+
+    def test_overlap(self):
+        wt = self.make_diverged()
+        self.build_tree_contents([('new/afile', 'base content\nmore\n')])
+        wt.commit("bla", rev_id="newparent2")
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = HybridRevisionRewriter(wt, RebaseState2(wt))
+        self.assertRaises(ConflictsInTree,
+            replayer, "oldcommit", "newcommit", ("newparent2",))
+        self.assertEquals((0, 1),
+            (replayer.snapshot_count, replayer.merge_count))
+
+    def test_upstream_changes_reused(self):
+        wt = self.make_diverged()
+        oldwt = wt.bzrdir.sprout("old2", revision_id="oldcommit"
+            ).open_workingtree()
+        self.build_tree_contents([('old2/afile', 'bloe2')])
+        oldwt.commit("bla", rev_id="oldcommit2")
+        wt.branch.repository.fetch(oldwt.branch.repository)
+        compared = []
+        def changed_paths(new_tree, old_tree):
+            compared.append((new_tree.get_revision_id(),
+                             old_tree.get_revision_id()))
+            return orig_changed_paths(new_tree, old_tree)
+        orig_changed_paths = self.overrideAttr(rebase_module,
+            "changed_paths", changed_paths)
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = HybridRevisionRewriter(wt, RebaseState2(wt))
+        replayer("oldcommit", "newcommit", ("newparent",))
+        replayer("oldcommit2", "newcommit2", ("newcommit",))
+        self.assertEquals((2, 0),
+            (replayer.snapshot_count, replayer.merge_count))
+        self.assertEquals([("oldcommit", "oldparent"),
+                           ("newparent", "oldparent"),
+                           ("oldcommit2", "oldcommit")], compared)
+        replayer.finish()
+        self.assertEquals("newcommit2", wt.last_revision())
+        self.assertEquals("bloe2", open("new/afile", "r").read())
+        self.assertPathExists("new/bfile")
+
+
+class PathsOverlapTests(TestCase):
+
+    def test_disjoint(self):
+        self.assertFalse(paths_overlap(set(["a", "b/c"]), set(["b/d", "c"])))
+
+    def test_same(self):
+        self.assertTrue(paths_overlap(set(["a", "b/c"]), set(["b/c"])))
+
+    def test_parent(self):
+        self.assertTrue(paths_overlap(set(["b"]), set(["b/c/d"])))
+        self.assertTrue(paths_overlap(set(["b/c/d"]), set(["b"])))
+
+    def test_prefix(self):
+        self.assertFalse(paths_overlap(set(["b"]), set(["bc/d"])))
+
+    def test_root(self):
+        self.assertTrue(paths_overlap(set([""]), set(["a"])))
+
+    def test_empty(self):
+        self.assertFalse(paths_overlap(set(), set(["a"])))
+
+
+class RestrictedMergePathsTests(TestCaseWithTransport):
+
+    def make_trees(self):
+        wt = self.make_branch_and_tree(".")
+        self.build_tree_contents([("afile", "a"), ("bfile", "b"),
+            ("dir/",), ("dir/cfile", "c")])
+        wt.add(["afile", "bfile", "dir", "dir/cfile"])
+        wt.commit("base", rev_id="base")
+        return wt
+
+    def get_merge_paths(self, wt):
+        wt.commit("other", rev_id="other")
+        repo = wt.branch.repository
+        return restricted_merge_paths(repo.revision_tree("base"),
+            repo.revision_tree("other"))
+
+    def test_modified(self):
+        wt = self.make_trees()
+        self.build_tree_contents([("afile", "aa"), ("dir/cfile", "cc")])
+        self.assertEquals(["afile", "dir/cfile"], self.get_merge_paths(wt))
+
+    def test_added_removed(self):
+        wt = self.make_trees()
+        wt.remove(["bfile"], keep_files=False)
+        self.build_tree_contents([("dir/dfile", "d")])
+        wt.add(["dir/dfile"])
+        self.assertEquals(["bfile", "dir/dfile"], self.get_merge_paths(wt))
+
+    def test_renamed(self):
+        wt = self.make_trees()
+        wt.rename_one("afile", "dir/afile")
+        self.assertIs(None, self.get_merge_paths(wt))
+
+    def test_directory_added(self):
+        wt = self.make_trees()
+        self.build_tree(["newdir/"])
+        wt.add(["newdir"])
+        self.assertIs(None, self.get_merge_paths(wt))
+
+    def test_unchanged(self):
+        wt = self.make_trees()
+        self.assertIs(None, self.get_merge_paths(wt))
+
+
+class TestReplayRestricted(DivergedTreeTestCase):
+
+    def test_renamed_upstream(self):
+        wt = self.make_diverged()
+        wt.rename_one("afile", "cfile")
+        wt.commit("rename", rev_id="newparent2")
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = WorkingTreeRevisionRewriter(wt, RebaseState2(wt))
+        self.assertEquals(["afile"],
+            replayer.get_merge_paths("oldparent", "oldcommit"))
+        self.assertEquals(["cfile"],
+            replayer.get_commit_paths(["afile"], "oldparent", "oldcommit"))
+        replayer("oldcommit", "newcommit", ("newparent2",))
+        self.assertEquals("bloe", open("new/cfile", "r").read())
+        self.assertPathDoesNotExist("new/afile")
+        newtree = wt.branch.repository.revision_tree("newcommit")
+        self.assertEquals("originalid", newtree.path2id("cfile"))
+
+    def test_check_commit(self):
+        wt = self.make_diverged()
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = WorkingTreeRevisionRewriter(wt, RebaseState2(wt),
+            check_interval=1)
+        replayer("oldcommit", "newcommit", ("newparent",))
+        self.assertFalse(wt.changes_from(wt.basis_tree()).has_changed())
+        self.assertEquals("bloe", open("new/afile", "r").read())
+
+    def test_incremental_revert(self):
+        wt = self.make_diverged()
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = WorkingTreeRevisionRewriter(wt, RebaseState2(wt),
+            paranoid=True)
+        calls = []
+        self.overrideAttr(rebase_module, "incremental_revert",
+            lambda *args: calls.append(args[1]))
+        replayer("oldcommit", "newcommit", ("newparent",))
+        self.assertEquals([], calls)
+        replayer("oldcommit", "newcommit2", ("newcommit",))
+        self.assertEquals([["newcommit"]], calls)
+
+    def test_check_commit_mismatch(self):
+        wt = self.make_diverged()
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        replayer = WorkingTreeRevisionRewriter(wt, RebaseState2(wt),
+            check_interval=1)
+        self.build_tree_contents([("new/afile", "changed"),
+            ("new/bfile", "changed")])
+        oldrev = wt.branch.repository.get_revision("oldcommit")
+        self.assertRaises(RestrictedCommitMismatch,
+            replayer.commit_rebase, oldrev, "newcommit", ["bfile"])
+
+
+class IncrementalRevertTests(TestCaseWithTransport):
+
+    def test_revert(self):
+        wt = self.make_branch_and_tree(".")
+        self.build_tree_contents([("afile", "a"), ("bfile", "b"),
+            ("dir/",), ("dir/cfile", "c"), ("dfile", "d")])
+        wt.add(["afile", "bfile", "dir", "dir/cfile", "dfile"])
+        wt.commit("base", rev_id="base")
+        self.build_tree_contents([("afile", "aa"), ("efile", "e")])
+        wt.add(["efile"])
+        wt.remove(["bfile"], keep_files=False)
+        wt.rename_one("dir", "newdir")
+        wt.commit("other", rev_id="other")
+        wt.branch.generate_revision_history("base")
+        wt.set_parent_ids(["base"])
+        wt.revert(backups=False)
+        self.build_tree_contents([("dfile", "uncommitted")])
+        wt.commit("local", rev_id="local")
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        incremental_revert(wt, ["other"], paranoid=True)
+        self.assertEquals(["other"], wt.get_parent_ids())
+        self.assertEquals("other", wt.branch.last_revision())
+        self.assertFalse(wt.changes_from(
+            wt.branch.repository.revision_tree("other")).has_changed())
+        self.assertEquals("aa", open("afile").read())
+        self.assertEquals("d", open("dfile").read())
+        self.assertPathDoesNotExist("bfile")
+        self.assertPathDoesNotExist("dir")
+        self.assertPathExists("newdir/cfile")
+        self.assertPathExists("efile")
+
+    def test_merge_parents(self):
+        wt = self.make_branch_and_tree(".")
+        wt.commit("base", rev_id="base")
+        self.build_tree_contents([("afile", "a")])
+        wt.add(["afile"])
+        wt.commit("other", rev_id="other")
+        wt.lock_write()
+        self.addCleanup(wt.unlock)
+        incremental_revert(wt, ["base", "ghost"])
+        self.assertEquals(["base", "ghost"], wt.get_parent_ids())
+        self.assertPathDoesNotExist("afile")
+
+
+class InventoryDeltaToChangesTests(TestCaseWithTransport):
+
+    def assertChangesMatch(self, wt, old_revid, new_revid):
+        repo = wt.branch.repository
+        old_tree = repo.revision_tree(old_revid)
+        new_tree = repo.revision_tree(new_revid)
+        delta = new_tree.root_inventory._make_delta(old_tree.root_inventory)
+        self.assertEquals(sorted(new_tree.iter_changes(old_tree)),
+            sorted(inventory_delta_to_changes(delta,
+                old_tree.root_inventory)))
+
+    def test_changes(self):
+        wt = self.make_branch_and_tree(".")
+        self.build_tree_contents([("afile", "a"), ("bfile", "b"),
+            ("dir/",), ("dir/cfile", "c"), ("dfile", "d"), ("efile", "e")])
+        wt.add(["afile", "bfile", "dir", "dir/cfile", "dfile", "efile"])
+        wt.commit("base", rev_id="base")
+        self.build_tree_contents([("afile", "aa"), ("ffile", "f"),
+            ("dfile", "dd")])
+        wt.add(["ffile"])
+        wt.remove(["bfile"], keep_files=False)
+        wt.rename_one("dir", "newdir")
+        wt.rename_one("efile", "newdir/efile")
+        os.chmod("ffile", 0755)
+        wt.commit("other", rev_id="other")
+        self.assertChangesMatch(wt, "base", "other")
+        self.assertChangesMatch(wt, "other", "base")
+        self.assertChangesMatch(wt, NULL_REVISION, "other")
+
+    def test_last_modified_only(self):
+        wt = self.make_branch_and_tree(".")
+        self.build_tree_contents([("afile", "a")])
+        wt.add(["afile"])
+        wt.commit("base", rev_id="base")
+        self.build_tree_contents([("afile", "b")])
+        wt.commit("change", rev_id="change")
+        self.build_tree_contents([("afile", "a")])
+        wt.commit("back", rev_id="back")
+        self.assertChangesMatch(wt, "base", "back")
+
+
 class TestReplaySnapshotError(TestCase):
 
     def test_create(self):
         ReplaySnapshotError("message")
+
+
+class TestRestrictedCommitMismatch(TestCase):
+
+    def test_create(self):
+        self.assertEquals(
+            "Commit of the changed paths in rev missed changes to: a, b.",
+            str(RestrictedCommitMismatch("rev", ["a", "b"])))
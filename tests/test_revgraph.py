@@ -0,0 +1,115 @@
+# Copyright (C) 2012 by Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Tests for the compact revision graph."""
+
+import random
+
+from bzrlib.errors import GraphCycleError
+from bzrlib.graph import (
+    DictParentsProvider,
+    Graph,
+    )
+from bzrlib.revision import NULL_REVISION
+from bzrlib.tests import TestCase
+
+from bzrlib.plugins.rewrite.revgraph import CompactGraph
+from bzrlib.plugins.rewrite.tests import make_random_parent_map
+
+
+class CompactGraphTests(TestCase):
+
+    def test_get_parents(self):
+        graph = CompactGraph({"A": (), "B": ("A", "ghost")})
+        self.assertEquals(("A", "ghost"), graph.get_parents("B"))
+        self.assertEquals((), graph.get_parents("A"))
+        self.assertIs(None, graph.get_parents("ghost"))
+        self.assertIs(None, graph.get_parents("unknown"))
+
+    def test_contains(self):
+        graph = CompactGraph({"A": (), "B": ("A", "ghost")})
+        self.assertEquals(2, len(graph))
+        self.assertTrue("B" in graph)
+        self.assertFalse("ghost" in graph)
+        self.assertFalse("unknown" in graph)
+
+    def test_ancestry(self):
+        graph = CompactGraph([("B", ("A", "ghost")), ("ghost", None),
+                              ("A", ()), ("B", ("A", "ghost"))])
+        self.assertEquals(2, len(graph))
+        self.assertEquals(("A", "ghost"), graph.get_parents("B"))
+        self.assertEquals(["A", "B"], graph.topo_sort())
+
+    def test_topo_sort(self):
+        graph = CompactGraph({"A": (), "B": ("A",), "C": ("A",),
+                              "D": ("C", "B"), "E": ("D", "other")})
+        order = graph.topo_sort()
+        self.assertEquals(set("ABCDE"), set(order))
+        for revid in order:
+            for parent in graph.get_parents(revid):
+                if parent in graph:
+                    self.assertTrue(order.index(parent) < order.index(revid))
+
+    def test_topo_sort_subset(self):
+        graph = CompactGraph({"A": (), "B": ("A",), "C": ("B",)})
+        self.assertEquals(["B", "C"], graph.topo_sort(["C", "B"]))
+        self.assertRaises(KeyError, graph.topo_sort, ["ghost"])
+
+    def test_topo_sort_cycle(self):
+        graph = CompactGraph({"A": ("B",), "B": ("A",), "C": ()})
+        self.assertRaises(GraphCycleError, graph.topo_sort)
+
+    def test_descendants(self):
+        graph = CompactGraph({"A": (), "B": ("A",), "C": ("B",),
+                              "D": ("A",), "E": ("ghost",)})
+        self.assertEquals(set(["C"]), graph.descendants(["B"]))
+        self.assertEquals(set(["B", "C", "D"]), graph.descendants(["A"]))
+        self.assertEquals(set(["C"]), graph.descendants(["B", "C"]))
+        self.assertEquals(set(["E"]), graph.descendants(["ghost"]))
+        self.assertEquals(set(), graph.descendants(["unknown"]))
+
+    def test_heads(self):
+        graph = CompactGraph({"A": (), "B": ("A",), "C": ("B",),
+                              "D": ("A",)})
+        self.assertEquals(set(["C"]), graph.heads(["A", "B", "C"]))
+        self.assertEquals(set(["C", "D"]), graph.heads(["C", "D"]))
+        self.assertEquals(set(["C", "unknown"]),
+            graph.heads(["C", "unknown"]))
+
+    def test_random(self):
+        rand = random.Random(42)
+        for i in range(20):
+            parent_map = make_random_parent_map(rand, 60)
+            graph = CompactGraph(parent_map)
+            reference = Graph(DictParentsProvider(parent_map))
+            order = graph.topo_sort()
+            self.assertEquals(sorted(parent_map), sorted(order))
+            for revid in order:
+                for parent in parent_map[revid]:
+                    if parent != NULL_REVISION:
+                        self.assertTrue(
+                            order.index(parent) < order.index(revid))
+            for j in range(10):
+                revids = rand.sample(sorted(parent_map), rand.choice([2, 3]))
+                self.assertEquals(reference.heads(revids),
+                    graph.heads(revids))
+                descendants = set()
+                for revid in parent_map:
+                    for other in revids:
+                        if (revid != other and
+                            reference.heads([revid, other]) == set([revid])):
+                            descendants.add(revid)
+                self.assertEquals(descendants, graph.descendants(revids))
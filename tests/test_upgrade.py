@@ -16,12 +16,24 @@
 
 """Mapping upgrade tests."""
 
+from bzrlib.errors import BzrError
+from bzrlib.revision import Revision
 from bzrlib.tests import (
     TestCase,
+    TestCaseWithTransport,
     )
+from bzrlib.workingtree import WorkingTree
 
+from bzrlib.plugins.rewrite import upgrade
+from bzrlib.plugins.rewrite.rebase import CommitBuilderRevisionRewriter
 from bzrlib.plugins.rewrite.upgrade import (
     UpgradeChangesContent,
+    UpgradeState,
+    create_deterministic_revid,
+    find_changed_revisions,
+    upgrade_branch,
+    upgrade_repository,
+    upgrade_tags,
     )
 
 
@@ -30,3 +42,327 @@ class TestUpgradeChangesContent(TestCase):
     def test_init(self):
         x = UpgradeChangesContent("revisionx")
         self.assertEqual("revisionx", x.revid)
+
+    def test_str(self):
+        self.assertEqual("Upgrade will change contents in revision revisionx. "
+            "Use --allow-changes to override.",
+            str(UpgradeChangesContent("revisionx")))
+        self.assertEqual("Upgrade will change contents in revision a, b. "
+            "Use --allow-changes to override.",
+            str(UpgradeChangesContent("a", ["a", "b"])))
+
+
+class CountingRevisions(object):
+
+    def __init__(self, revisions):
+        self.revisions = revisions
+        self.calls = []
+
+    def get_revisions(self, revids):
+        self.calls.append(len(revids))
+        return [self.revisions[revid] for revid in revids]
+
+
+class FindChangedRevisionsTests(TestCase):
+
+    def make_revision(self, revid, message):
+        return Revision(revid, timestamp=0, timezone=0, committer="Joe",
+            message=message, inventory_sha1="sha", properties={})
+
+    def test_changed(self):
+        revisions = {}
+        upgrade_map = {}
+        for i in range(1200):
+            oldrevid = "old-%d" % i
+            newrevid = "new-%d" % i
+            revisions[oldrevid] = self.make_revision(oldrevid, "msg")
+            if i in (5, 700):
+                message = "changed"
+            else:
+                message = "msg"
+            revisions[newrevid] = self.make_revision(newrevid, message)
+            upgrade_map[oldrevid] = newrevid
+        repository = CountingRevisions(revisions)
+        self.assertEquals(["old-5", "old-700"],
+            find_changed_revisions(repository, upgrade_map))
+        self.assertEquals([500, 500, 500, 500, 200, 200], repository.calls)
+
+    def test_new_revisions_not_cached(self):
+        revisions = {"a": self.make_revision("a", "msg"),
+                     "b": self.make_revision("b", "msg")}
+        repository = CountingRevisions(revisions)
+        cache = CountingRevisions(revisions)
+        self.assertEquals([],
+            find_changed_revisions(repository, {"a": "b"}, cache))
+        self.assertEquals([1], cache.calls)
+        self.assertEquals([1], repository.calls)
+
+    def test_unchanged(self):
+        revisions = {"a": self.make_revision("a", "msg"),
+                     "b": self.make_revision("b", "msg")}
+        self.assertEquals([],
+            find_changed_revisions(CountingRevisions(revisions), {"a": "b"}))
+
+
+class UpgradeStateTests(TestCaseWithTransport):
+
+    def setUp(self):
+        super(UpgradeStateTests, self).setUp()
+        self.repository = self.make_repository(".")
+        self.state = UpgradeState(self.repository)
+
+    def test_no_plan(self):
+        self.assertFalse(self.state.has_plan())
+        self.assertIs(None, self.state.read_upgrade_plan(["arev"], {}))
+
+    def test_write_read(self):
+        self.state.write_plan(["arev"], {"b": "b2"}, {"a": ("a2", ("b2",))},
+            {"a": "a2", "b": "b2"})
+        self.assertEquals(({"a": ("a2", ("b2",))}, {"a": "a2", "b": "b2"}),
+            self.state.read_upgrade_plan(["arev"], {"b": "b2"}))
+
+    def test_other_heads(self):
+        self.state.write_plan(["arev"], {"b": "b2"}, {"a": ("a2", ("b2",))},
+            {"a": "a2"})
+        self.assertIs(None, self.state.read_upgrade_plan(["brev"],
+            {"b": "b2"}))
+        self.assertIs(None, self.state.read_upgrade_plan(["arev", "brev"],
+            {"b": "b2"}))
+
+    def test_other_selection(self):
+        self.state.write_plan(["arev"], {"b": "b2"}, {"a": ("a2", ("b2",))},
+            {"a": "a2"})
+        self.assertIs(None, self.state.read_upgrade_plan(["arev"],
+            {"b": "b3"}))
+        self.assertIs(None, self.state.read_upgrade_plan(["arev"],
+            {"b": "b2", "c": "c2"}))
+
+    def test_new_revisions_not_heads(self):
+        self.state.write_plan(["arev"], {"b": "b2"}, {"a": ("a2", ("b2",))},
+            {"a": "a2"})
+        self.assertIsNot(None, self.state.read_upgrade_plan(["a2", "arev"],
+            {"b": "b2"}))
+
+    def test_other_revids(self):
+        self.state.write_plan(["arev"], {"b": "b2"}, {"a": ("a2", ("b2",))},
+            {"a": "a2"})
+        self.assertIsNot(None, self.state.read_upgrade_plan(["arev"],
+            {"b": "b2"}, lambda revid, parents: revid + "2"))
+        self.assertIs(None, self.state.read_upgrade_plan(["arev"],
+            {"b": "b2"}, lambda revid, parents: revid + "3"))
+
+    def test_write_clears_journal(self):
+        self.state.write_plan(["arev"], {}, {"a": ("a2", ())}, {})
+        self.state.record_completed("a", "a2")
+        self.state.write_plan(["arev"], {}, {"a": ("a2", ())}, {})
+        self.assertEquals({}, self.state.read_completed())
+
+    def test_remove(self):
+        self.state.write_plan(["arev"], {}, {"a": ("a2", ())}, {})
+        self.state.record_completed("a", "a2")
+        self.state.remove_plan()
+        self.assertFalse(self.state.has_plan())
+        self.assertEquals({}, self.state.read_completed())
+        self.state.remove_plan()
+
+    def test_active_revid(self):
+        self.assertIs(None, self.state.read_active_revid())
+        self.state.write_plan(["arev"], {}, {"a": ("a2", ())}, {})
+        self.state.write_active_revid("a")
+        self.assertEquals("a", self.state.read_active_revid())
+        self.state.write_active_revid(None)
+        self.assertIs(None, self.state.read_active_revid())
+
+
+class ResumeUpgradeTests(TestCaseWithTransport):
+
+    def make_old_chain(self):
+        wt = self.make_branch_and_tree(".")
+        wt.commit("base", rev_id="base")
+        wt.commit("base, upgraded", rev_id="base-upgraded")
+        wt.set_parent_ids(["base"])
+        wt.branch.generate_revision_history("base")
+        wt.commit("one", rev_id="one")
+        wt.commit("two", rev_id="two")
+        return wt.branch.repository
+
+    def generate_rebase_map(self, revision_id):
+        return {"base": "base-upgraded"}
+
+    def interrupt_upgrade(self, repository, revision_id):
+        class InterruptedRewriter(CommitBuilderRevisionRewriter):
+            def __call__(self, oldrevid, newrevid, new_parents):
+                if oldrevid == "two":
+                    raise BzrError("interrupted")
+                return CommitBuilderRevisionRewriter.__call__(self, oldrevid,
+                    newrevid, new_parents)
+        self.overrideAttr(upgrade, "CommitBuilderRevisionRewriter",
+            InterruptedRewriter)
+        self.assertRaises(BzrError, upgrade_repository, repository,
+            self.generate_rebase_map, create_deterministic_revid,
+            revision_id=revision_id, allow_changes=True,
+            checkpoint_interval=None)
+        self.overrideAttr(upgrade, "CommitBuilderRevisionRewriter",
+            CommitBuilderRevisionRewriter)
+
+    def test_resume(self):
+        repository = self.make_old_chain()
+        self.interrupt_upgrade(repository, "two")
+        state = UpgradeState(repository)
+        self.assertTrue(state.has_plan())
+        newone = create_deterministic_revid("one", ["base-upgraded"])
+        self.assertEquals({"one": newone}, state.read_completed())
+        def generate_bounded_transpose_plan(*args):
+            raise AssertionError("plan was regenerated")
+        self.overrideAttr(upgrade, "generate_bounded_transpose_plan",
+            generate_bounded_transpose_plan)
+        renames = upgrade_repository(repository, self.generate_rebase_map,
+            create_deterministic_revid, revision_id="two",
+            allow_changes=True)
+        newtwo = create_deterministic_revid("two", [newone])
+        self.assertEquals({"base": "base-upgraded", "one": newone,
+                           "two": newtwo}, renames)
+        self.assertEquals([newone],
+            repository.get_revision(newtwo).parent_ids)
+        self.assertFalse(state.has_plan())
+
+    def test_resume_all_revisions(self):
+        repository = self.make_old_chain()
+        self.interrupt_upgrade(repository, None)
+        def generate_bounded_transpose_plan(*args):
+            raise AssertionError("plan was regenerated")
+        self.overrideAttr(upgrade, "generate_bounded_transpose_plan",
+            generate_bounded_transpose_plan)
+        renames = upgrade_repository(repository, self.generate_rebase_map,
+            create_deterministic_revid, allow_changes=True)
+        self.assertEquals(set(["base", "one", "two"]), set(renames))
+
+    def test_new_revision_replans(self):
+        repository = self.make_old_chain()
+        self.interrupt_upgrade(repository, None)
+        WorkingTree.open(".").commit("three", rev_id="three")
+        renames = upgrade_repository(repository, self.generate_rebase_map,
+            create_deterministic_revid, allow_changes=True)
+        self.assertEquals(set(["base", "one", "two", "three"]),
+            set(renames))
+        self.assertEquals([renames["two"]],
+            repository.get_revision(renames["three"]).parent_ids)
+        self.assertFalse(UpgradeState(repository).has_plan())
+
+    def test_other_revids_replan(self):
+        repository = self.make_old_chain()
+        self.interrupt_upgrade(repository, "two")
+        def determine_new_revid(revid, new_parents):
+            return revid + "-upgraded"
+        renames = upgrade_repository(repository, self.generate_rebase_map,
+            determine_new_revid, revision_id="two", allow_changes=True)
+        self.assertEquals("two-upgraded", renames["two"])
+        self.assertEquals(["one-upgraded"],
+            repository.get_revision("two-upgraded").parent_ids)
+
+    def test_changes_content(self):
+        repository = self.make_old_chain()
+        def generate_rebase_map(revision_id):
+            return {"base": "base-upgraded", "one": "base-upgraded"}
+        e = self.assertRaises(UpgradeChangesContent, upgrade_repository,
+            repository, generate_rebase_map, create_deterministic_revid,
+            revision_id="two")
+        self.assertEquals(["base", "one"], e.revids)
+        self.assertFalse(UpgradeState(repository).has_plan())
+
+    def test_other_revision_replans(self):
+        repository = self.make_old_chain()
+        UpgradeState(repository).write_plan(["one"], {}, {}, {})
+        renames = upgrade_repository(repository, self.generate_rebase_map,
+            create_deterministic_revid, revision_id="two",
+            allow_changes=True)
+        self.assertEquals(set(["base", "one", "two"]), set(renames))
+
+
+class UpgradeTagsTests(TestCaseWithTransport):
+
+    def make_tagged_branch(self):
+        wt = self.make_branch_and_tree(".")
+        wt.commit("base", rev_id="base")
+        wt.commit("base, upgraded", rev_id="base-upgraded")
+        wt.set_parent_ids(["base"])
+        wt.branch.generate_revision_history("base")
+        wt.commit("one", rev_id="one")
+        wt.commit("side", rev_id="side")
+        wt.set_parent_ids(["one"])
+        wt.branch.generate_revision_history("one")
+        wt.commit("two", rev_id="two")
+        wt.branch.tags.set_tag("tag-one", "one")
+        wt.branch.tags.set_tag("tag-side", "side")
+        wt.branch.tags.set_tag("tag-ghost", "ghost")
+        return wt.branch
+
+    def count_upgrades(self):
+        calls = []
+        orig = upgrade.upgrade_repository
+        def upgrade_repository(*args, **kwargs):
+            calls.append(kwargs.get("revision_ids"))
+            return orig(*args, **kwargs)
+        self.overrideAttr(upgrade, "upgrade_repository", upgrade_repository)
+        return calls
+
+    def test_upgrade_branch(self):
+        branch = self.make_tagged_branch()
+        upgrades = self.count_upgrades()
+        maps = []
+        def generate_rebase_map(revision_id):
+            maps.append(revision_id)
+            return {"base": "base-upgraded"}
+        branch.lock_write()
+        try:
+            renames = upgrade_branch(branch, generate_rebase_map,
+                create_deterministic_revid, allow_changes=True)
+        finally:
+            branch.unlock()
+        self.assertEquals([["two", "one", "side"]], upgrades)
+        self.assertEquals(["side", "two"], maps)
+        newone = create_deterministic_revid("one", ["base-upgraded"])
+        self.assertEquals(renames["two"], branch.last_revision())
+        self.assertEquals({"tag-one": newone, "tag-side": renames["side"],
+                           "tag-ghost": "ghost"}, branch.tags.get_tag_dict())
+
+    def test_upgrade_tags(self):
+        branch = self.make_tagged_branch()
+        upgrades = self.count_upgrades()
+        def generate_rebase_map(revision_id):
+            return {"base": "base-upgraded"}
+        branch.lock_write()
+        try:
+            upgrade_tags(branch.tags, branch.repository, generate_rebase_map,
+                create_deterministic_revid, allow_changes=True)
+        finally:
+            branch.unlock()
+        self.assertEquals([["one", "side"]], upgrades)
+        newone = create_deterministic_revid("one", ["base-upgraded"])
+        self.assertEquals(newone, branch.tags.lookup_tag("tag-one"))
+        self.assertEquals("two", branch.last_revision())
+
+    def test_many_tags(self):
+        branch = self.make_tagged_branch()
+        tag_dict = branch.tags.get_tag_dict()
+        for i in range(10000):
+            tag_dict["tag-%d" % i] = ["one", "side", "two"][i % 3]
+        branch.tags._set_tag_dict(tag_dict)
+        writes = []
+        orig = branch._set_tags_bytes
+        def set_tags_bytes(bytes):
+            writes.append(len(bytes))
+            return orig(bytes)
+        self.overrideAttr(branch, "_set_tags_bytes", set_tags_bytes)
+        def generate_rebase_map(revision_id):
+            return {"base": "base-upgraded"}
+        branch.lock_write()
+        try:
+            renames = upgrade_branch(branch, generate_rebase_map,
+                create_deterministic_revid, allow_changes=True)
+        finally:
+            branch.unlock()
+        self.assertEquals(1, len(writes))
+        tag_dict = branch.tags.get_tag_dict()
+        self.assertEquals(renames["side"], tag_dict["tag-1"])
+        self.assertEquals(renames["two"], tag_dict["tag-2"])
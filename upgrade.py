@@ -22,25 +22,131 @@ from __future__ import absolute_import
 from bzrlib import (
     osutils,
     trace,
-    ui,
     )
 from bzrlib.errors import (
     BzrError,
+    NoSuchFile,
+    )
+from bzrlib.revision import NULL_REVISION
+from bzrlib.tag import BasicTags
+from bzrlib.plugins.rewrite.cache import (
+    REVISION_PREFETCH_CHUNK,
+    RevisionCache,
+    RevisionPresenceCache,
+    RevisionTreeCache,
     )
 from bzrlib.plugins.rewrite.rebase import (
-    generate_transpose_plan,
+    REBASE_CHECKPOINT_INTERVAL,
+    find_ancestors_among,
+    generate_bounded_transpose_plan,
     CommitBuilderRevisionRewriter,
+    JournaledPlanState,
+    read_rebase_plan_stream,
     rebase,
     rebase_todo,
     )
 
 
+UPGRADE_PLAN_FILENAME = 'upgrade-plan'
+UPGRADE_RENAMES_FILENAME = 'upgrade-renames'
+UPGRADE_JOURNAL_FILENAME = 'upgrade-journal'
+
+
 class UpgradeChangesContent(BzrError):
     """Inconsistency was found upgrading the mapping of a revision."""
-    _fmt = """Upgrade will change contents in revision %(revid)s. Use --allow-changes to override."""
+    _fmt = """Upgrade will change contents in revision %(revisions)s. Use --allow-changes to override."""
 
-    def __init__(self, revid):
+    def __init__(self, revid, revids=None):
+        if revids is None:
+            revids = [revid]
         self.revid = revid
+        self.revids = revids
+        self.revisions = ", ".join(revids)
+
+
+class UpgradeState(JournaledPlanState):
+    """State of an upgrade, kept in the control directory of the repository.
+
+    The plan and journal use the same formats as those of a rebase. The plan
+    records a digest of the revisions it was created for in place of the
+    last revision info, so that it is only resumed by an upgrade of the same
+    revisions. Revisions that had already been upgraded when the plan was
+    created are kept in a separate file, as entries without parents.
+    """
+
+    _plan_filename = UPGRADE_PLAN_FILENAME
+    _journal_filename = UPGRADE_JOURNAL_FILENAME
+
+    def __init__(self, repository):
+        super(UpgradeState, self).__init__(repository.control_transport)
+        self.repository = repository
+
+    def write_plan(self, heads, upgrade_map, replace_map, renames):
+        """Write an upgrade plan.
+
+        :param heads: Heads of the ancestry the plan was created for
+        :param upgrade_map: Dictionary with the revisions that were selected
+            for upgrade, mapping old to new revision ids
+        :param replace_map: Replace map (old revid -> (new revid, new parents))
+        :param renames: Dictionary with the revisions that have been upgraded
+            already, mapping old to new revision ids
+        """
+        digest = _upgrade_plan_digest(heads, upgrade_map, replace_map)
+        # Clear the journal first, so it is never combined with a new plan
+        self.transport.put_bytes(self._journal_filename, '')
+        self._write_plan_file(UPGRADE_RENAMES_FILENAME, (0, digest),
+            dict([(oldrevid, (newrevid, ()))
+                  for (oldrevid, newrevid) in renames.iteritems()
+                  if oldrevid not in replace_map]))
+        self._write_plan_file(self._plan_filename, (0, digest), replace_map)
+
+    def read_upgrade_plan(self, heads, upgrade_map, determine_new_revid=None):
+        """Read the upgrade plan for a set of revisions, if there is one.
+
+        A plan is only returned if it was created for the same heads and
+        selected revisions, and if it agrees with determine_new_revid for
+        every revision in it. The caller has to select the revisions again
+        to obtain heads and upgrade_map.
+
+        :param heads: Heads of the ancestry to upgrade
+        :param upgrade_map: Dictionary with the revisions that are selected
+            for upgrade, mapping old to new revision ids
+        :param determine_new_revid: Optional function for creating new
+            revision ids, to check the plan against
+        :return: Tuple with replace map and dictionary with renamed
+            revisions, or None if there is no plan for these revisions
+        """
+        if not self.has_plan():
+            return None
+        ((revno, digest), replace_map) = self.read_plan()
+        if digest != _upgrade_plan_digest(heads, upgrade_map, replace_map):
+            trace.mutter("upgrade plan is out of date, not resuming")
+            return None
+        if determine_new_revid is not None:
+            for (oldrevid, (newrevid, parents)) in replace_map.iteritems():
+                if determine_new_revid(oldrevid, parents) != newrevid:
+                    trace.mutter("upgrade plan uses other revision ids, "
+                                 "not resuming")
+                    return None
+        f = self.transport.get(UPGRADE_RENAMES_FILENAME)
+        try:
+            (last_rev_info, renamed) = read_rebase_plan_stream(f)
+        finally:
+            f.close()
+        renames = dict([(oldrevid, newrevid)
+            for (oldrevid, (newrevid, parents)) in renamed.iteritems()])
+        for (oldrevid, (newrevid, parents)) in replace_map.iteritems():
+            renames[oldrevid] = newrevid
+        return (replace_map, renames)
+
+    def remove_plan(self):
+        """Remove the upgrade plan and journal."""
+        for name in (self._plan_filename, UPGRADE_RENAMES_FILENAME,
+                     self._journal_filename):
+            try:
+                self.transport.delete(name)
+            except NoSuchFile:
+                pass
 
 
 def create_deterministic_revid(revid, new_parents):
@@ -56,114 +162,279 @@ def create_deterministic_revid(revid, new_parents):
     return revid + "-rebase-" + osutils.sha_string(":".join(new_parents))[:8]
 
 
+def _present_tag_targets(repository, tags_dict, renames):
+    """Find the tagged revisions that are present and not renamed yet.
+
+    :param repository: Repository to check
+    :param tags_dict: Dictionary mapping tag names to revision ids
+    :param renames: Dictionary with renamed revisions
+    :return: Sorted list of revision ids
+    """
+    targets = set(tags_dict.itervalues())
+    targets.difference_update(renames)
+    targets.discard(NULL_REVISION)
+    if not targets:
+        return []
+    repository.lock_read()
+    try:
+        return sorted(repository.has_revisions(targets))
+    finally:
+        repository.unlock()
+
+
+def _set_tags(tags, updates):
+    """Set a number of tags at once.
+
+    Tags that are stored in a single dictionary are all written in one go,
+    rather than rewriting the dictionary for every tag.
+
+    :param tags: Tags object to update
+    :param updates: Dictionary mapping tag names to new revision ids
+    """
+    if not isinstance(tags, BasicTags):
+        for name, revid in updates.iteritems():
+            tags.set_tag(name, revid)
+        return
+    tags.branch.lock_write()
+    try:
+        master = tags.branch.get_master_branch()
+        if master is not None:
+            _set_tags(master.tags, updates)
+        tag_dict = tags.get_tag_dict()
+        tag_dict.update(updates)
+        tags._set_tag_dict(tag_dict)
+    finally:
+        tags.branch.unlock()
+
+
+def _update_tags(tags, tags_dict, renames, branch_ancestry=None):
+    """Point tags at the upgraded versions of their revisions.
+
+    :param tags: Tags object to update
+    :param tags_dict: Dictionary mapping tag names to revision ids
+    :param renames: Dictionary with renamed revisions
+    :param branch_ancestry: Optional ancestry of the branch; tags on
+        revisions in it are left alone
+    """
+    updates = {}
+    for name, revid in tags_dict.iteritems():
+        if (revid in renames and
+            (branch_ancestry is None or not revid in branch_ancestry)):
+            updates[name] = renames[revid]
+    if updates:
+        _set_tags(tags, updates)
+
+
 def upgrade_tags(tags, repository, generate_rebase_map, determine_new_revid,
                  allow_changes=False, verbose=False, branch_renames=None,
-                 branch_ancestry=None):
-    """Upgrade a tags dictionary."""
+                 branch_ancestry=None,
+                 checkpoint_interval=REBASE_CHECKPOINT_INTERVAL):
+    """Upgrade a tags dictionary.
+
+    All tagged revisions are upgraded in a single upgrade of the repository.
+    """
     renames = {}
     if branch_renames is not None:
         renames.update(branch_renames)
-    pb = ui.ui_factory.nested_progress_bar()
-    try:
-        tags_dict = tags.get_tag_dict()
-        for i, (name, revid) in enumerate(tags_dict.iteritems()):
-            pb.update("upgrading tags", i, len(tags_dict))
-            if not revid in renames:
-                try:
-                    repository.lock_read()
-                    revid_exists = repository.has_revision(revid)
-                finally:
-                    repository.unlock()
-                if revid_exists:
-                    renames.update(upgrade_repository(repository, 
-                          generate_rebase_map, determine_new_revid,
-                          revision_id=revid, allow_changes=allow_changes,
-                          verbose=verbose))
-            if (revid in renames and 
-                (branch_ancestry is None or not revid in branch_ancestry)):
-                tags.set_tag(name, renames[revid])
-    finally:
-        pb.finished()
+    tags_dict = tags.get_tag_dict()
+    targets = _present_tag_targets(repository, tags_dict, renames)
+    if targets:
+        renames.update(upgrade_repository(repository, generate_rebase_map,
+            determine_new_revid, allow_changes=allow_changes,
+            verbose=verbose, checkpoint_interval=checkpoint_interval,
+            revision_ids=targets))
+    _update_tags(tags, tags_dict, renames, branch_ancestry)
 
 
 def upgrade_branch(branch, generate_rebase_map, determine_new_revid,
-                   allow_changes=False, verbose=False):
+                   allow_changes=False, verbose=False,
+                   checkpoint_interval=REBASE_CHECKPOINT_INTERVAL):
     """Upgrade a branch to the current mapping version.
 
+    The branch tip and all tagged revisions are upgraded in a single
+    upgrade of the repository.
+
     :param branch: Branch to upgrade.
     :param foreign_repository: Repository to fetch new revisions from
     :param allow_changes: Allow changes in mappings.
     :param verbose: Whether to print verbose list of rewrites
+    :param checkpoint_interval: Number of revisions to write in a single
+        write group, or None to write each revision in its own
     """
     revid = branch.last_revision()
+    if branch.supports_tags():
+        tags_dict = branch.tags.get_tag_dict()
+    else:
+        tags_dict = {}
+    heads = [revid]
+    heads.extend([target for target in
+        _present_tag_targets(branch.repository, tags_dict, {})
+        if target != revid])
     renames = upgrade_repository(branch.repository, generate_rebase_map,
-              determine_new_revid, revision_id=revid,
-              allow_changes=allow_changes, verbose=verbose)
+              determine_new_revid, allow_changes=allow_changes,
+              verbose=verbose, checkpoint_interval=checkpoint_interval,
+              revision_ids=heads)
     if revid in renames:
         branch.generate_revision_history(renames[revid])
-    ancestry = branch.repository.get_ancestry(branch.last_revision(),
-                    topo_sorted=False)
-    upgrade_tags(branch.tags, branch.repository, generate_rebase_map,
-            determine_new_revid,
-           allow_changes=allow_changes, verbose=verbose,
-           branch_renames=renames, branch_ancestry=ancestry)
+    if tags_dict:
+        branch_ancestry = find_ancestors_among(
+            branch.repository.get_graph(), branch.last_revision(),
+            [target for target in tags_dict.itervalues()
+             if target in renames])
+        _update_tags(branch.tags, tags_dict, renames, branch_ancestry)
     return renames
 
 
-def check_revision_changed(oldrev, newrev):
-    """Check if two revisions are different. This is exactly the same
-    as Revision.equals() except that it does not check the revision_id."""
-    if (newrev.inventory_sha1 != oldrev.inventory_sha1 or
+def _revision_changed(oldrev, newrev):
+    return (newrev.inventory_sha1 != oldrev.inventory_sha1 or
         newrev.timestamp != oldrev.timestamp or
         newrev.message != oldrev.message or
         newrev.timezone != oldrev.timezone or
         newrev.committer != oldrev.committer or
-        newrev.properties != oldrev.properties):
+        newrev.properties != oldrev.properties)
+
+
+def check_revision_changed(oldrev, newrev):
+    """Check if two revisions are different. This is exactly the same
+    as Revision.equals() except that it does not check the revision_id."""
+    if _revision_changed(oldrev, newrev):
         raise UpgradeChangesContent(oldrev.revision_id)
 
 
-def create_upgrade_plan(repository, generate_rebase_map, determine_new_revid,
-                        revision_id=None, allow_changes=False):
-    """Generate a rebase plan for upgrading revisions.
+def find_changed_revisions(repository, upgrade_map, revisions=None):
+    """Find the revisions of which the contents would change in an upgrade.
+
+    Old and new revisions are retrieved in batches of
+    REVISION_PREFETCH_CHUNK revisions. The new revisions are only needed
+    for the comparison, so they are always read from the repository
+    directly rather than being kept in revisions.
+
+    :param repository: Repository to retrieve the new revisions from
+    :param upgrade_map: Dictionary mapping old to new revision ids
+    :param revisions: Optional `RevisionCache` to retrieve the old revisions
+        from; defaults to repository
+    :return: Sorted list with the old revision ids of the revisions that
+        are changed
+    """
+    if revisions is None:
+        revisions = repository
+    changed = []
+    oldrevids = sorted(upgrade_map)
+    for i in range(0, len(oldrevids), REVISION_PREFETCH_CHUNK):
+        chunk = oldrevids[i:i+REVISION_PREFETCH_CHUNK]
+        oldrevs = revisions.get_revisions(chunk)
+        newrevs = repository.get_revisions(
+            [upgrade_map[oldrevid] for oldrevid in chunk])
+        for oldrev, newrev in zip(oldrevs, newrevs):
+            if _revision_changed(oldrev, newrev):
+                changed.append(oldrev.revision_id)
+    return changed
+
+
+def _select_upgrade_revisions(repository, generate_rebase_map,
+                              revision_id=None, revision_ids=None):
+    """Select the revisions to upgrade.
 
     :param repository: Repository to do upgrade in
-    :param foreign_repository: Subversion repository to fetch new revisions
-        from.
-    :param new_mapping: New mapping to use.
     :param revision_id: Revision to upgrade (None for all revisions in
         repository.)
-    :param allow_changes: Whether an upgrade is allowed to change the contents
-        of revisions.
-    :return: Tuple with a rebase plan and map of renamed revisions.
+    :param revision_ids: Optional list of revisions to upgrade, instead of
+        revision_id. generate_rebase_map is only called for the revisions
+        that are not an ancestor of one of the others.
+    :return: Tuple with the heads of the ancestry to upgrade and a
+        dictionary mapping the old to the new revision ids of the selected
+        revisions
     """
+    if revision_ids is not None:
+        heads = sorted(repository.get_graph().heads(revision_ids))
+        upgrade_map = {}
+        for head in heads:
+            upgrade_map.update(generate_rebase_map(head))
+    else:
+        upgrade_map = generate_rebase_map(revision_id)
+        if revision_id is None:
+            heads = repository.all_revision_ids()
+        else:
+            heads = [revision_id]
+    return (heads, upgrade_map)
 
-    graph = repository.get_graph()
-    upgrade_map = generate_rebase_map(revision_id)
 
-    if not allow_changes:
-        for oldrevid, newrevid in upgrade_map.iteritems():
-            oldrev = repository.get_revision(oldrevid)
-            newrev = repository.get_revision(newrevid)
-            check_revision_changed(oldrev, newrev)
+def _upgrade_plan_digest(heads, upgrade_map, replace_map):
+    """Create a digest of the revisions an upgrade plan is created for.
 
-    if revision_id is None:
-        heads = repository.all_revision_ids()
-    else:
-        heads = [revision_id]
+    Heads that are new revisions of the plan itself are left out, so the
+    digest does not change as revisions are upgraded.
+
+    :param heads: Heads of the ancestry to upgrade
+    :param upgrade_map: Dictionary with the revisions that are selected
+        for upgrade, mapping old to new revision ids
+    :param replace_map: Replace map of the plan
+    :return: Digest, usable as revision id in a plan file
+    """
+    new_revids = set([newrevid
+        for (newrevid, parents) in replace_map.itervalues()])
+    lines = ["head %s\n" % revid for revid in sorted(set(heads))
+             if revid not in new_revids]
+    lines.extend(["upgrade %s %s\n" % (oldrevid, upgrade_map[oldrevid])
+                  for oldrevid in sorted(upgrade_map)])
+    return "upgrade-plan:" + osutils.sha_strings(lines)
+
+
+def _plan_upgrade(repository, heads, upgrade_map, determine_new_revid,
+                  allow_changes=False, revisions=None):
+    """Generate a rebase plan for upgrading a set of selected revisions.
 
+    See `create_upgrade_plan`.
+    """
+    if not allow_changes:
+        if revisions is None:
+            revisions = RevisionCache(repository)
+        changed = find_changed_revisions(repository, upgrade_map,
+            revisions)
+        if changed:
+            raise UpgradeChangesContent(changed[0], changed)
 
-    plan = generate_transpose_plan(graph.iter_ancestry(heads), upgrade_map,
-      graph, determine_new_revid)
+    plan = generate_bounded_transpose_plan(heads, upgrade_map,
+        repository.get_graph(), determine_new_revid)
     def remove_parents((oldrevid, (newrevid, parents))):
         return (oldrevid, newrevid)
-    upgrade_map.update(dict(map(remove_parents, plan.iteritems())))
+    renames = dict(upgrade_map)
+    renames.update(dict(map(remove_parents, plan.iteritems())))
 
-    return (plan, upgrade_map)
+    return (plan, renames)
+
+
+def create_upgrade_plan(repository, generate_rebase_map, determine_new_revid,
+                        revision_id=None, allow_changes=False,
+                        revisions=None, revision_ids=None):
+    """Generate a rebase plan for upgrading revisions.
+
+    :param repository: Repository to do upgrade in
+    :param foreign_repository: Subversion repository to fetch new revisions
+        from.
+    :param new_mapping: New mapping to use.
+    :param revision_id: Revision to upgrade (None for all revisions in
+        repository.)
+    :param allow_changes: Whether an upgrade is allowed to change the contents
+        of revisions.
+    :param revisions: Optional `RevisionCache` to retrieve revisions from.
+    :param revision_ids: Optional list of revisions to upgrade, instead of
+        revision_id. generate_rebase_map is only called for the revisions
+        that are not an ancestor of one of the others.
+    :return: Tuple with a rebase plan and map of renamed revisions.
+    """
+    (heads, upgrade_map) = _select_upgrade_revisions(repository,
+        generate_rebase_map, revision_id=revision_id,
+        revision_ids=revision_ids)
+    return _plan_upgrade(repository, heads, upgrade_map, determine_new_revid,
+        allow_changes=allow_changes, revisions=revisions)
 
 
 def upgrade_repository(repository, generate_rebase_map,
                        determine_new_revid, revision_id=None,
-                       allow_changes=False, verbose=False):
+                       allow_changes=False, verbose=False,
+                       checkpoint_interval=REBASE_CHECKPOINT_INTERVAL,
+                       revision_ids=None):
     """Upgrade the revisions in repository until the specified stop revision.
 
     :param repository: Repository in which to upgrade.
@@ -173,19 +444,51 @@ def upgrade_repository(repository, generate_rebase_map,
                         all revisions.
     :param allow_changes: Allow changes to mappings.
     :param verbose: Whether to print list of rewrites
+    :param checkpoint_interval: Number of revisions to write in a single
+        write group, or None to write each revision in its own
+    :param revision_ids: Optional list of revision ids to upgrade, instead
+        of revision_id
     :return: Dictionary of mapped revisions
+
+    The plan and progress of the upgrade are kept in the repository, so an
+    interrupted upgrade of the same revisions continues where it stopped.
+    Resuming only skips generating the plan and replaying the revisions
+    that were already upgraded: the revisions to upgrade are always
+    selected again, which calls generate_rebase_map and, when upgrading
+    all revisions, lists all revisions in the repository. Every entry of
+    the stored plan is also checked against determine_new_revid. The plan
+    is recreated if any of these changed since it was written.
     """
     # Find revisions that need to be upgraded, create
     # dictionary with revision ids in key, new parents in value
     try:
         repository.lock_write()
-        (plan, revid_renames) = create_upgrade_plan(repository,
-            generate_rebase_map, determine_new_revid,
-            revision_id=revision_id, allow_changes=allow_changes)
+        presence = RevisionPresenceCache(repository)
+        revisions = RevisionCache(repository, presence)
+        trees = RevisionTreeCache(repository)
+        state = UpgradeState(repository)
+        (heads, upgrade_map) = _select_upgrade_revisions(repository,
+            generate_rebase_map, revision_id=revision_id,
+            revision_ids=revision_ids)
+        resumed = state.read_upgrade_plan(heads, upgrade_map,
+            determine_new_revid)
+        if resumed is not None:
+            (plan, revid_renames) = resumed
+        else:
+            (plan, revid_renames) = _plan_upgrade(repository, heads,
+                upgrade_map, determine_new_revid,
+                allow_changes=allow_changes, revisions=revisions)
+            state.write_plan(heads, upgrade_map, plan, revid_renames)
         if verbose:
             for revid in rebase_todo(repository, plan):
                 trace.note("%s -> %s" % (revid, plan[revid][0]))
-        rebase(repository, plan, CommitBuilderRevisionRewriter(repository))
+        rebase(repository, plan,
+            CommitBuilderRevisionRewriter(repository, presence=presence,
+                trees=trees, revisions=revisions, reuse_texts=True,
+                checkpoint_interval=checkpoint_interval),
+            state=state, presence=presence, trees=trees,
+            revisions=revisions)
+        state.remove_plan()
         return revid_renames
     finally:
         repository.unlock()